@@ -0,0 +1,133 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Benchmarks of the mixture contamination engine.
+
+The leave-one-out pass of within-dataset should scale linearly with the
+number of nonzero entries of the table. The module can also be run directly
+to print the per-sample cost at each size, which should stay roughly
+constant:
+
+    $ python -m benchmarks.contamination
+
+The shard benchmarks compare a worker of a sharded leave-one-out pass
+loading the table from its BIOM file against mapping it as written by
+write_mapped, before assessing one eighth of the samples.
+"""
+import os
+import tempfile
+import time
+
+import h5py
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as ss
+import biom
+
+from q2_mislabeled._mixture import mixture_proportions
+from q2_mislabeled._mmap import MappedTable, write_mapped
+
+# the fraction of the samples in each shard
+SHARD_FRACTION = 1 / 8
+
+
+def _synthetic_sources(n_samples, n_environments=6, n_features=5000,
+                       pool_size=1000, nnz_per_sample=150, seed=42):
+    # each environment draws its samples' features from its own, overlapping
+    # pool of features
+    rng = np.random.default_rng(seed)
+    pools = np.vstack([rng.choice(n_features, pool_size, replace=False)
+                       for _ in range(n_environments)])
+    labels = rng.integers(0, n_environments, n_samples)
+
+    picks = rng.integers(0, pool_size, (n_samples, nnz_per_sample))
+    rows = pools[labels[:, None], picks].ravel()
+    cols = np.repeat(np.arange(n_samples), nnz_per_sample)
+    data = rng.geometric(0.1, n_samples * nnz_per_sample).astype(float)
+    matrix = ss.coo_matrix((data, (rows, cols)),
+                           shape=(n_features, n_samples)).tocsr()
+
+    ids = ['S%d' % i for i in range(n_samples)]
+    table = biom.Table(matrix, ['F%d' % i for i in range(n_features)], ids)
+    env = pd.Series(np.array(['env-%d' % i
+                              for i in range(n_environments)])[labels],
+                    index=ids)
+    return table, env
+
+
+class LeaveOneOut:
+    params = [1000, 10000, 100000]
+    param_names = ['n_samples']
+    timeout = 600
+
+    def setup(self, n_samples):
+        self.table, self.env = _synthetic_sources(n_samples)
+
+    def time_mixture_leave_one_out(self, n_samples):
+        mixture_proportions(self.table, self.env)
+
+    def peakmem_mixture_leave_one_out(self, n_samples):
+        mixture_proportions(self.table, self.env)
+
+
+def _write_table(table, directory):
+    # the table as each layout stores it
+    path = os.path.join(directory, 'feature-table.biom')
+    with h5py.File(path, 'w') as fh:
+        table.to_hdf5(fh, generated_by='q2-mislabeled benchmarks')
+    write_mapped(table, os.path.join(directory, 'mapped'))
+    return path, os.path.join(directory, 'mapped')
+
+
+def _shard(layout, path, env):
+    if layout == 'hdf5':
+        table = biom.load_table(path)
+    else:
+        table = MappedTable(path)
+    shard = env.index[:max(1, int(len(env) * SHARD_FRACTION))]
+    return mixture_proportions(table, env, loo_ids=shard)
+
+
+class LeaveOneOutShard:
+    params = ([10000, 100000], ['hdf5', 'mapped'])
+    param_names = ['n_samples', 'layout']
+    timeout = 600
+
+    def setup(self, n_samples, layout):
+        table, self.env = _synthetic_sources(n_samples)
+        self.tmp = tempfile.TemporaryDirectory()
+        paths = _write_table(table, self.tmp.name)
+        self.path = paths[0] if layout == 'hdf5' else paths[1]
+
+    def teardown(self, n_samples, layout):
+        self.tmp.cleanup()
+
+    def time_shard(self, n_samples, layout):
+        _shard(layout, self.path, self.env)
+
+    def peakmem_shard(self, n_samples, layout):
+        _shard(layout, self.path, self.env)
+
+
+if __name__ == '__main__':
+    for n_samples in LeaveOneOut.params:
+        table, env = _synthetic_sources(n_samples)
+        start = time.perf_counter()
+        mixture_proportions(table, env)
+        elapsed = time.perf_counter() - start
+        print("%7d samples  %8.2fs  %6.1fus/sample" %
+              (n_samples, elapsed, elapsed / n_samples * 1e6))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = dict(zip(LeaveOneOutShard.params[1],
+                             _write_table(table, tmp)))
+            for layout, path in paths.items():
+                start = time.perf_counter()
+                _shard(layout, path, env)
+                print("%7d samples  %-6s shard  %8.2fs" %
+                      (n_samples, layout, time.perf_counter() - start))
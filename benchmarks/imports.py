@@ -0,0 +1,68 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Benchmarks of the time to load the plugin.
+
+Every QIIME 2 command loads every installed plugin, so this is paid by each
+command. Each benchmark runs in a fresh interpreter. The libraries QIIME 2
+itself loads first (pandas, biom and q2-types) are imported in the setup,
+so that only the cost of this plugin is measured. The module can also be
+run directly to print the median of several runs:
+
+    $ python -m benchmarks.imports
+"""
+import importlib.util
+import statistics
+import subprocess
+import sys
+
+# loaded by QIIME 2 before any plugin
+FRAMEWORK = "import pandas, biom, qiime2, q2_types.feature_table"
+
+# the package, and the actions plugin_setup registers, without needing
+# QIIME 2 to build the plugin
+PACKAGE = ("import q2_mislabeled\n"
+           "[getattr(q2_mislabeled, name) for name in q2_mislabeled.__all__]\n"
+           "q2_mislabeled.__version__")
+
+PLUGIN = "import q2_mislabeled.plugin_setup"
+
+
+def _require_qiime2():
+    if importlib.util.find_spec('qiime2') is None:
+        raise NotImplementedError("QIIME 2 is not available")
+
+
+class Import:
+    timeout = 120
+
+    def timeraw_package(self):
+        _require_qiime2()
+        return PACKAGE, FRAMEWORK
+
+    def timeraw_plugin(self):
+        _require_qiime2()
+        return PLUGIN, FRAMEWORK
+
+
+def _seconds(code, setup, repeat=7):
+    # the median time to run code after setup, each in a new interpreter
+    timer = ("import time\n%s\nstart = time.perf_counter()\n%s\n"
+             "print(time.perf_counter() - start)")
+    times = [float(subprocess.check_output(
+                 [sys.executable, '-c', timer % (setup, code)]))
+             for _ in range(repeat)]
+    return statistics.median(times)
+
+
+if __name__ == '__main__':
+    _require_qiime2()
+    for name, code in (('package', PACKAGE), ('plugin', PLUGIN)):
+        try:
+            print("%-8s %8.3fs" % (name, _seconds(code, FRAMEWORK)))
+        except subprocess.CalledProcessError:
+            print("%-8s failed" % name)
@@ -0,0 +1,227 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""End-to-end benchmarks of within-dataset and against-dataset.
+
+Tables are synthesized over a grid of sample, feature and environment
+counts, and problems are injected with the same logic as
+support-files/make-problematic-data.py. Each pipeline is run once per grid
+point, and its stage metrics and detection accuracy (as computed by
+support-files/assess-test-run.py) are reported through asv track
+benchmarks, so that both speed and accuracy are recorded per commit.
+
+QIIME 2 and the plugins the pipelines use must be installed; otherwise the
+benchmarks are skipped. The module can also be run directly to print a
+summary of every grid point:
+
+    $ python -m benchmarks.pipelines
+"""
+import importlib.util
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import biom
+
+N_SAMPLES = [120, 300, 1000]
+N_FEATURES = [1000, 5000]
+N_ENVIRONMENTS = [3, 6]
+
+N_JOBS = 2
+SAMPLE_DEPTH = 5000  # counts per synthesized sample, before rarefaction
+
+SUPPORT_FILES = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                             'support-files')
+
+# the stages reported, as the StageRecorder stage names each covers
+STAGE_GROUPS = {
+    'rarefy': ('rarefy', ),
+    'filter': ('filter_features', 'filter_samples', 'merge'),
+    'classifier': ('classify_samples_ncv', 'logistic', 'naive-bayes',
+                   'classify_new_samples', 'fit_classifier',
+                   'predict_classification', 'view_probabilities'),
+    'sourcetracker': ('gibbs', 'mixture', 'view_proportions')}
+
+
+def _support_module(name):
+    # the support files are scripts rather than modules, so load them by
+    # path
+    path = os.path.join(SUPPORT_FILES, '%s.py' % name)
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'),
+                                                  path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _synthetic_dataset(n_samples, n_features, n_environments, prefix='S',
+                       seed=42):
+    # each environment has its own sparse feature profile, and each sample
+    # is a draw from the profile of its environment
+    rng = np.random.default_rng(seed)
+    environments = ['env-%d' % i for i in range(n_environments)]
+    profiles = rng.dirichlet(np.full(n_features, 0.05), n_environments)
+
+    labels = np.arange(n_samples) % n_environments
+    rng.shuffle(labels)
+    counts = np.vstack([rng.multinomial(SAMPLE_DEPTH, profiles[label])
+                        for label in labels]).T
+
+    ids = ['%s%d' % (prefix, i) for i in range(n_samples)]
+    table = biom.Table(counts, ['F%d' % i for i in range(n_features)], ids)
+    md = pd.DataFrame({'env_package': np.array(environments)[labels]},
+                      index=pd.Index(ids, name='#SampleID'))
+    return table.remove_empty(), md
+
+
+def _problematic_dataset(n_samples, n_features, n_environments, prefix='S',
+                         seed=42):
+    table, md = _synthetic_dataset(n_samples, n_features, n_environments,
+                                   prefix=prefix, seed=seed)
+    # only the samples which were altered count towards the contamination
+    # figures
+    inject = _support_module('make-problematic-data').inject_problems
+    return inject(table, md, flag_unchanged=False)
+
+
+def _run(pipeline, n_samples, n_features, n_environments):
+    # run a pipeline once, returning its wall time, stage metrics and the
+    # accuracy of its results
+    import qiime2
+    from qiime2.plugins import mislabeled
+
+    table, md = _problematic_dataset(n_samples, n_features, n_environments)
+    table = qiime2.Artifact.import_data('FeatureTable[Frequency]', table)
+    env = qiime2.Metadata(md[['env_package']]).get_column('env_package')
+
+    start = time.perf_counter()
+    if pipeline == 'within_dataset':
+        result = mislabeled.pipelines.within_dataset(table=table, env=env,
+                                                     n_jobs=N_JOBS)
+    else:
+        # the reference is a clean dataset drawn from the same profiles
+        reference, ref_md = _synthetic_dataset(n_samples, n_features,
+                                               n_environments, prefix='R',
+                                               seed=43)
+        reference = qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                                reference)
+        ref_env = qiime2.Metadata(ref_md).get_column('env_package')
+        result = mislabeled.pipelines.against_dataset(
+            focus=table, reference=reference, focus_env=env,
+            reference_env=ref_env, n_jobs=N_JOBS)
+    wall_time = time.perf_counter() - start
+
+    assess = _support_module('assess-test-run').assess
+    return {'wall_time': wall_time,
+            'n_samples': n_samples,
+            'stages': result.stage_metrics.view(pd.DataFrame),
+            'accuracy': assess(md, result.mislabelings.view(pd.DataFrame))}
+
+
+def _run_grid(pipeline):
+    try:
+        from qiime2.plugins import mislabeled  # noqa
+    except ImportError:
+        raise NotImplementedError("QIIME 2 and q2-mislabeled are not "
+                                  "available")
+
+    return {(n_samples, n_features, n_environments):
+            _run(pipeline, n_samples, n_features, n_environments)
+            for n_samples in N_SAMPLES
+            for n_features in N_FEATURES
+            for n_environments in N_ENVIRONMENTS}
+
+
+def _stage_seconds(run, group):
+    stages = run['stages']
+    return stages.loc[stages['stage'].isin(STAGE_GROUPS[group]),
+                      'wall_time_s'].sum()
+
+
+class _Pipeline:
+    params = (N_SAMPLES, N_FEATURES, N_ENVIRONMENTS)
+    param_names = ['n_samples', 'n_features', 'n_environments']
+    pipeline = None
+
+    # every pipeline is run once for the whole grid, and each track
+    # benchmark reports a different aspect of those runs
+    def setup_cache(self):
+        return _run_grid(self.pipeline)
+
+    setup_cache.timeout = 6 * 60 * 60
+
+    def track_seconds(self, runs, *params):
+        return runs[params]['wall_time']
+
+    track_seconds.unit = 'seconds'
+
+    def track_samples_per_second(self, runs, *params):
+        return runs[params]['n_samples'] / runs[params]['wall_time']
+
+    track_samples_per_second.unit = 'samples/second'
+
+    def track_rarefy_seconds(self, runs, *params):
+        return _stage_seconds(runs[params], 'rarefy')
+
+    track_rarefy_seconds.unit = 'seconds'
+
+    def track_filter_seconds(self, runs, *params):
+        return _stage_seconds(runs[params], 'filter')
+
+    track_filter_seconds.unit = 'seconds'
+
+    def track_classifier_seconds(self, runs, *params):
+        return _stage_seconds(runs[params], 'classifier')
+
+    track_classifier_seconds.unit = 'seconds'
+
+    def track_sourcetracker_seconds(self, runs, *params):
+        return _stage_seconds(runs[params], 'sourcetracker')
+
+    track_sourcetracker_seconds.unit = 'seconds'
+
+    def track_peak_rss(self, runs, *params):
+        return runs[params]['stages']['peak_rss_mb'].max()
+
+    track_peak_rss.unit = 'MB'
+
+    def track_mislabel_recall(self, runs, *params):
+        return runs[params]['accuracy']['mislabel_recall']
+
+    def track_correction_accuracy(self, runs, *params):
+        return runs[params]['accuracy']['correction_accuracy']
+
+    def track_contamination_recall(self, runs, *params):
+        return runs[params]['accuracy']['contamination_recall']
+
+    def track_false_mislabel_rate(self, runs, *params):
+        return runs[params]['accuracy']['false_mislabel_rate']
+
+    def track_false_contamination_rate(self, runs, *params):
+        return runs[params]['accuracy']['false_contamination_rate']
+
+
+class WithinDataset(_Pipeline):
+    pipeline = 'within_dataset'
+
+
+class AgainstDataset(_Pipeline):
+    pipeline = 'against_dataset'
+
+
+if __name__ == '__main__':
+    for pipeline in ('within_dataset', 'against_dataset'):
+        for params, run in _run_grid(pipeline).items():
+            print("%s  samples=%d features=%d environments=%d" %
+                  ((pipeline, ) + params))
+            print("  %.2fs (%.1f samples/s)" %
+                  (run['wall_time'], run['n_samples'] / run['wall_time']))
+            for group in STAGE_GROUPS:
+                print("  %-14s %8.2fs" % (group, _stage_seconds(run, group)))
+            for name, value in run['accuracy'].items():
+                print("  %-25s %.3f" % (name, value))
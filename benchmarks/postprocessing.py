@@ -0,0 +1,85 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Benchmarks for the post-processing of classifier and SourceTracker output.
+
+These are asv benchmarks, but the module can also be run directly to print
+the per-sample cost at each size, which should stay roughly constant if the
+post-processing scales linearly:
+
+    $ python -m benchmarks.postprocessing
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from q2_mislabeled._pipelines import _set_mislabeled, _set_contamination
+
+ENVIRONMENTS = ['human-gut', 'human-oral', 'human-skin']
+
+
+def _synthetic(n_samples, seed=42):
+    rng = np.random.default_rng(seed)
+    ids = pd.Index(['S%d' % i for i in range(n_samples)], name='#SampleID')
+    env_df = pd.DataFrame({'env_package': rng.choice(ENVIRONMENTS,
+                                                     n_samples)},
+                          index=ids)
+
+    # as with rarefaction, a few samples are not represented in the output,
+    # and the sample order does not match the metadata
+    kept = rng.permutation(ids[rng.random(n_samples) > 0.05])
+    probs = rng.dirichlet(np.ones(len(ENVIRONMENTS)), len(kept))
+    prob_df = pd.DataFrame(probs, index=kept, columns=ENVIRONMENTS)
+    return env_df, prob_df
+
+
+class SetMislabeled:
+    params = [1000, 10000, 100000, 400000]
+    param_names = ['n_samples']
+
+    def setup(self, n_samples):
+        self.env_df, self.prob_df = _synthetic(n_samples)
+
+    def time_set_mislabeled(self, n_samples):
+        _set_mislabeled(self.env_df.copy(), self.prob_df, 'env_package',
+                        0.25)
+
+
+class SetContamination:
+    params = [1000, 10000, 100000, 400000]
+    param_names = ['n_samples']
+
+    def setup(self, n_samples):
+        self.env_df, prob_df = _synthetic(n_samples)
+        self.below = _set_mislabeled(self.env_df, prob_df, 'env_package',
+                                     0.25)
+        _, self.proportions_df = _synthetic(n_samples, seed=7)
+
+        # the proportions are only defined for samples which were classified
+        keep = self.proportions_df.index.isin(self.below.index)
+        self.proportions_df = self.proportions_df[keep]
+
+    def time_set_contamination(self, n_samples):
+        _set_contamination(self.env_df.copy(), self.proportions_df,
+                           'env_package', self.below, 0.6)
+
+
+def _report(bench, method):
+    print(type(bench).__name__)
+    for n in bench.params:
+        bench.setup(n)
+        start = time.perf_counter()
+        getattr(bench, method)(n)
+        elapsed = time.perf_counter() - start
+        print("%10d samples  %8.3fs  %8.3fus/sample" %
+              (n, elapsed, 1e6 * elapsed / n))
+
+
+if __name__ == '__main__':
+    _report(SetMislabeled(), 'time_set_mislabeled')
+    _report(SetContamination(), 'time_set_contamination')
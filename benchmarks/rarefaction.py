@@ -0,0 +1,152 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Benchmarks of the in-process rarefaction kernel against feature-table.
+
+The feature-table comparison runs the rarefy action through the Artifact
+API, so it includes the table (de)serialization the pipelines pay for, and
+is skipped when QIIME 2 is not available. The SourceTracker table
+benchmarks compare filtering, rarefying and filtering again as separate
+steps, each writing its table as an action would, against the fused
+in-process stage, by time and by the bytes of the tables written. The
+module can also be run directly:
+
+    $ python -m benchmarks.rarefaction
+"""
+import io
+import time
+
+import h5py
+import numpy as np
+import scipy.sparse as ss
+import biom
+
+from q2_mislabeled._rarefy import rarefy, rarefy_filter
+
+SAMPLING_DEPTH = 1000
+
+# the HMP SOP drops features present in fewer than 1% of the samples
+PREVALENCE = 0.01
+
+
+def _synthetic_table(n_samples, n_features=5000, nnz_per_sample=150,
+                     seed=42):
+    rng = np.random.default_rng(seed)
+    nnz = n_samples * nnz_per_sample
+    rows = rng.integers(0, n_features, nnz)
+    cols = np.repeat(np.arange(n_samples), nnz_per_sample)
+    data = rng.geometric(0.05, nnz).astype(float)
+    matrix = ss.coo_matrix((data, (rows, cols)),
+                           shape=(n_features, n_samples)).tocsr()
+    return biom.Table(matrix,
+                      ['F%d' % i for i in range(n_features)],
+                      ['S%d' % i for i in range(n_samples)])
+
+
+class InProcess:
+    params = ([10000, 100000], [1, 4])
+    param_names = ['n_samples', 'n_jobs']
+    timeout = 600
+
+    def setup(self, n_samples, n_jobs):
+        self.table = _synthetic_table(n_samples)
+
+    def time_rarefy(self, n_samples, n_jobs):
+        rarefy(self.table, SAMPLING_DEPTH, n_jobs=n_jobs, random_state=42)
+
+
+class FeatureTableAction:
+    params = [10000, 100000]
+    param_names = ['n_samples']
+    timeout = 600
+
+    def setup(self, n_samples):
+        try:
+            import qiime2
+            from qiime2.plugins import feature_table
+        except ImportError:
+            raise NotImplementedError("QIIME 2 is not available")
+        self.rarefy = feature_table.actions.rarefy
+        self.table = qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                                 _synthetic_table(n_samples))
+
+    def time_rarefy(self, n_samples):
+        rarefied, = self.rarefy(self.table, sampling_depth=SAMPLING_DEPTH)
+        rarefied.view(biom.Table)
+
+
+def _hdf5_bytes(table):
+    # the size of a table as written to an artifact
+    buffer = io.BytesIO()
+    with h5py.File(buffer, 'w') as fh:
+        table.to_hdf5(fh, generated_by='benchmark')
+    return buffer.getbuffer().nbytes
+
+
+def _prevalent(table, min_samples):
+    return table.filter(lambda v, i, m: (v > 0).sum() >= min_samples,
+                        axis='observation', inplace=False)
+
+
+def _separate(table, min_samples):
+    # the SourceTracker table as three actions, each writing its table, and
+    # the bytes written
+    written = 0
+    for step in (lambda t: _prevalent(t, min_samples),
+                 lambda t: rarefy(t, SAMPLING_DEPTH, random_state=42),
+                 lambda t: _prevalent(t, min_samples)):
+        table = step(table)
+        written += _hdf5_bytes(table)
+    return table, written
+
+
+def _fused(table, min_samples):
+    table = rarefy_filter(table, SAMPLING_DEPTH, min_samples,
+                          random_state=42)
+    return table, _hdf5_bytes(table)
+
+
+class SourceTrackerTable:
+    params = ([10000, 100000], ['separate', 'fused'])
+    param_names = ['n_samples', 'stage']
+    timeout = 600
+
+    def setup(self, n_samples, stage):
+        self.table = _synthetic_table(n_samples)
+        self.min_samples = int(n_samples * PREVALENCE)
+        self.stage = _separate if stage == 'separate' else _fused
+
+    def time_prepare(self, n_samples, stage):
+        self.stage(self.table, self.min_samples)
+
+    def track_bytes_written(self, n_samples, stage):
+        return self.stage(self.table, self.min_samples)[1]
+
+    track_bytes_written.unit = 'bytes'
+
+
+if __name__ == '__main__':
+    for n_samples in InProcess.params[0]:
+        table = _synthetic_table(n_samples)
+        for n_jobs in InProcess.params[1]:
+            start = time.perf_counter()
+            rarefy(table, SAMPLING_DEPTH, n_jobs=n_jobs, random_state=42)
+            print("in-process     %7d samples  n_jobs=%d  %8.2fs" %
+                  (n_samples, n_jobs, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        table.subsample(SAMPLING_DEPTH)
+        print("biom.subsample %7d samples            %8.2fs" %
+              (n_samples, time.perf_counter() - start))
+
+        min_samples = int(n_samples * PREVALENCE)
+        for name, stage in (('separate', _separate), ('fused', _fused)):
+            start = time.perf_counter()
+            _, written = stage(table, min_samples)
+            print("%-14s %7d samples  %8.1f MB  %8.2fs" %
+                  (name, n_samples, written / 1e6,
+                   time.perf_counter() - start))
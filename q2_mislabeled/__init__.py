@@ -6,8 +6,39 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from ._pipelines import within_dataset, against_dataset
-from . import _version
-__version__ = _version.get_versions()['version']
+import importlib
 
-__all__ = ['within_dataset', 'against_dataset']
+# the module providing each of the actions. the modules, and the version,
+# are only loaded once they are first used, so that importing the package is
+# cheap
+_ACTIONS = {'within_dataset': '_pipelines',
+            'within_dataset_columns': '_pipelines',
+            'against_dataset': '_pipelines',
+            'prepare_reference': '_pipelines',
+            'against_prepared_reference': '_pipelines',
+            'against_dataset_batch': '_pipelines',
+            'rescore': '_rescore',
+            'rescore_grid': '_rescore'}
+
+__all__ = ['within_dataset', 'within_dataset_columns', 'against_dataset',
+           'prepare_reference', 'against_prepared_reference',
+           'against_dataset_batch', 'rescore', 'rescore_grid']
+
+
+def __getattr__(name):
+    if name == '__version__':
+        from . import _version
+        value = _version.get_versions()['version']
+    elif name in _ACTIONS:
+        module = importlib.import_module('.' + _ACTIONS[name], __name__)
+        value = getattr(module, name)
+    else:
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_ACTIONS) | {'__version__'})
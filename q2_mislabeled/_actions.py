@@ -0,0 +1,96 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""The functions the plugin registers for its actions.
+
+Each has the signature of the action it runs, and only imports the module
+implementing it when called, so that loading the plugin does not import the
+pipelines and their dependencies.
+"""
+import importlib
+from typing import Dict
+
+import pandas as pd
+import qiime2
+
+
+def _call(module, name, kwargs):
+    module = importlib.import_module('.' + module, __package__)
+    return getattr(module, name)(**kwargs)
+
+
+def within_dataset(ctx, table, env, alleged_min_probability=0.25,
+                   env_min_proportion=0.6, n_jobs=1, sampling_depth=1000,
+                   preprocessing='hmp', rarefaction_engine='feature-table',
+                   contamination_engine='gibbs',
+                   classifier_engine='random-forest', random_state=None,
+                   previous_probabilities=None, previous_proportions=None,
+                   refresh_fraction=0.1, checkpoint_dir=None,
+                   n_rarefactions=1, loo_shards=1, work_dir=None,
+                   shard_lease=600.0):
+    return _call('_pipelines', 'within_dataset', locals())
+
+
+def within_dataset_columns(ctx, table, metadata, columns,
+                           alleged_min_probability=0.25,
+                           env_min_proportion=0.6, n_jobs=1,
+                           sampling_depth=1000, preprocessing='hmp',
+                           rarefaction_engine='feature-table',
+                           contamination_engine='gibbs',
+                           classifier_engine='random-forest',
+                           random_state=None, checkpoint_dir=None):
+    return _call('_pipelines', 'within_dataset_columns', locals())
+
+
+def against_dataset(ctx, focus, reference, focus_env, reference_env,
+                    alleged_min_probability=0.25, env_min_proportion=0.6,
+                    n_jobs=1, sampling_depth=1000, preprocessing='hmp',
+                    rarefaction_engine='feature-table',
+                    contamination_engine='gibbs', random_state=None,
+                    chunk_size=None, checkpoint_dir=None,
+                    focus_features='merge'):
+    return _call('_pipelines', 'against_dataset', locals())
+
+
+def prepare_reference(ctx, reference, reference_env, n_jobs=1,
+                      sampling_depth=1000, preprocessing='hmp',
+                      rarefaction_engine='feature-table', random_state=None):
+    return _call('_pipelines', 'prepare_reference', locals())
+
+
+def against_prepared_reference(ctx, focus, reference, focus_env,
+                               alleged_min_probability=0.25,
+                               env_min_proportion=0.6, n_jobs=1,
+                               rarefaction_engine='feature-table',
+                               contamination_engine='gibbs',
+                               random_state=None, chunk_size=None,
+                               focus_features='merge'):
+    return _call('_pipelines', 'against_prepared_reference', locals())
+
+
+def against_dataset_batch(ctx, focus, reference, focus_env, reference_env,
+                          alleged_min_probability=0.25,
+                          env_min_proportion=0.6, n_jobs=1,
+                          sampling_depth=1000, preprocessing='hmp',
+                          rarefaction_engine='feature-table',
+                          contamination_engine='gibbs', random_state=None,
+                          chunk_size=None, focus_features='merge'):
+    return _call('_pipelines', 'against_dataset_batch', locals())
+
+
+def rescore(probabilities: pd.DataFrame, proportions: pd.DataFrame,
+            env: qiime2.CategoricalMetadataColumn,
+            alleged_min_probability: float = 0.25,
+            env_min_proportion: float = 0.6) -> pd.DataFrame:
+    return _call('_rescore', 'rescore', locals())
+
+
+def rescore_grid(probabilities: pd.DataFrame, proportions: pd.DataFrame,
+                 env: qiime2.CategoricalMetadataColumn,
+                 alleged_min_probabilities: list,
+                 env_min_proportions: list) -> Dict[str, pd.DataFrame]:
+    return _call('_rescore', 'rescore_grid', locals())
@@ -0,0 +1,128 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import qiime2
+
+MANIFEST = 'manifest.json'
+
+# the arguments which only set how many processes a stage uses. every stage
+# gives the same outputs for any of them, or is random without a seed, so
+# they are not keyed, and a run resumed with fewer jobs (say, after running
+# out of memory) loads the stages which completed
+UNKEYED = ('n_jobs', 'jobs')
+
+
+class Checkpoint:
+    """Persist the artifacts produced by the stages of a pipeline
+
+    Each call of a stage is keyed by its name, its arguments and a context
+    common to every stage (such as the plugin version, and the configuration
+    of the engines the stages close over), and its outputs are saved to a
+    directory of that key once it completes. A call with a saved key loads
+    its outputs rather than running again, so that a failed pipeline
+    resumes at the first stage which did not complete.
+
+    Artifacts which are inputs of the pipeline are identified by their
+    UUID. The artifacts a stage produces have new UUIDs every run, so they
+    are instead identified by the key of the call which produced them.
+
+    A stage may be random without taking a seed (such as rarefying with
+    q2-feature-table), so repeating a call within a run is not assumed to
+    give the same outputs. Each repeat is keyed by how many times the call
+    was made before it.
+    """
+    def __init__(self, directory, context):
+        self.directory = directory
+        self.context = context
+        self.keys = {}
+        self.repeats = collections.Counter()
+        os.makedirs(directory, exist_ok=True)
+
+    def wrap(self, name, action):
+        """Checkpoint every call of action as a stage called name"""
+        def wrapped(*args, **kwargs):
+            return self.call(name, action, *args, **kwargs)
+        return wrapped
+
+    def call(self, name, action, *args, **kwargs):
+        """Call action with args and kwargs, or load its saved outputs"""
+        key = self.key(name, args, kwargs)
+        self.repeats[key] += 1
+        if self.repeats[key] > 1:
+            key = _hash([key, self.repeats[key]])
+        path = os.path.join(self.directory, key)
+        if os.path.exists(os.path.join(path, MANIFEST)):
+            result = _load(path)
+        else:
+            result = action(*args, **kwargs)
+            self._save(path, result)
+
+        outputs = result if isinstance(result, tuple) else (result, )
+        for i, output in enumerate(outputs):
+            if output is not None:
+                self.keys[str(output.uuid)] = '%s/%d' % (key, i)
+        return result
+
+    def key(self, name, args, kwargs):
+        """The key of a call of the stage called name"""
+        description = [name, self.context,
+                       [self._token(arg) for arg in args],
+                       {k: self._token(v) for k, v in sorted(kwargs.items())
+                        if k not in UNKEYED}]
+        return _hash(description)
+
+    def _token(self, value):
+        if isinstance(value, qiime2.Artifact):
+            uuid = str(value.uuid)
+            return self.keys.get(uuid, uuid)
+        if isinstance(value, (qiime2.Metadata, qiime2.MetadataColumn)):
+            contents = value.to_dataframe().to_csv()
+            return hashlib.sha256(contents.encode()).hexdigest()
+        if isinstance(value, (list, tuple)):
+            return [self._token(v) for v in value]
+        return repr(value)
+
+    def _save(self, path, result):
+        # the outputs are saved to a temporary directory which is then
+        # renamed, so that a stage interrupted while saving is run again
+        outputs = result if isinstance(result, tuple) else (result, )
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        names = []
+        for i, output in enumerate(outputs):
+            names.append(None if output is None else
+                         os.path.basename(output.save(
+                             os.path.join(tmp, '%d.qza' % i))))
+        with open(os.path.join(tmp, MANIFEST), 'w') as fh:
+            json.dump({'outputs': names,
+                       'tuple': isinstance(result, tuple)}, fh)
+
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another run saved the same stage first
+            shutil.rmtree(tmp)
+
+
+def _hash(description):
+    return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+
+def _load(path):
+    with open(os.path.join(path, MANIFEST)) as fh:
+        manifest = json.load(fh)
+    outputs = tuple(None if name is None else
+                    qiime2.Artifact.load(os.path.join(path, name))
+                    for name in manifest['outputs'])
+    return outputs if manifest['tuple'] else outputs[0]
@@ -0,0 +1,220 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as ss
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+from sklearn.naive_bayes import MultinomialNB
+
+# as with classify_samples_ncv
+N_FOLDS = 5
+
+# the pseudocount added to every feature of every class, as with the
+# scikit-learn MultinomialNB default
+NB_ALPHA = 1.0
+
+
+def out_of_fold_probabilities(table, labels, n_folds=N_FOLDS, n_jobs=1,
+                              random_state=None):
+    """Estimate class probabilities for each sample from the folds it is not
+    trained on
+
+    The model is an L2 regularized multinomial logistic regression on the
+    square root of the relative abundances (the Hellinger transform), which
+    keeps the table sparse.
+
+    Parameters
+    ----------
+    table : biom.Table
+        The samples to classify.
+    labels : pd.Series
+        The class of each sample. Samples in the table without a class are
+        ignored.
+    n_folds : int, optional
+        The number of stratified cross-validation folds.
+    n_jobs : int, optional
+        The number of worker processes to train the folds in.
+    random_state : int, optional
+        The seed used to assign samples to folds.
+
+    Returns
+    -------
+    pd.DataFrame
+        The probability of each class, as columns, for each sample.
+    """
+    labels = labels.reindex(table.ids()).dropna()
+    table = table.filter(labels.index, inplace=False)
+    X = _hellinger(table.matrix_data.T.tocsr())
+    y = labels.to_numpy()
+    classes = np.unique(y)
+
+    tasks = [(X, y, train, test) for train, test in StratifiedKFold(
+        n_folds, shuffle=True, random_state=random_state).split(X, y)]
+    if n_jobs == 1:
+        # the objective is strictly convex, so each fold converges to the
+        # same model, up to the solver tolerance, from any start. run one
+        # after the other, each fold starts from the model of the previous
+        # one, which is close to it
+        results, start = [], None
+        for task in tasks:
+            # a fold missing a class has a differently shaped model
+            complete = len(np.unique(y[task[2]])) == len(classes)
+            results.append(_fit_fold(*task, start if complete else None))
+            if complete:
+                start = results[-1][2]
+    else:
+        # in parallel, the folds have no previous model to start from
+        with ProcessPoolExecutor(max_workers=min(n_jobs, n_folds)) as pool:
+            results = list(pool.map(_fit_fold, *zip(*tasks)))
+
+    probabilities = np.zeros((len(y), len(classes)))
+    for (_, _, _, test), (fold_classes, fold_probabilities, _) in \
+            zip(tasks, results):
+        # a class absent from a training fold cannot be predicted by it
+        columns = np.searchsorted(classes, fold_classes)
+        probabilities[np.ix_(test, columns)] = fold_probabilities
+
+    return pd.DataFrame(probabilities, index=labels.index, columns=classes)
+
+
+def leave_one_out_probabilities(table, labels, alpha=NB_ALPHA):
+    """Estimate class probabilities for each sample from all of the others
+
+    The model is a multinomial naive Bayes model of the counts. Leaving a
+    sample out only changes the feature totals and size of its own class,
+    so every sample is scored exactly, and at once, by subtracting its
+    counts from those of its class.
+
+    Parameters
+    ----------
+    table : biom.Table
+        The samples to classify.
+    labels : pd.Series
+        The class of each sample. Samples in the table without a class are
+        ignored.
+    alpha : float, optional
+        The pseudocount added to every feature of every class.
+
+    Returns
+    -------
+    pd.DataFrame
+        The probability of each class, as columns, for each sample.
+    """
+    labels = labels.reindex(table.ids()).dropna()
+    table = table.filter(labels.index, inplace=False)
+    X = table.matrix_data.T.tocsr().astype(float)
+    codes, classes = pd.factorize(labels, sort=True)
+    n_samples, n_features = X.shape
+
+    # the feature totals of each class, features by classes
+    indicator = ss.csr_matrix((np.ones(n_samples),
+                               (np.arange(n_samples), codes)),
+                              shape=(n_samples, len(classes)))
+    pooled = np.asarray((X.T @ indicator).todense())
+    pooled_totals = pooled.sum(axis=0)
+    class_sizes = np.bincount(codes, minlength=len(classes))
+
+    # the log likelihood of each sample under every class, with every
+    # sample included
+    log_profiles = np.log(pooled + alpha) - \
+        np.log(pooled_totals + alpha * n_features)
+    log_likelihood = np.asarray(X @ log_profiles)
+    log_prior = np.broadcast_to(np.log(class_sizes), log_likelihood.shape)
+    log_prior = log_prior - np.log(n_samples - 1)
+
+    # leaving a sample out only changes the profile of its own class at the
+    # features of the sample, and the size of that class
+    rows = np.repeat(np.arange(n_samples), np.diff(X.indptr))
+    own = codes[rows]
+    counts = X.data
+    pooled_own = pooled[X.indices, own]
+    totals = np.asarray(X.sum(axis=1)).ravel()
+    delta = np.bincount(rows, minlength=n_samples,
+                        weights=counts * (np.log(pooled_own - counts + alpha) -
+                                          np.log(pooled_own + alpha)))
+    delta -= totals * (np.log(pooled_totals[codes] - totals +
+                              alpha * n_features) -
+                       np.log(pooled_totals[codes] + alpha * n_features))
+    log_likelihood[np.arange(n_samples), codes] += delta
+
+    # the only sample of a class cannot be assigned to it
+    with np.errstate(divide='ignore'):
+        log_prior[np.arange(n_samples), codes] = \
+            np.log(class_sizes[codes] - 1) - np.log(n_samples - 1)
+
+    log_posterior = log_likelihood + log_prior
+    log_posterior -= log_posterior.max(axis=1, keepdims=True)
+    probabilities = np.exp(log_posterior)
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    return pd.DataFrame(probabilities, index=labels.index, columns=classes)
+
+
+def heldout_probabilities(table, labels, new, engine='logistic'):
+    """Estimate class probabilities for new samples from a model of the
+    others
+
+    Parameters
+    ----------
+    table : biom.Table
+        The samples to train on and to classify.
+    labels : pd.Series
+        The class of each sample to train on. Samples in the table without a
+        class, and those in new, are not trained on.
+    new : list of str
+        The samples to classify. Those not in the table (such as samples
+        removed by rarefaction) are not classified.
+    engine : {'logistic', 'naive-bayes'}, optional
+        The model, as with out_of_fold_probabilities and
+        leave_one_out_probabilities respectively.
+
+    Returns
+    -------
+    pd.DataFrame
+        The probability of each class, as columns, for each new sample.
+    """
+    ids = pd.Index(table.ids())
+    new = pd.Index(new)
+    new = new[new.isin(ids)]
+    labels = labels.reindex(ids).dropna()
+    labels = labels[~labels.index.isin(new)]
+    X = table.matrix_data.T.tocsr()
+    train = ids.get_indexer(labels.index)
+    test = ids.get_indexer(new)
+    if engine == 'logistic':
+        X = _hellinger(X)
+        model = _model()
+    else:
+        model = MultinomialNB(alpha=NB_ALPHA)
+
+    model.fit(X[train], labels.to_numpy())
+    return pd.DataFrame(model.predict_proba(X[test]), index=new,
+                        columns=model.classes_)
+
+
+def _model():
+    return LogisticRegression(C=1.0, max_iter=1000)
+
+
+def _hellinger(matrix):
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    matrix = matrix.multiply(1 / np.where(totals > 0, totals, 1)[:, None])
+    return matrix.tocsr().sqrt()
+
+
+def _fit_fold(X, y, train, test, start=None):
+    model = _model()
+    if start is not None:
+        model.set_params(warm_start=True)
+        model.coef_, model.intercept_ = (a.copy() for a in start)
+    model.fit(X[train], y[train])
+    return (model.classes_, model.predict_proba(X[test]),
+            (model.coef_, model.intercept_))
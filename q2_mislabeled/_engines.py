@@ -0,0 +1,40 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""The choices of the pipeline parameters.
+
+These are imported by plugin_setup when QIIME 2 loads the plugin, so this
+module must not import anything.
+"""
+
+# hmp: prepare the classifier and SourceTracker tables separately, as in the
+#      SOP
+# shared: prepare the classifier table once, and reuse it for SourceTracker
+PREPROCESSING = ('hmp', 'shared')
+
+# feature-table: rarefy with the q2-feature-table action
+# in-process: rarefy with the sparse kernel in _rarefy, sharded over n_jobs
+RAREFACTION_ENGINES = ('feature-table', 'in-process')
+
+# gibbs: estimate source proportions with the SourceTracker2 gibbs action
+# mixture: estimate them in process with the mixture model in _mixture
+CONTAMINATION_ENGINES = ('gibbs', 'mixture')
+
+# random-forest: classify with the q2-sample-classifier classify_samples_ncv
+#                action
+# logistic: classify in process with the logistic regression in _classifier
+# naive-bayes: classify every sample against all of the others at once with
+#              the naive Bayes model in _classifier
+CLASSIFIER_ENGINES = ('random-forest', 'logistic', 'naive-bayes')
+
+# merge: source track the focus samples on the union of the focus and reference
+#        features, merged with the q2-feature-table action
+# drop: project the focus samples onto the reference features, dropping the
+#       features only the focus has
+# pool: project them onto the reference features, pooling the features only
+#       the focus has into one unassigned feature
+FOCUS_FEATURES = ('merge', 'drop', 'pool')
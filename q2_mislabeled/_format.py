@@ -6,7 +6,11 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import json
+import tarfile
+
 import qiime2.plugin.model as model
+from q2_types.feature_table import BIOMV210Format
 
 
 class TSVFormat(model.TextFileFormat):
@@ -26,3 +30,75 @@ class TSVFormat(model.TextFileFormat):
 
 TSVDirectoryFormat = model.SingleFileDirectoryFormat(
     'TSVDirectoryFormat', 'mislabeled.tsv', TSVFormat)
+
+
+class StageMetricsFormat(model.TextFileFormat):
+    HEADER = ['id', 'stage', 'wall_time_s', 'cpu_time_s', 'peak_rss_mb']
+
+    def sniff(self):
+        with self.open() as fh:
+            header = fh.readline().strip().split('\t')
+            return header[:len(self.HEADER)] == self.HEADER
+
+
+StageMetricsDirectoryFormat = model.SingleFileDirectoryFormat(
+    'StageMetricsDirectoryFormat', 'stage-metrics.tsv', StageMetricsFormat)
+
+
+class OpenMetricsFormat(model.TextFileFormat):
+    def sniff(self):
+        with self.open() as fh:
+            return fh.readline().startswith('# ')
+
+
+class JSONFormat(model.TextFileFormat):
+    def sniff(self):
+        with self.open() as fh:
+            try:
+                json.load(fh)
+                return True
+            except json.JSONDecodeError:
+                return False
+
+
+class EstimatorArchiveFormat(model.BinaryFileFormat):
+    def sniff(self):
+        return tarfile.is_tarfile(str(self))
+
+
+class NpyFormat(model.BinaryFileFormat):
+    def sniff(self):
+        with self.open() as fh:
+            return fh.read(6) == b'\x93NUMPY'
+
+
+class ReferenceBundleDirectoryFormat(model.DirectoryFormat):
+    # the reference tables prepared for each stage, and the per-environment
+    # summed source counts derived from the SourceTracker table
+    classifier_table = model.File('classifier_table.biom',
+                                  format=BIOMV210Format)
+    sourcetracker_table = model.File('sourcetracker_table.biom',
+                                     format=BIOMV210Format)
+    source_counts = model.File('source_counts.biom', format=BIOMV210Format)
+
+    # the source samples of the SourceTracker table and their environments,
+    # laid out by write_mapped, which the mixture engine maps
+    mapped_data = model.File('sourcetracker_mapped/data.npy',
+                             format=NpyFormat)
+    mapped_indices = model.File('sourcetracker_mapped/indices.npy',
+                                format=NpyFormat)
+    mapped_indptr = model.File('sourcetracker_mapped/indptr.npy',
+                               format=NpyFormat)
+    mapped_feature_ids = model.File('sourcetracker_mapped/feature_ids.npy',
+                                    format=NpyFormat)
+    mapped_sample_ids = model.File('sourcetracker_mapped/sample_ids.npy',
+                                   format=NpyFormat)
+    mapped_env = model.File('sourcetracker_mapped/env.npy', format=NpyFormat)
+
+    # the fitted estimator, laid out as q2-sample-classifier stores it
+    sklearn_pipeline = model.File('sklearn_pipeline.tar',
+                                  format=EstimatorArchiveFormat)
+    sklearn_version = model.File('sklearn_version.json', format=JSONFormat)
+
+    # the parameters the reference was prepared with
+    parameters = model.File('parameters.json', format=JSONFormat)
@@ -0,0 +1,229 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as ss
+
+# the pseudocount added to every feature of every source profile, as with
+# the SourceTracker2 alpha1 prior
+ALPHA = 0.001
+
+UNKNOWN = 'Unknown'
+
+
+def mixture_proportions(sources, env, sinks=None, max_iter=500, tol=1e-5,
+                        loo_ids=None):
+    """Estimate the source proportions of sinks as a mixture of environments
+
+    Each environment is summarized by the pooled feature profile of its
+    source samples, and an unknown source by a uniform profile over the
+    features none of the sources have. The mixing
+    proportions of every sink are fit by expectation maximization, with
+    all sinks updated together in one sparse computation per iteration.
+    Each sink is fit as it would be alone, so sinks can be assessed in
+    chunks.
+
+    Parameters
+    ----------
+    sources : biom.Table or MappedTable
+        The source samples.
+    env : pd.Series
+        The environment of each source sample. Samples in sources without an
+        environment are ignored.
+    sinks : biom.Table, optional
+        The sink samples. If not provided, each source sample is assessed
+        against the others, leaving it out of the profile of its own
+        environment.
+    max_iter : int, optional
+        The maximum number of iterations, each of three EM steps.
+    tol : float, optional
+        Iteration stops once no proportion changes by more than tol.
+    loo_ids : list of str, optional
+        Without sinks, the source samples to assess against the others. Each
+        is assessed exactly as it would be with all of them, so the source
+        samples can be assessed in shards. By default, all of them are.
+
+    Returns
+    -------
+    pd.DataFrame
+        The proportion of each sink attributed to each environment, and to
+        the unknown source, with sinks as rows.
+    """
+    env = env.reindex(sources.ids()).dropna()
+    if len(env) < len(sources.ids()):
+        sources = sources.filter(env.index, inplace=False)
+    codes, environments = pd.factorize(env, sort=True)
+
+    # the pooled counts of each environment, features by environments. these
+    # are computed once, and everything else is an update of them
+    src = sources.matrix_data.tocsr()
+    indicator = ss.csr_matrix((np.ones(len(codes)),
+                               (np.arange(len(codes)), codes)),
+                              shape=(len(codes), len(environments)))
+    pooled = np.asarray((src @ indicator).todense())
+
+    if sinks is None:
+        positions = np.arange(len(codes))
+        if loo_ids is not None:
+            positions = pd.Index(sources.ids()).get_indexer(loo_ids)
+            if (positions < 0).any():
+                raise KeyError("Samples to leave out are not sources with "
+                               "an environment: %s"
+                               % sorted(np.asarray(loo_ids)[positions < 0]))
+        sink_ids = sources.ids()[positions]
+        sink_codes = codes[positions]
+        matrix = src[:, positions].tocsc()
+        features = matrix.indices
+    else:
+        sink_ids = sinks.ids()
+        matrix = sinks.matrix_data.tocsc()
+        positions = pd.Index(sources.ids(axis='observation')).get_indexer(
+            sinks.ids(axis='observation'))
+        features = positions[matrix.indices]
+
+    # the feature space is that of the sources, so that the proportions of
+    # a sink do not depend on the other sinks it is assessed with. features
+    # of a sink which no source has all share one row of zeros
+    n_features = len(pooled)
+    unshared = features < 0
+    if unshared.any():
+        features = np.where(unshared, n_features, features)
+        pooled = np.vstack([pooled, np.zeros((1, len(environments)))])
+    pooled_totals = pooled.sum(axis=0)
+    profiles = (pooled + ALPHA) / (pooled_totals + ALPHA * n_features)
+
+    # only the observed features of a sink contribute to its likelihood, so
+    # the sinks are described by their nonzero entries
+    counts = matrix.data.astype(float)
+    rows = np.repeat(np.arange(len(sink_ids), dtype=np.int32),
+                     np.diff(matrix.indptr))
+    totals = np.bincount(rows, weights=counts, minlength=len(sink_ids))
+
+    # the unknown source is spread over the features that no source has:
+    # those of the sources without counts, and those only the sink has
+    in_sources = pooled.sum(axis=1)[features]
+    n_novel = np.full(len(sink_ids), n_features -
+                      np.count_nonzero(pooled[:n_features].sum(axis=1)))
+    n_novel += np.bincount(rows, weights=unshared,
+                           minlength=len(sink_ids)).astype(int)
+
+    own = own_delta = None
+    if sinks is None:
+        # leave each sample out of the profile of its own environment by
+        # subtracting its counts from the pooled counts. the profile only
+        # changes at the features of the sample, so it is kept as the
+        # difference from the pooled profile at those features
+        own = sink_codes.astype(np.int32)[rows]
+        own_delta = ((pooled[features, own] - counts + ALPHA) /
+                     (pooled_totals[own] - totals[rows] +
+                      ALPHA * n_features)) - profiles[features, own]
+
+        # features only the sample has are novel once it is left out
+        in_sources = in_sources - counts
+        n_novel += np.bincount(rows, weights=in_sources == 0,
+                               minlength=len(sink_ids)).astype(int)
+
+    unknown = (((in_sources == 0) + ALPHA) /
+               (n_novel[rows] + ALPHA * n_features))
+
+    proportions = _fit(profiles, features, counts, rows, totals, unknown,
+                       own, own_delta, max_iter, tol)
+    return pd.DataFrame(proportions, index=pd.Index(sink_ids),
+                        columns=list(environments) + [UNKNOWN])
+
+
+def _fit(profiles, features, counts, rows, totals, unknown, own, own_delta,
+         max_iter, tol):
+    # expectation maximization of the mixing proportions of every sink at
+    # once. the sinks are described by their nonzero entries, with the
+    # feature, count, sink, unknown source profile, and with leave one out,
+    # the environment of the sink and its change to that profile, of each.
+    # sinks are retired from the computation as they converge, as most
+    # converge long before the slowest
+    n_environments = profiles.shape[1]
+    fitted = np.full((len(totals), n_environments + 1),
+                     1 / (n_environments + 1))
+    active = np.flatnonzero(totals > 0)
+    entries = [features, counts, rows, unknown, own, own_delta]
+
+    def compact(keep, entries):
+        # restrict the entries to the sinks kept, renumbering the sinks
+        kept = keep[entries[2]]
+        entries = [None if e is None else e[kept] for e in entries]
+        entries[2] = (np.cumsum(keep) - 1)[entries[2]]
+        return entries
+
+    entries = compact(totals > 0, entries)
+    proportions = fitted[active]
+    scale = totals[active][:, None]
+    by_profile = np.ascontiguousarray(profiles.T)
+
+    def step(proportions, entries):
+        features, counts, rows, unknown, own, own_delta = entries
+        n_sinks = len(proportions)
+
+        # the E step, as the mixed profile at each entry. the entries of a
+        # sink are contiguous, so its proportions are repeated rather than
+        # gathered
+        lengths = np.bincount(rows, minlength=n_sinks)
+        indptr = np.r_[0, np.cumsum(lengths)]
+        by_source = proportions.T
+        mixed = unknown * np.repeat(by_source[-1], lengths)
+        for k in range(n_environments):
+            mixed += (by_profile[k].take(features) *
+                      np.repeat(by_source[k], lengths))
+        if own is not None:
+            mixed += own_delta * np.repeat(
+                proportions[np.arange(n_sinks), own[indptr[:-1]]], lengths)
+
+        # the M step, as the expected share of each source in each sink
+        weights = counts / mixed
+        shares = np.empty_like(proportions)
+        shares[:, :-1] = ss.csr_matrix((weights, features, indptr),
+                                       shape=(n_sinks, len(profiles))) \
+            @ profiles
+        shares[:, -1] = np.bincount(rows, weights=weights * unknown,
+                                    minlength=n_sinks)
+        if own is not None:
+            shares[np.arange(n_sinks), own[indptr[:-1]]] += np.bincount(
+                rows, weights=weights * own_delta, minlength=n_sinks)
+        return proportions * shares / scale
+
+    for iteration in range(max_iter):
+        # each iteration is a SQUAREM extrapolation of two EM steps, which
+        # is then stabilized with a third
+        first = step(proportions, entries)
+        second = step(first, entries)
+        r = first - proportions
+        v = second - first - r
+        alpha = -np.sqrt((r ** 2).sum(axis=1) /
+                         np.maximum((v ** 2).sum(axis=1), 1e-300))
+        alpha = np.minimum(alpha, -1)[:, None]
+        extrapolated = proportions - 2 * alpha * r + alpha ** 2 * v
+        # keep every source recoverable, as EM cannot move away from zero
+        extrapolated = np.maximum(extrapolated, 1e-10)
+        extrapolated /= extrapolated.sum(axis=1, keepdims=True)
+        updated = step(extrapolated, entries)
+
+        converged = np.abs(updated - proportions).max(axis=1) <= tol
+        proportions = updated
+        if converged.all() or iteration == max_iter - 1:
+            break
+
+        # compacting costs about as much as a step, so only do so once
+        # enough sinks have converged
+        if converged.mean() > 0.1:
+            fitted[active[converged]] = proportions[converged]
+            entries = compact(~converged, entries)
+            active = active[~converged]
+            proportions = proportions[~converged]
+            scale = scale[~converged]
+
+    fitted[active] = proportions
+    return fitted
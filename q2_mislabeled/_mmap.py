@@ -0,0 +1,109 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""Tables written as uncompressed arrays, which can be memory-mapped.
+
+The workers of sharded source tracking with the mixture engine map the
+source samples from the work directory read-only, rather than each loading
+its own copy, so the workers of a machine share its pages. Prepared
+reference bundles hold their source samples in the same layout.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as ss
+import biom
+
+# the arrays of the feature-major CSR matrix, as biom.Table holds it
+MATRIX = ('data', 'indices', 'indptr')
+FEATURE_IDS = 'feature_ids'
+SAMPLE_IDS = 'sample_ids'
+ENV = 'env'
+
+
+def write_mapped(table, directory, env=None):
+    """Write a table as uncompressed arrays which can be memory-mapped
+
+    The CSR matrix of the table is written as one .npy file per array, and
+    the ids as fixed-width strings, which numpy maps without unpickling.
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table to write.
+    directory : str
+        The directory to write the arrays to, which is created if needed.
+    env : pd.Series, optional
+        The environment of each sample of the table, written with it.
+    """
+    os.makedirs(directory, exist_ok=True)
+    matrix = table.matrix_data.tocsr()
+    for name in MATRIX:
+        np.save(os.path.join(directory, name + '.npy'), getattr(matrix, name))
+    for name, axis in ((FEATURE_IDS, 'observation'), (SAMPLE_IDS, 'sample')):
+        np.save(os.path.join(directory, name + '.npy'),
+                np.asarray(table.ids(axis=axis), dtype=str))
+    if env is not None:
+        np.save(os.path.join(directory, ENV + '.npy'),
+                np.asarray(env.loc[table.ids()], dtype=str))
+
+
+class MappedTable:
+    """A table written by write_mapped, memory-mapped read-only
+
+    The arrays are not read until they are used, and then only the pages
+    used are, which the operating system shares between every process
+    mapping the same files. Building a biom.Table copies its matrix, so
+    this instead offers the read-only part of the biom.Table interface the
+    in-process engines use.
+
+    Parameters
+    ----------
+    directory : str
+        The directory the table was written to.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _load(self, name):
+        return np.load(os.path.join(self.directory, name + '.npy'),
+                       mmap_mode='r')
+
+    @property
+    def shape(self):
+        """The number of features and samples, as biom.Table.shape"""
+        return (len(self._load(FEATURE_IDS)), len(self._load(SAMPLE_IDS)))
+
+    @property
+    def matrix_data(self):
+        """The features by samples CSR matrix, backed by the mapped files"""
+        data, indices, indptr = (self._load(name) for name in MATRIX)
+        return ss.csr_matrix((data, indices, indptr), shape=self.shape,
+                             copy=False)
+
+    def ids(self, axis='sample'):
+        """The ids of the samples or features, as biom.Table.ids"""
+        name = SAMPLE_IDS if axis == 'sample' else FEATURE_IDS
+        return self._load(name).astype(object)
+
+    @property
+    def env(self):
+        """The environment of each sample, if written with the table"""
+        if not os.path.exists(os.path.join(self.directory, ENV + '.npy')):
+            return None
+        return pd.Series(self._load(ENV).astype(object), index=self.ids())
+
+    def filter(self, ids_to_keep, inplace=False):
+        """Copy the samples ids_to_keep to a biom.Table, in the order of
+        this table"""
+        if inplace:
+            raise ValueError("A mapped table is read-only.")
+        ids = self.ids()
+        positions = np.flatnonzero(pd.Index(ids).isin(ids_to_keep))
+        return biom.Table(self.matrix_data[:, positions],
+                          self.ids(axis='observation'), ids[positions])
@@ -6,99 +6,662 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
 import pandas as pd
+import scipy.sparse as ss
 import qiime2
 import biom
+from q2_types.feature_table import BIOMV210Format
+
+from ._format import ReferenceBundleDirectoryFormat
+from ._probe import TableProbe
+from ._profiling import StageRecorder
+from ._workqueue import WorkQueue, local_workers, task
 
 NOT_APPLICABLE = 'not applicable'
 
+# the feature the focus-only features are pooled into
+UNASSIGNED = 'unassigned'
+
+# the files q2-sample-classifier stores a fitted estimator in
+ESTIMATOR_FILES = ('sklearn_pipeline.tar', 'sklearn_version.json')
+
+# the directory of a reference bundle the source samples are mapped from
+MAPPED_SOURCES = 'sourcetracker_mapped'
+
+# the prefix of the ids of the collapsed sources of a reference bundle, so
+# that they do not collide with the ids of the focus samples
+SOURCE_PREFIX = '__source__'
+
 
 # defaults from HMP SOP
 # https://www.hmpdacc.org/hmp/doc/QiimeCommunityProfiling.pdf
 def within_dataset(ctx, table, env, alleged_min_probability=0.25,
-                   env_min_proportion=0.6, n_jobs=1, sampling_depth=1000):
-    feat_filter = ctx.get_action('feature_table', 'filter_features')
-    rarefy = ctx.get_action('feature_table', 'rarefy')
-    classifier = ctx.get_action('sample_classifier', 'classify_samples_ncv')
-    st = ctx.get_action('sourcetracker2', 'gibbs')
+                   env_min_proportion=0.6, n_jobs=1, sampling_depth=1000,
+                   preprocessing='hmp', rarefaction_engine='feature-table',
+                   contamination_engine='gibbs',
+                   classifier_engine='random-forest', random_state=None,
+                   previous_probabilities=None, previous_proportions=None,
+                   refresh_fraction=0.1, checkpoint_dir=None,
+                   n_rarefactions=1, loo_shards=1, work_dir=None,
+                   shard_lease=600.0):
+    if (previous_probabilities is None) != (previous_proportions is None):
+        raise ValueError("The previous probabilities and proportions must "
+                         "be provided together.")
+
+    recorder = StageRecorder(
+        parallel=getattr(ctx, 'parallel', False),
+        checkpoint=_checkpoint(checkpoint_dir, random_state=random_state,
+                               rarefaction_engine=rarefaction_engine,
+                               contamination_engine=contamination_engine,
+                               classifier_engine=classifier_engine))
+    feat_filter = recorder.wrap(
+        'filter_features', ctx.get_action('feature_table', 'filter_features'))
+    filter_samples = recorder.wrap(
+        'filter_samples', ctx.get_action('feature_table', 'filter_samples'))
+    classifier = recorder.wrap(
+        'classify_samples_ncv' if classifier_engine == 'random-forest'
+        else classifier_engine,
+        _get_classifier(ctx, classifier_engine))
+    heldout_classifier = recorder.wrap(
+        'classify_new_samples',
+        _get_heldout_classifier(ctx, classifier_engine, filter_samples))
+    st = recorder.wrap(contamination_engine,
+                       _get_sharded_sourcetracker(ctx, contamination_engine,
+                                                  loo_shards, work_dir,
+                                                  shard_lease))
 
     env_df = env.to_dataframe()
     c = env_df.columns[0]  # MetadataColumn, so our col of interest is idx 0
 
-    # get our table dimensions
-    nfeat, nsamp = table.view(biom.Table).shape
-    min_samples = int(nsamp * 0.01)
+    # with the results of a previous run, only the samples added since are
+    # assessed, unless enough were added to change the models
+    new = None
+    if previous_probabilities is not None:
+        prev_prob_df = recorder.run('view_probabilities',
+                                    previous_probabilities.view, pd.DataFrame)
+        prev_proportions_df = recorder.run('view_proportions',
+                                           previous_proportions.view,
+                                           pd.DataFrame)
+        new = recorder.run('find_new_samples', _new_samples,
+                           TableProbe(table).sample_totals(), env_df, c,
+                           prev_prob_df, sampling_depth, refresh_fraction)
 
-    # From the HMP SOP
-    # Rarefy OTU tables at depth 100 (n.b., classifier is faster now so
-    # we use a depth of 1000):
-    raretab, = rarefy(table, sampling_depth=sampling_depth)
+    if new == []:
+        # nothing was added, so the previous results are used as they are
+        prob_df = _current(prev_prob_df, env_df, new)
+        proportions_df = _current(prev_proportions_df, env_df, new)
+        prob_spread_df = proportions_spread_df = None
+        prob_below_min = _set_sources(recorder, env_df, prob_df, c,
+                                      alleged_min_probability)
+    else:
+        # get our table dimensions
+        min_samples = recorder.run('min_samples', _min_samples, table)
 
-    # From the HMP SOP
-    # Drop all OTUs present in less than 1% of the samples:
-    filttab, = feat_filter(raretab, min_samples=min_samples)
-    _, feat, prob = classifier(filttab, env, n_jobs=n_jobs)
-    prob_df = prob.view(pd.DataFrame)
+        # each rarefaction is drawn with its own seed and assessed on its
+        # own, so every classifier is submitted before any result is viewed.
+        # with parallel pipeline execution, the draws are then assessed
+        # concurrently
+        draw_jobs = _shared_jobs(ctx, n_jobs, n_rarefactions)
+        probs, refilttabs = [], []
+        for seed in _seeds(random_state, n_rarefactions):
+            rarefy = recorder.wrap(
+                'rarefy', _get_rarefy(ctx, rarefaction_engine, n_jobs, seed))
+
+            # From the HMP SOP
+            # Rarefy OTU tables at depth 100 (n.b., classifier is faster now
+            # so we use a depth of 1000):
+            raretab, = rarefy(table, sampling_depth=sampling_depth)
+
+            # From the HMP SOP
+            # Drop all OTUs present in less than 1% of the samples:
+            filttab, = feat_filter(raretab, min_samples=min_samples)
+            if new is None:
+                _, feat, prob = classifier(filttab, env, n_jobs=draw_jobs,
+                                           random_state=random_state)
+            else:
+                # the new samples are classified by a model of the previous
+                # ones
+                prob = heldout_classifier(filttab, env, new,
+                                          n_jobs=draw_jobs,
+                                          random_state=random_state)
+            probs.append(prob)
+
+            # the SourceTracker table does not depend on the classifier, so
+            # prepare it before waiting on the classifier results
+            refilttabs.append(_sourcetracker_table(
+                table, filttab, min_samples, sampling_depth, preprocessing,
+                feat_filter, rarefy, rarefaction_engine))
+
+        prob_df, prob_spread_df = _ensemble([
+            recorder.run('view_probabilities', prob.view, pd.DataFrame)
+            for prob in probs])
+        if new is not None:
+            prob_df = pd.concat([_current(prev_prob_df, env_df, new),
+                                 prob_df])
+        prob_below_min = _set_sources(recorder, env_df, prob_df, c,
+                                      alleged_min_probability)
+
+        # every draw is source tracked with the same sources, those which
+        # are not mislabeled by the mean probabilities
+        proportions = []
+        for refilttab in refilttabs:
+            if new is None:
+                # Run source tracker in leave-one-out mode. We are disabling
+                # rarefaction as that's already been resolved.
+                st_metadata = qiime2.Metadata(env_df[['SourceSink', c]])
+                draw_proportions, _ = st(refilttab, st_metadata,
+                                         jobs=draw_jobs,
+                                         source_category_column=c, loo=True,
+                                         source_rarefaction_depth=0,
+                                         sink_rarefaction_depth=0)
+            else:
+                draw_proportions = _new_sourcetracker(
+                    st, filter_samples, refilttab, env_df, c, prob_below_min,
+                    new, draw_jobs)
+            proportions.append(draw_proportions)
+
+        if new is None:
+            proportions_df, proportions_spread_df = _ensemble([
+                recorder.run('view_proportions', prop.view, pd.DataFrame).T
+                for prop in proportions])
+        else:
+            proportions_df = _current(prev_proportions_df, env_df, new)
+            proportions_spread_df = None
+            if proportions[0] is not None:
+                new_proportions_df, proportions_spread_df = _ensemble([
+                    recorder.run('view_proportions', prop.view,
+                                 pd.DataFrame).T
+                    for prop in proportions])
+                proportions_df = pd.concat([
+                    proportions_df, new_proportions_df]).fillna(0.0)
 
+    recorder.run('set_contamination', _set_contamination, env_df,
+                 proportions_df, c, prob_below_min, env_min_proportion)
+    if n_rarefactions > 1:
+        _set_spread(env_df, prob_spread_df, c, 'alleged_probability',
+                    'classifier probabilities')
+        _set_spread(env_df, proportions_spread_df, c, 'min_proportion',
+                    'source proportions')
+
+    mislabelings = qiime2.Artifact.import_data('SampleData[Mislabeled]',
+                                               env_df)
+    if new is None and n_rarefactions == 1:
+        # the probabilities are those of the one classifier, as they are
+        prob, = probs
+    else:
+        prob = _probabilities_artifact(prob_df)
+    return (mislabelings, prob, _proportions_artifact(proportions_df),
+            _stage_metrics(recorder))
+
+
+def _set_sources(recorder, env_df, prob_df, c, alleged_min_probability):
     # We deviate slightly from the HMP SOP here. Specifically, instead of
     # creating a copy of the mapping file, we augment our mapping file with
     # what samples are below our probability threshold. As the HMP SOP notes,
     # the contaminatin check is then run "...for all remaining samples..."
-    prob_below_min = _set_mislabeled(env_df, prob_df, c,
-                                     alleged_min_probability)
+    prob_below_min = recorder.run('set_mislabeled', _set_mislabeled, env_df,
+                                  prob_df, c, alleged_min_probability)
 
     # set our source/sink variable. Note that since we are using LOO, we are
     # only evaluating the "source" samples for contamination. In this case,
     # that means the samples which do not appear to be mislabeled.
     env_df.loc[prob_below_min.index, 'SourceSink'] = ['sink' if v else 'source'
                                                       for v in prob_below_min]
+    return prob_below_min
 
-    # From the HMP SOP:
-    # Reduce number of features further before running SourceTracker
-    # (to reduce run-time): Remove OTUs present in <1% of the samples, then
-    # rarefy at depth 100 (n.b. ST is faster now so we use 1000 here), then
-    # again remove OTUs present in <1% of the remaining samples:
-    if min_samples > 1:
-        filttab, = feat_filter(table, min_samples=min_samples)
-    else:
-        filttab = table
-    raretab, = rarefy(filttab, sampling_depth=sampling_depth)
-    if min_samples > 1:
-        refilttab, = feat_filter(raretab, min_samples=min_samples)
-    else:
-        refilttab = raretab
-
-    # Run source tracker in leave-one-out mode. We are disabling rarefaction
-    # as that's already been resolved.
-    st_metadata = qiime2.Metadata(env_df[['SourceSink', c]])
-    proportions, _ = st(refilttab, st_metadata, jobs=n_jobs,
-                        source_category_column=c, loo=True,
-                        source_rarefaction_depth=0,
-                        sink_rarefaction_depth=0)
-    proportions_df = proportions.view(pd.DataFrame).T
-
-    _set_contamination(env_df, proportions_df, c, prob_below_min,
-                       env_min_proportion)
 
-    mislabelings = qiime2.Artifact.import_data('SampleData[Mislabeled]',
-                                               env_df)
-    return mislabelings
+def _new_samples(totals, env_df, c, prev_prob_df, sampling_depth,
+                 refresh_fraction):
+    # the samples to assess that were not assessed by a previous run, or
+    # None if every sample should be assessed again. samples too shallow to
+    # be rarefied are never assessed, so they are not counted as new
+    ids = totals.index[totals >= sampling_depth]
+    ids = env_df.index[env_df.index.isin(ids)]
+    is_new = ~ids.isin(prev_prob_df.index)
+
+    # the models describe each environment by its samples, so once the
+    # samples added to an environment are more than refresh_fraction of
+    # those it had, or it is a new environment, they are out of date
+    previous = env_df.loc[ids[~is_new], c].value_counts()
+    added = env_df.loc[ids[is_new], c].value_counts()
+    previous = previous.reindex(added.index, fill_value=0)
+    if (added > refresh_fraction * previous).any():
+        return None
+    return list(ids[is_new])
+
+
+def _current(df, env_df, new):
+    # the previous results of the samples still being assessed
+    return df.loc[df.index.isin(env_df.index) & ~df.index.isin(new)]
+
+
+def _seeds(random_state, n_rarefactions):
+    # the seed of each rarefaction. the first is random_state, so a single
+    # rarefaction is drawn as it would be without an ensemble
+    if random_state is None:
+        return [None] * n_rarefactions
+    return [random_state + i for i in range(n_rarefactions)]
+
+
+def _ensemble(dfs):
+    # the mean over the rarefactions of each value, and its standard
+    # deviation if there is more than one. a value missing from a
+    # rarefaction, such as an environment no source was drawn for, is zero
+    if len(dfs) == 1:
+        return dfs[0], None
+
+    stacked = pd.concat(dfs).fillna(0.0)
+    grouped = stacked.groupby(level=0, sort=False)
+    return grouped.mean(), grouped.std()
+
+
+def _set_spread(env_df, spread_df, c, column, description):
+    # store the spread over the rarefactions of a value stored for the
+    # reported environment type, alongside it
+    spread = np.full(len(env_df), NOT_APPLICABLE, dtype=object)
+    if spread_df is not None:
+        in_spread, rows, cols = _alleged_positions(env_df, spread_df, c,
+                                                   description)
+        spread[in_spread] = spread_df.to_numpy(dtype=float)[rows, cols]
+    env_df[column + '_std'] = spread
+
+
+def _new_sourcetracker(st, filter_samples, table, env_df, c, prob_below_min,
+                       new, n_jobs):
+    # the new samples which are not mislabeled are assessed as sinks against
+    # the previous samples which are not mislabeled, as when assessing a
+    # focus dataset against a reference
+    correct = prob_below_min.index[~prob_below_min.to_numpy(dtype=bool)]
+    sinks = correct[correct.isin(new)]
+    if len(sinks) == 0:
+        return None
+
+    st_df = env_df.loc[correct, [c]]
+    st_df['SourceSink'] = np.where(correct.isin(new), 'sink', 'source')
+    st_metadata = qiime2.Metadata(st_df[['SourceSink', c]])
+    st_table, = filter_samples(table, metadata=st_metadata)
+    proportions, _ = st(st_table, st_metadata, jobs=n_jobs,
+                        source_category_column=c, loo=False,
+                        source_rarefaction_depth=0, sink_rarefaction_depth=0)
+    return proportions
+
+
+def within_dataset_columns(ctx, table, metadata, columns,
+                           alleged_min_probability=0.25,
+                           env_min_proportion=0.6, n_jobs=1,
+                           sampling_depth=1000, preprocessing='hmp',
+                           rarefaction_engine='feature-table',
+                           contamination_engine='gibbs',
+                           classifier_engine='random-forest',
+                           random_state=None, checkpoint_dir=None):
+    envs = _metadata_columns(metadata, columns)
+
+    recorder = StageRecorder(
+        parallel=getattr(ctx, 'parallel', False),
+        checkpoint=_checkpoint(checkpoint_dir, random_state=random_state,
+                               rarefaction_engine=rarefaction_engine,
+                               contamination_engine=contamination_engine,
+                               classifier_engine=classifier_engine))
+    feat_filter = recorder.wrap(
+        'filter_features', ctx.get_action('feature_table', 'filter_features'))
+    filter_samples = recorder.wrap(
+        'filter_samples', ctx.get_action('feature_table', 'filter_samples'))
+    rarefy = recorder.wrap(
+        'rarefy', _get_rarefy(ctx, rarefaction_engine, n_jobs, random_state))
+    classifier = recorder.wrap(
+        'classify_samples_ncv' if classifier_engine == 'random-forest'
+        else classifier_engine,
+        _get_classifier(ctx, classifier_engine))
+    st = recorder.wrap(contamination_engine,
+                       _get_sourcetracker(ctx, contamination_engine))
+    column_jobs = _shared_jobs(ctx, n_jobs, len(envs))
+
+    # the tables do not depend on the column, so they are prepared once for
+    # all of them
+    min_samples = recorder.run('min_samples', _min_samples, table)
+    filttab = _classifier_table(table, min_samples, sampling_depth,
+                                feat_filter, rarefy)
+
+    # the columns are independent of each other, so every classifier is
+    # submitted before any result is viewed, and each SourceTracker run as
+    # soon as the probabilities it needs are. with parallel pipeline
+    # execution, the columns are then assessed concurrently
+    n_samples = len(metadata.to_dataframe())
+    probs = {}
+    for column, env in envs.items():
+        # the classifier requires every sample of its table to be described,
+        # so a column which does not describe every sample is classified on
+        # those it does
+        column_table = filttab
+        if len(env.to_dataframe()) < n_samples:
+            column_table, = filter_samples(
+                filttab, metadata=qiime2.Metadata(env.to_dataframe()))
+        _, _, probs[column] = classifier(column_table, env,
+                                         n_jobs=column_jobs,
+                                         random_state=random_state)
+    refilttab = _sourcetracker_table(table, filttab, min_samples,
+                                     sampling_depth, preprocessing,
+                                     feat_filter, rarefy, rarefaction_engine)
+
+    env_dfs, prob_dfs, prob_below_mins, proportions = {}, {}, {}, {}
+    for column, env in envs.items():
+        env_df = env_dfs[column] = env.to_dataframe()
+        prob_dfs[column] = recorder.run('view_probabilities',
+                                        probs[column].view, pd.DataFrame)
+        prob_below_mins[column] = _set_sources(recorder, env_df,
+                                               prob_dfs[column], column,
+                                               alleged_min_probability)
+
+        # a column may not describe every sample, so only those it does are
+        # source tracked
+        st_metadata = qiime2.Metadata(env_df[['SourceSink', column]])
+        st_table, = filter_samples(refilttab, metadata=st_metadata)
+        proportions[column], _ = st(st_table, st_metadata, jobs=column_jobs,
+                                    source_category_column=column, loo=True,
+                                    source_rarefaction_depth=0,
+                                    sink_rarefaction_depth=0)
+
+    mislabelings, proportion_artifacts = {}, {}
+    for column, env_df in env_dfs.items():
+        proportions_df = recorder.run('view_proportions',
+                                      proportions[column].view,
+                                      pd.DataFrame).T
+        recorder.run('set_contamination', _set_contamination, env_df,
+                     proportions_df, column, prob_below_mins[column],
+                     env_min_proportion)
+        mislabelings[column] = qiime2.Artifact.import_data(
+            'SampleData[Mislabeled]', env_df)
+        proportion_artifacts[column] = _proportions_artifact(proportions_df)
+
+    return (mislabelings, probs, proportion_artifacts,
+            _stage_metrics(recorder))
+
+
+def _metadata_columns(metadata, columns):
+    # the categorical columns to assess, without the samples they do not
+    # describe
+    if len(columns) == 0:
+        raise ValueError("At least one column must be provided.")
+    if len(set(columns)) != len(columns):
+        raise ValueError("The columns must not be repeated.")
+
+    envs = {}
+    for column in columns:
+        env = metadata.get_column(column)
+        if not isinstance(env, qiime2.CategoricalMetadataColumn):
+            raise ValueError("The column %r is not categorical." % column)
+        envs[column] = env.drop_missing_values()
+    return envs
+
+
+def _shared_jobs(ctx, n_jobs, n_branches):
+    # with parallel pipeline execution the branches (columns, rarefactions,
+    # or focus tables) are assessed at the same time, so they share n_jobs
+    if not getattr(ctx, 'parallel', False):
+        return n_jobs
+    return max(1, n_jobs // n_branches)
 
 
 def against_dataset(ctx, focus, reference, focus_env, reference_env,
                     alleged_min_probability=0.25, env_min_proportion=0.6,
-                    n_jobs=1, sampling_depth=1000):
+                    n_jobs=1, sampling_depth=1000, preprocessing='hmp',
+                    rarefaction_engine='feature-table',
+                    contamination_engine='gibbs', random_state=None,
+                    chunk_size=None, checkpoint_dir=None,
+                    focus_features='merge'):
+    recorder = StageRecorder(
+        parallel=getattr(ctx, 'parallel', False),
+        checkpoint=_checkpoint(checkpoint_dir, random_state=random_state,
+                               rarefaction_engine=rarefaction_engine,
+                               contamination_engine=contamination_engine))
+    feat_filter = recorder.wrap(
+        'filter_features', ctx.get_action('feature_table', 'filter_features'))
+    filter_samples = recorder.wrap(
+        'filter_samples', ctx.get_action('feature_table', 'filter_samples'))
+    merge_tables = recorder.wrap('merge', _get_merge(ctx, focus_features))
+    project = recorder.wrap('project', _project)
+    rarefy = recorder.wrap(
+        'rarefy', _get_rarefy(ctx, rarefaction_engine, n_jobs, random_state))
+    fit_classifier = recorder.wrap(
+        'fit_classifier',
+        ctx.get_action('sample_classifier', 'fit_classifier'))
+    pred_classifier = recorder.wrap(
+        'predict_classification',
+        ctx.get_action('sample_classifier', 'predict_classification'))
+    st = recorder.wrap(contamination_engine,
+                       _get_sourcetracker(ctx, contamination_engine))
+
+    focus_env_df, env_df, ref_column = \
+        _against_env(focus_env, reference_env.to_dataframe())
+    classifier_jobs, st_jobs = _branch_jobs(ctx, n_jobs)
+
+    # get our table dimensions
+    ref_min_samples = recorder.run('min_samples', _min_samples, reference)
+    foc_min_samples = recorder.run('min_samples', _min_samples, focus)
+
+    # The classifier and SourceTracker branches are independent, as are the
+    # reference and focus preparations within them, so all of the actions
+    # are submitted before any result is viewed. With parallel pipeline
+    # execution, the branches then run concurrently.
+    ref_filttab = _classifier_table(reference, ref_min_samples,
+                                    sampling_depth, feat_filter, rarefy)
+    foc_filttab = _classifier_table(focus, foc_min_samples, sampling_depth,
+                                    feat_filter, rarefy)
+
+    # construct a classifier from the reference data, and predict the samples
+    # in the focus table
+    estimator, _ = fit_classifier(ref_filttab, reference_env,
+                                  n_jobs=classifier_jobs,
+                                  random_state=random_state)
+    probs = _against_classifier(pred_classifier, filter_samples, foc_filttab,
+                                estimator, chunk_size, classifier_jobs)
+
+    ref_refilttab = _sourcetracker_table(reference, ref_filttab,
+                                         ref_min_samples, sampling_depth,
+                                         preprocessing, feat_filter, rarefy,
+                                         rarefaction_engine)
+    foc_refilttab = _sourcetracker_table(focus, foc_filttab,
+                                         foc_min_samples, sampling_depth,
+                                         preprocessing, feat_filter, rarefy,
+                                         rarefaction_engine)
+    if focus_features != 'merge':
+        foc_refilttab = project(ref_refilttab, foc_refilttab,
+                                pool=focus_features == 'pool')
+    proportions = _against_sourcetracker(st, merge_tables, filter_samples,
+                                         ref_refilttab, foc_refilttab,
+                                         env_df, ref_column, chunk_size,
+                                         st_jobs)
+
+    prob_df = pd.concat([
+        recorder.run('view_probabilities', prob.view, pd.DataFrame)
+        for prob in probs])
+    proportions_df = pd.concat([
+        recorder.run('view_proportions', prop.view, pd.DataFrame).T
+        for prop in proportions])
+
+    mislabelings = recorder.run('assess', _against_mislabelings, env_df,
+                                focus_env_df, prob_df, proportions_df,
+                                ref_column, alleged_min_probability,
+                                env_min_proportion)
+    return (mislabelings, _probabilities_artifact(prob_df),
+            _proportions_artifact(proportions_df), _stage_metrics(recorder))
+
+
+def prepare_reference(ctx, reference, reference_env, n_jobs=1,
+                      sampling_depth=1000, preprocessing='hmp',
+                      rarefaction_engine='feature-table', random_state=None):
     feat_filter = ctx.get_action('feature_table', 'filter_features')
-    merge_tables = ctx.get_action('feature_table', 'merge')
-    rarefy = ctx.get_action('feature_table', 'rarefy')
+    rarefy = _get_rarefy(ctx, rarefaction_engine, n_jobs, random_state)
     fit_classifier = ctx.get_action('sample_classifier', 'fit_classifier')
+
+    ref_env_df = reference_env.to_dataframe()
+    ref_column = ref_env_df.columns[0]
+    min_samples = _min_samples(reference)
+
+    filttab = _classifier_table(reference, min_samples, sampling_depth,
+                                feat_filter, rarefy)
+    estimator, _ = fit_classifier(filttab, reference_env, n_jobs=n_jobs,
+                                  random_state=random_state)
+    refilttab = _sourcetracker_table(reference, filttab, min_samples,
+                                     sampling_depth, preprocessing,
+                                     feat_filter, rarefy, rarefaction_engine)
+
+    # SourceTracker collapses the source samples of each environment to
+    # their summed counts before sampling, so we can do that once here and
+    # use the sums as the sources for every focus table
+    counts = _source_counts(refilttab.view(biom.Table),
+                            ref_env_df[ref_column])
+    counts_ff = BIOMV210Format()
+    with counts_ff.open() as fh:
+        counts.to_hdf5(fh, generated_by='q2-mislabeled')
+
+    bundle = ReferenceBundleDirectoryFormat()
+    bundle.classifier_table.write_data(filttab.view(BIOMV210Format),
+                                       BIOMV210Format)
+    bundle.sourcetracker_table.write_data(refilttab.view(BIOMV210Format),
+                                          BIOMV210Format)
+    bundle.source_counts.write_data(counts_ff, BIOMV210Format)
+    _write_mapped_sources(refilttab.view(biom.Table), ref_env_df[ref_column],
+                          str(bundle.path / MAPPED_SOURCES))
+    with tempfile.TemporaryDirectory() as tmp:
+        estimator.export_data(tmp)
+        for name in ESTIMATOR_FILES:
+            shutil.copy(os.path.join(tmp, name), str(bundle.path / name))
+    with open(str(bundle.path / 'parameters.json'), 'w') as fh:
+        json.dump({'environment_column': ref_column,
+                   'sampling_depth': sampling_depth,
+                   'preprocessing': preprocessing}, fh)
+
+    return qiime2.Artifact.import_data('ReferenceBundle', bundle)
+
+
+def against_prepared_reference(ctx, focus, reference, focus_env,
+                               alleged_min_probability=0.25,
+                               env_min_proportion=0.6, n_jobs=1,
+                               rarefaction_engine='feature-table',
+                               contamination_engine='gibbs',
+                               random_state=None, chunk_size=None,
+                               focus_features='merge'):
+    feat_filter = ctx.get_action('feature_table', 'filter_features')
+    filter_samples = ctx.get_action('feature_table', 'filter_samples')
+    merge_tables = _get_merge(ctx, focus_features)
+    rarefy = _get_rarefy(ctx, rarefaction_engine, n_jobs, random_state)
     pred_classifier = ctx.get_action('sample_classifier',
                                      'predict_classification')
-    st = ctx.get_action('sourcetracker2', 'gibbs')
+    st = _get_sourcetracker(ctx, contamination_engine)
+
+    bundle = reference.view(ReferenceBundleDirectoryFormat)
+    with open(str(bundle.path / 'parameters.json')) as fh:
+        parameters = json.load(fh)
+    sampling_depth = parameters['sampling_depth']
+    preprocessing = parameters['preprocessing']
+
+    sources = qiime2.Artifact.import_data(
+        'FeatureTable[Frequency]',
+        bundle.source_counts.view(BIOMV210Format))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ESTIMATOR_FILES:
+            shutil.copy(str(bundle.path / name), tmp)
+        estimator = qiime2.Artifact.import_data('SampleEstimator[Classifier]',
+                                                tmp)
+
+    # the summed counts are the sole source sample of their environment
+    source_ids = pd.Index(sources.view(biom.Table).ids(),
+                          name=focus_env.to_dataframe().index.name)
+    ref_env_df = pd.DataFrame({parameters['environment_column']:
+                               source_ids.str[len(SOURCE_PREFIX):]},
+                              index=source_ids)
+    focus_env_df, env_df, ref_column = _against_env(focus_env, ref_env_df)
+    classifier_jobs, st_jobs = _branch_jobs(ctx, n_jobs)
+
+    # as in against_dataset, both branches are submitted before any result
+    # is viewed
+    foc_min_samples = _min_samples(focus)
+    foc_filttab = _classifier_table(focus, foc_min_samples, sampling_depth,
+                                    feat_filter, rarefy)
+    probs = _against_classifier(pred_classifier, filter_samples, foc_filttab,
+                                estimator, chunk_size, classifier_jobs)
+
+    foc_refilttab = _sourcetracker_table(focus, foc_filttab,
+                                         foc_min_samples, sampling_depth,
+                                         preprocessing, feat_filter, rarefy,
+                                         rarefaction_engine)
+    if focus_features != 'merge':
+        # the sources have the features of the reference SourceTracker table
+        foc_refilttab = _project(sources, foc_refilttab,
+                                 pool=focus_features == 'pool')
+    if contamination_engine == 'mixture':
+        proportions = _against_mapped(str(bundle.path / MAPPED_SOURCES),
+                                      filter_samples, foc_refilttab,
+                                      chunk_size)
+    else:
+        proportions = _against_sourcetracker(st, merge_tables,
+                                             filter_samples, sources,
+                                             foc_refilttab, env_df,
+                                             ref_column, chunk_size,
+                                             st_jobs)
+
+    prob_df = pd.concat([prob.view(pd.DataFrame) for prob in probs])
+    proportions_df = pd.concat([prop.view(pd.DataFrame).T
+                                for prop in proportions])
 
+    mislabelings = _against_mislabelings(env_df, focus_env_df, prob_df,
+                                         proportions_df, ref_column,
+                                         alleged_min_probability,
+                                         env_min_proportion)
+    return (mislabelings, _probabilities_artifact(prob_df),
+            _proportions_artifact(proportions_df))
+
+
+def against_dataset_batch(ctx, focus, reference, focus_env, reference_env,
+                          alleged_min_probability=0.25,
+                          env_min_proportion=0.6, n_jobs=1,
+                          sampling_depth=1000, preprocessing='hmp',
+                          rarefaction_engine='feature-table',
+                          contamination_engine='gibbs', random_state=None,
+                          chunk_size=None, focus_features='merge'):
+    prepare = ctx.get_action('mislabeled', 'prepare_reference')
+    against = ctx.get_action('mislabeled', 'against_prepared_reference')
+
+    # all of the reference-side work is shared by the focus tables
+    bundle, = prepare(reference, reference_env, n_jobs=n_jobs,
+                      sampling_depth=sampling_depth,
+                      preprocessing=preprocessing,
+                      rarefaction_engine=rarefaction_engine,
+                      random_state=random_state)
+
+    # the focus tables are independent of each other, so we submit all of
+    # them before using any result. with parallel pipeline execution, they
+    # are then assessed concurrently, sharing n_jobs
+    focus_jobs = _shared_jobs(ctx, n_jobs, len(focus))
+    focus_ids = set(focus_env.to_dataframe().index)
+    mislabelings, probabilities, proportions = {}, {}, {}
+    for name, table in focus.items():
+        ids = focus_ids.intersection(TableProbe(table).sample_ids())
+        mislabelings[name], probabilities[name], proportions[name] = against(
+            table, bundle, focus_env.filter_ids(ids),
+            alleged_min_probability=alleged_min_probability,
+            env_min_proportion=env_min_proportion, n_jobs=focus_jobs,
+            rarefaction_engine=rarefaction_engine,
+            contamination_engine=contamination_engine,
+            random_state=random_state, chunk_size=chunk_size,
+            focus_features=focus_features)
+
+    return mislabelings, probabilities, proportions
+
+
+def _against_env(focus_env, ref_env_df):
+    # combine the focus and reference metadata, marking the focus samples as
+    # sinks and the reference samples as sources
     focus_env_df = focus_env.to_dataframe()
     focus_column = focus_env_df.columns[0]
-    ref_env_df = reference_env.to_dataframe()
     ref_column = ref_env_df.columns[0]
 
     focus_column_values = set(focus_env_df[focus_column].unique())
@@ -114,84 +677,542 @@ def against_dataset(ctx, focus, reference, focus_env, reference_env,
         focus_env_df.rename(columns={focus_column: ref_column}, inplace=True)
 
     env_df = pd.concat([focus_env_df, ref_env_df])
+    return focus_env_df, env_df, ref_column
 
-    # get our table dimensions
-    ref_nfeat, ref_nsamp = reference.view(biom.Table).shape
-    foc_nfeat, foc_nsamp = focus.view(biom.Table).shape
-    ref_min_samples = int(ref_nsamp * 0.01)
-    foc_min_samples = int(foc_nsamp * 0.01)
 
+def _against_classifier(pred_classifier, filter_samples, table, estimator,
+                        chunk_size, n_jobs):
+    # predict the focus samples with the reference classifier. predictions
+    # are per sample, so chunking does not change them
+    probs = []
+    for chunk in _chunks(filter_samples, table, chunk_size):
+        _, prob = pred_classifier(chunk, estimator, n_jobs=n_jobs)
+        probs.append(prob)
+    return probs
+
+
+def _against_sourcetracker(st, merge_tables, filter_samples, sources, sinks,
+                           env_df, ref_column, chunk_size, n_jobs):
+    # Run source tracker. We are disabling rarefaction
+    # as that's already been resolved. Every chunk of sinks is assessed
+    # against the same sources.
+    st_metadata = qiime2.Metadata(env_df[['SourceSink', ref_column]])
+    proportions = []
+    for chunk in _chunks(filter_samples, sinks, chunk_size):
+        merged, = merge_tables([sources, chunk])
+        chunk_proportions, _ = st(merged, st_metadata, jobs=n_jobs,
+                                  source_category_column=ref_column,
+                                  loo=False, source_rarefaction_depth=0,
+                                  sink_rarefaction_depth=0)
+        proportions.append(chunk_proportions)
+    return proportions
+
+
+def _against_mapped(directory, filter_samples, sinks, chunk_size):
+    # the mixture engine assesses every chunk of sinks against the source
+    # samples of the reference, as against_dataset does, mapping them from
+    # the bundle rather than reading them
+    from ._mixture import mixture_proportions
+    from ._mmap import MappedTable
+    sources = MappedTable(directory)
+    proportions = []
+    for chunk in _chunks(filter_samples, sinks, chunk_size):
+        proportions.append(_sourcetracker_artifact(mixture_proportions(
+            sources, sources.env, chunk.view(biom.Table))))
+    return proportions
+
+
+def _branch_jobs(ctx, n_jobs):
+    # with parallel pipeline execution the classifier and SourceTracker
+    # branches run at the same time, so they share n_jobs. otherwise they
+    # run one after the other and each can use all of them
+    if not getattr(ctx, 'parallel', False):
+        return n_jobs, n_jobs
+    classifier_jobs = max(1, n_jobs // 2)
+    return classifier_jobs, max(1, n_jobs - classifier_jobs)
+
+
+def _chunks(filter_samples, table, chunk_size):
+    # split a table into tables of at most chunk_size samples
+    if chunk_size is None:
+        yield table
+        return
+
+    ids = TableProbe(table).sample_ids()
+    if len(ids) <= chunk_size:
+        yield table
+        return
+
+    for start in range(0, len(ids), chunk_size):
+        chunk_ids = pd.Index(ids[start:start + chunk_size], name='id')
+        chunk, = filter_samples(table,
+                                metadata=qiime2.Metadata(
+                                    pd.DataFrame(index=chunk_ids)))
+        yield chunk
+
+
+def _against_mislabelings(env_df, focus_env_df, prob_df, proportions_df,
+                          ref_column, alleged_min_probability,
+                          env_min_proportion):
+    prob_below_min = _set_mislabeled(env_df, prob_df, ref_column,
+                                     alleged_min_probability)
+    _set_contamination(env_df, proportions_df, ref_column, prob_below_min,
+                       env_min_proportion)
+
+    env_df = env_df.loc[focus_env_df.index]
+    mislabelings = qiime2.Artifact.import_data('SampleData[Mislabeled]',
+                                               env_df)
+    return mislabelings
+
+
+def _probabilities_artifact(prob_df):
+    return qiime2.Artifact.import_data('SampleData[Probabilities]', prob_df)
+
+
+def _proportions_artifact(proportions_df):
+    # SourceTracker reports the environments as samples, but the proportions
+    # are stored with the samples as samples, as with any other feature table
+    table = biom.Table(proportions_df.to_numpy(dtype=float).T,
+                       list(proportions_df.columns),
+                       list(proportions_df.index))
+    return qiime2.Artifact.import_data('FeatureTable[RelativeFrequency]',
+                                       table)
+
+
+def _checkpoint(checkpoint_dir, **engines):
+    # the engines are configured when they are created rather than by the
+    # arguments of each call, so their configuration is part of every key.
+    # n_jobs is left out, as with the n_jobs argument of each call
+    if checkpoint_dir is None:
+        return None
+
+    import q2_mislabeled
+    from ._checkpoint import Checkpoint
+    return Checkpoint(checkpoint_dir, dict(engines,
+                                           version=q2_mislabeled.__version__))
+
+
+def _stage_metrics(recorder):
+    return qiime2.Artifact.import_data('StageMetrics',
+                                       recorder.to_dataframe())
+
+
+def _min_samples(table):
+    # the HMP SOP drops features present in fewer than 1% of the samples
+    nfeat, nsamp = TableProbe(table).shape
+    return int(nsamp * 0.01)
+
+
+def _get_rarefy(ctx, rarefaction_engine, n_jobs, random_state):
+    # provide a callable with the same interface as the feature-table
+    # rarefy action, so the pipelines do not depend on the engine used.
+    # every QIIME 2 command loads every plugin, so the in-process engines
+    # are only imported once they are used (scikit-learn alone takes longer
+    # to import than the rest of the plugin)
+    if rarefaction_engine == 'feature-table':
+        return ctx.get_action('feature_table', 'rarefy')
+
+    def rarefy(table, sampling_depth, min_samples=1):
+        # with min_samples, the features observed in fewer samples are also
+        # removed before and after rarefying
+        from ._rarefy import rarefy_filter
+        rarefied = rarefy_filter(table.view(biom.Table), sampling_depth,
+                                 min_samples, n_jobs=n_jobs,
+                                 random_state=random_state)
+        return qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                           rarefied),
+
+    return rarefy
+
+
+def _get_merge(ctx, focus_features):
+    if focus_features == 'merge':
+        return ctx.get_action('feature_table', 'merge')
+
+    # projected focus tables share the features of the sources, so they are
+    # stacked with them rather than merged
+    def merge(tables):
+        stacked = _stack_samples([t.view(biom.Table) for t in tables])
+        return (qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                            stacked), )
+    return merge
+
+
+def _project(reference, table, pool=False):
+    # only the feature ids of the reference are read
+    projected = _project_features(table.view(biom.Table),
+                                  TableProbe(reference).feature_ids(), pool)
+    return qiime2.Artifact.import_data('FeatureTable[Frequency]', projected)
+
+
+def _get_classifier(ctx, classifier_engine):
+    # provide a callable with the same interface as the sample-classifier
+    # classify_samples_ncv action, so within_dataset does not depend on the
+    # engine used. only the probabilities are used, so the predictions and
+    # feature importances are not produced
+    if classifier_engine == 'random-forest':
+        return ctx.get_action('sample_classifier', 'classify_samples_ncv')
+
+    def logistic(table, metadata, n_jobs, random_state):
+        from ._classifier import out_of_fold_probabilities
+        probabilities = out_of_fold_probabilities(
+            table.view(biom.Table), metadata.to_series(), n_jobs=n_jobs,
+            random_state=random_state)
+        return None, None, qiime2.Artifact.import_data(
+            'SampleData[Probabilities]', probabilities)
+
+    def naive_bayes(table, metadata, n_jobs, random_state):
+        # exact and deterministic, so there is nothing to parallelize or seed
+        from ._classifier import leave_one_out_probabilities
+        probabilities = leave_one_out_probabilities(table.view(biom.Table),
+                                                    metadata.to_series())
+        return None, None, qiime2.Artifact.import_data(
+            'SampleData[Probabilities]', probabilities)
+
+    return logistic if classifier_engine == 'logistic' else naive_bayes
+
+
+def _get_heldout_classifier(ctx, classifier_engine, filter_samples):
+    # provide a callable which classifies the new samples of a table with a
+    # model of the others, returning their probabilities
+    if classifier_engine == 'random-forest':
+        fit_classifier = ctx.get_action('sample_classifier', 'fit_classifier')
+        pred_classifier = ctx.get_action('sample_classifier',
+                                         'predict_classification')
+
+        def random_forest(table, metadata, new, n_jobs, random_state):
+            new_md = qiime2.Metadata(pd.DataFrame(
+                index=pd.Index(new, name='id')))
+            train, = filter_samples(table, metadata=new_md, exclude_ids=True)
+            test, = filter_samples(table, metadata=new_md)
+            estimator, _ = fit_classifier(train, metadata, n_jobs=n_jobs,
+                                          random_state=random_state)
+            _, prob = pred_classifier(test, estimator, n_jobs=n_jobs)
+            return prob
+
+        return random_forest
+
+    def heldout(table, metadata, new, n_jobs, random_state):
+        from ._classifier import heldout_probabilities
+        probabilities = heldout_probabilities(
+            table.view(biom.Table), metadata.to_series(), new,
+            engine=classifier_engine)
+        return _probabilities_artifact(probabilities)
+
+    return heldout
+
+
+def _get_sourcetracker(ctx, contamination_engine):
+    # provide a callable with the same interface as the sourcetracker2 gibbs
+    # action, so the pipelines do not depend on the engine used
+    if contamination_engine == 'gibbs':
+        return ctx.get_action('sourcetracker2', 'gibbs')
+
+    def mixture(table, sample_metadata, jobs, source_category_column, loo,
+                source_rarefaction_depth, sink_rarefaction_depth):
+        # the tables are already rarefied, so the depths and jobs are unused
+        from ._mixture import mixture_proportions
+        table = table.view(biom.Table)
+        md = sample_metadata.to_dataframe()
+        md = md.loc[md.index.isin(table.ids())]
+        is_source = md['SourceSink'] == 'source'
+
+        sources = table.filter(md.index[is_source], inplace=False)
+        sinks = None
+        if not loo:
+            sinks = table.filter(md.index[~is_source], inplace=False)
+        proportions = mixture_proportions(sources,
+                                          md[source_category_column], sinks)
+        return _sourcetracker_artifact(proportions), None
+
+    return mixture
+
+
+def _get_sharded_sourcetracker(ctx, contamination_engine, loo_shards,
+                               work_dir, lease=None):
+    # provide a callable with the same interface as _get_sourcetracker, which
+    # splits the samples assessed with leave one out into shards, run as the
+    # tasks of a work queue. every sample is assessed against all of the
+    # others, as without shards, so the shards are independent of each other
+    # and workers on other machines sharing work_dir can run them. jobs
+    # workers are run on this machine. a shard whose worker stopped is queued
+    # again after lease seconds
+    st = _get_sourcetracker(ctx, contamination_engine)
+    if loo_shards == 1:
+        return st
+
+    def sharded(table, sample_metadata, jobs, source_category_column, loo,
+                source_rarefaction_depth, sink_rarefaction_depth):
+        if not loo:
+            return st(table, sample_metadata, jobs=jobs,
+                      source_category_column=source_category_column,
+                      loo=loo,
+                      source_rarefaction_depth=source_rarefaction_depth,
+                      sink_rarefaction_depth=sink_rarefaction_depth)
+
+        md = sample_metadata.to_dataframe()
+        sources = md.index[(md['SourceSink'] == 'source') &
+                           md.index.isin(TableProbe(table).sample_ids())]
+        shards = [list(shard) for shard in np.array_split(sources, loo_shards)
+                  if len(shard) > 0]
+
+        with contextlib.ExitStack() as stack:
+            directory = work_dir
+            if directory is None:
+                directory = stack.enter_context(tempfile.TemporaryDirectory())
+            queue = WorkQueue(directory)
+
+            # the inputs are shared with the workers through the directory.
+            # the workers map the table rather than each deserializing its
+            # own copy. only the sources are mapped, which the workers then
+            # use without copying
+            from ._mmap import write_mapped
+            inputs = tempfile.mkdtemp(dir=directory)
+            stack.callback(shutil.rmtree, inputs)
+            table_path = os.path.join(inputs, 'table')
+            write_mapped(table.view(biom.Table).filter(sources,
+                                                       inplace=False),
+                         table_path)
+            metadata_path = os.path.join(inputs, 'metadata.tsv')
+            sample_metadata.save(metadata_path)
+
+            names = [queue.submit(_loo_shard, contamination_engine,
+                                  table_path, metadata_path,
+                                  source_category_column, shard,
+                                  source_rarefaction_depth,
+                                  sink_rarefaction_depth)
+                     for shard in shards]
+            # this process is one of the workers
+            with local_workers(directory, min(jobs, len(names)) - 1):
+                proportions = queue.gather(names, lease=lease)
+
+        proportions = pd.concat([pd.DataFrame(**shard)
+                                 for shard in proportions])
+        return _sourcetracker_artifact(proportions), None
+
+    return sharded
+
+
+@task
+def _loo_shard(contamination_engine, table_path, metadata_path, column,
+               sinks, source_rarefaction_depth, sink_rarefaction_depth):
+    # the proportions of each source sample in sinks, assessed against all of
+    # the other source samples, split for JSON. run by a worker of a work
+    # queue, which may be on another machine
+    md = qiime2.Metadata.load(metadata_path).to_dataframe()
+    if contamination_engine == 'mixture':
+        # the tables are already rarefied, so the depths are unused
+        from ._mixture import mixture_proportions
+        from ._mmap import MappedTable
+        env = md.loc[md['SourceSink'] == 'source', column]
+        proportions = mixture_proportions(MappedTable(table_path), env,
+                                          loo_ids=sinks)
+        return proportions.to_dict(orient='split')
+
+    # as the gibbs action, the source samples of each environment are
+    # collapsed to their summed counts, here once for the shard. each sample
+    # is then a sink of its own run, with its counts subtracted from those
+    # of its environment, which is the leave one out assessment of that
+    # sample. the tables are already rarefied, so the depths are unused
+    from sourcetracker._sourcetracker import gibbs
+    from ._mmap import MappedTable
+    table = MappedTable(table_path)
+    env = md.loc[md['SourceSink'] == 'source', column]
+    collapsed = _source_counts(table, env).to_dataframe(dense=True).T
+    collapsed.index = collapsed.index.str[len(SOURCE_PREFIX):]
+
+    positions = pd.Index(table.ids()).get_indexer(sinks)
+    counts = table.matrix_data[:, positions].T.toarray()
+    proportions = []
+    for sink, sink_counts in zip(sinks, counts):
+        sources = collapsed.copy()
+        sources.loc[env[sink]] -= sink_counts
+        sink_df = pd.DataFrame([sink_counts], index=[sink],
+                               columns=collapsed.columns)
+        sink_proportions, _, _ = gibbs(sources, sink_df, jobs=1,
+                                       create_feature_tables=False)
+        proportions.append(sink_proportions)
+    return pd.concat(proportions).to_dict(orient='split')
+
+
+def _sourcetracker_artifact(proportions):
+    # as with gibbs, environments are the samples and sinks the features
+    proportions = biom.Table(proportions.to_numpy(), list(proportions.index),
+                             list(proportions.columns))
+    return qiime2.Artifact.import_data('FeatureTable[RelativeFrequency]',
+                                       proportions)
+
+
+def _classifier_table(table, min_samples, sampling_depth, feat_filter,
+                      rarefy):
     # From the HMP SOP
     # Rarefy OTU tables at depth 100 (n.b., classifier is faster now so
     # we use a depth of 1000):
-    ref_raretab, = rarefy(reference, sampling_depth=sampling_depth)
-    foc_raretab, = rarefy(focus, sampling_depth=sampling_depth)
+    table, = rarefy(table, sampling_depth=sampling_depth)
 
     # From the HMP SOP
     # Drop all OTUs present in less than 1% of the samples:
-    if ref_min_samples > 1:
-        ref_filttab, = feat_filter(ref_raretab, min_samples=ref_min_samples)
-    else:
-        ref_filttab = ref_raretab
-    if foc_min_samples > 1:
-        foc_filttab, = feat_filter(foc_raretab, min_samples=foc_min_samples)
-    else:
-        foc_filttab = foc_raretab
+    if min_samples > 1:
+        table, = feat_filter(table, min_samples=min_samples)
+    return table
 
-    # construct a classifier from the reference data, and predict the samples
-    # in the focus table
-    estimator, _ = fit_classifier(ref_filttab, reference_env, n_jobs=n_jobs)
-    _, prob = pred_classifier(foc_filttab, estimator, n_jobs=n_jobs)
-    prob_df = prob.view(pd.DataFrame)
+
+def _sourcetracker_table(table, classifier_table, min_samples,
+                         sampling_depth, preprocessing, feat_filter, rarefy,
+                         rarefaction_engine):
+    if preprocessing == 'shared':
+        # The classifier table is already rarefied and free of rare
+        # features, so reuse it rather than preparing a second table
+        return classifier_table
 
     # From the HMP SOP:
     # Reduce number of features further before running SourceTracker
     # (to reduce run-time): Remove OTUs present in <1% of the samples, then
     # rarefy at depth 100 (n.b. ST is faster now so we use 1000 here), then
     # again remove OTUs present in <1% of the remaining samples:
-    if ref_min_samples > 1:
-        ref_filttab, = feat_filter(reference, min_samples=ref_min_samples)
-    else:
-        ref_filttab = reference
+    if rarefaction_engine == 'in-process':
+        # the in-process engine does all three in one pass over the table,
+        # and only builds the final table
+        table, = rarefy(table, sampling_depth=sampling_depth,
+                        min_samples=min_samples)
+        return table
 
-    if foc_min_samples > 1:
-        foc_filttab, = feat_filter(focus, min_samples=foc_min_samples)
-    else:
-        foc_filttab = focus
+    if min_samples > 1:
+        table, = feat_filter(table, min_samples=min_samples)
+    table, = rarefy(table, sampling_depth=sampling_depth)
+    if min_samples > 1:
+        table, = feat_filter(table, min_samples=min_samples)
+    return table
 
-    ref_raretab, = rarefy(ref_filttab, sampling_depth=sampling_depth)
-    foc_raretab, = rarefy(foc_filttab, sampling_depth=sampling_depth)
 
-    if ref_min_samples > 1:
-        ref_refilttab, = feat_filter(ref_raretab, min_samples=ref_min_samples)
-    else:
-        ref_refilttab = ref_raretab
+def _write_mapped_sources(table, env, directory):
+    # write the samples of a table which have an environment, with their
+    # environments, so the mixture engine maps them without filtering
+    from ._mmap import write_mapped
+    env = env.reindex(table.ids()).dropna()
+    write_mapped(table.filter(env.index, inplace=False), directory, env=env)
 
-    if foc_min_samples > 1:
-        foc_refilttab, = feat_filter(foc_raretab, min_samples=foc_min_samples)
-    else:
-        foc_refilttab = foc_raretab
 
-    merged, = merge_tables([ref_refilttab, foc_refilttab])
+def _source_counts(table, env):
+    """Collapse the samples of a table to their summed counts per environment
 
-    # Run source tracker. We are disabling rarefaction
-    # as that's already been resolved.
-    st_metadata = qiime2.Metadata(env_df[['SourceSink', ref_column]])
-    proportions, _ = st(merged, st_metadata, jobs=n_jobs,
-                        source_category_column=ref_column, loo=False,
-                        source_rarefaction_depth=0,
-                        sink_rarefaction_depth=0)
-    proportions_df = proportions.view(pd.DataFrame).T
+    Parameters
+    ----------
+    table : biom.Table or MappedTable
+        The table to collapse.
+    env : pd.Series
+        The environment of each sample. Samples in the table without an
+        environment are ignored.
 
-    prob_below_min = _set_mislabeled(env_df, prob_df, ref_column,
-                                     alleged_min_probability)
-    _set_contamination(env_df, proportions_df, ref_column, prob_below_min,
-                       env_min_proportion)
+    Returns
+    -------
+    biom.Table
+        A table with one sample per environment, named by the environment
+        prefixed by SOURCE_PREFIX.
+    """
+    env = env.reindex(table.ids()).dropna()
+    if len(env) < len(table.ids()):
+        table = table.filter(env.index, inplace=False)
+    codes, environments = pd.factorize(env, sort=True)
+    indicator = ss.csr_matrix((np.ones(len(codes)),
+                               (np.arange(len(codes)), codes)),
+                              shape=(len(codes), len(environments)))
+    sums = table.matrix_data @ indicator
+    return biom.Table(ss.csr_matrix(sums), table.ids(axis='observation'),
+                      [SOURCE_PREFIX + env for env in environments])
 
-    env_df = env_df.loc[focus_env_df.index]
-    mislabelings = qiime2.Artifact.import_data('SampleData[Mislabeled]',
-                                               env_df)
-    return mislabelings
+
+def _project_features(table, features, pool=False):
+    """Reindex the features of a table onto those of a reference
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table to project.
+    features : list of str
+        The features of the reference.
+    pool : bool, optional
+        Whether the features of the table which are not in the reference are
+        summed into one unassigned feature, rather than dropped.
+
+    Returns
+    -------
+    biom.Table
+        A table with the features of the reference, followed by the
+        unassigned feature if any were pooled. Samples left without any
+        counts are dropped, as they cannot be source tracked.
+    """
+    features = pd.Index(features)
+    ids = list(features)
+
+    # the reference feature of each feature of the table, or -1 for those
+    # only the table has
+    rows = features.get_indexer(table.ids(axis='observation'))
+    if pool and (rows < 0).any():
+        rows = np.where(rows < 0, len(ids), rows)
+        ids.append(UNASSIGNED)
+    kept = np.flatnonzero(rows >= 0)
+
+    # the projection is a sparse 0/1 matrix of the reference features by
+    # those of the table, so summing the pooled features comes for free
+    projection = ss.csr_matrix((np.ones(len(kept)), (rows[kept], kept)),
+                               shape=(len(ids), len(rows)))
+    matrix = (projection @ table.matrix_data).tocsc()
+    samples = np.flatnonzero(np.diff(matrix.indptr))
+    return biom.Table(matrix[:, samples], ids,
+                      list(np.asarray(table.ids())[samples]))
+
+
+def _stack_samples(tables):
+    """Combine tables with the same features by their samples
+
+    Unlike merging, the features are not unioned. The features of every
+    table must be those of the first, in any order, aside from the unassigned
+    feature of a pooled projection.
+
+    Parameters
+    ----------
+    tables : list of biom.Table
+        The tables to combine, which do not share any samples.
+
+    Returns
+    -------
+    biom.Table
+        The samples of every table, with the features of the first, followed
+        by the unassigned feature if any table has it.
+    """
+    features = pd.Index(tables[0].ids(axis='observation'))
+    if UNASSIGNED not in features and \
+            any(t.exists(UNASSIGNED, axis='observation') for t in tables):
+        features = features.append(pd.Index([UNASSIGNED]))
+
+    matrices = []
+    for table in tables:
+        rows = features.get_indexer(table.ids(axis='observation'))
+        if (rows < 0).any():
+            raise ValueError("The tables to stack do not share their "
+                             "features.")
+        matrix = table.matrix_data.tocoo()
+        matrices.append(ss.csr_matrix((matrix.data,
+                                       (rows[matrix.row], matrix.col)),
+                                      shape=(len(features), matrix.shape[1])))
+    return biom.Table(ss.hstack(matrices).tocsr(), list(features),
+                      [i for t in tables for i in t.ids()])
+
+
+def _alleged_positions(env_df, df, c, description):
+    # resolve each sample in env_df that is present in df to its row, and
+    # its alleged label to a column, so that lookups against df are a single
+    # position-based gather. samples absent from df (e.g., removed by
+    # rarefaction) are reported through the returned mask.
+    in_df = env_df.index.isin(df.index)
+    rows = df.index.get_indexer(env_df.index[in_df])
+    cols = df.columns.get_indexer(env_df.loc[in_df, c])
+    if (cols < 0).any():
+        missing = sorted(set(env_df.loc[in_df, c][cols < 0]))
+        raise KeyError("Environments not represented in the %s: %s"
+                       % (description, missing))
+    return in_df, rows, cols
 
 
 def _set_mislabeled(env_df, prob_df, c, alleged_min_probability):
@@ -199,38 +1220,30 @@ def _set_mislabeled(env_df, prob_df, c, alleged_min_probability):
     # reported environment type. note that care has to be taken with the
     # possibility that samples were removed from the input table due to the
     # rarefaction procedure.
-    env_df['alleged_probability'] = NOT_APPLICABLE
-    overlap = [i for i in env_df.index if i in prob_df.index]
-    env_df.loc[overlap, 'alleged_probability'] = \
-        [prob_df.loc[r.Index, getattr(r, c)]
-         for r in env_df.loc[overlap].itertuples()]
-    prob_below_min = \
-        env_df.loc[overlap, 'alleged_probability'] < alleged_min_probability
-
-    is_mislabeled = prob_below_min[prob_below_min]
-    is_not_mislabeled = prob_below_min[~prob_below_min]
-    env_df['Mislabeled'] = NOT_APPLICABLE
-    env_df.loc[is_mislabeled.index, 'Mislabeled'] = True
-    env_df.loc[is_not_mislabeled.index, 'Mislabeled'] = False
+    in_prob, rows, cols = _alleged_positions(env_df, prob_df, c,
+                                             'classifier probabilities')
+    probs = prob_df.to_numpy(dtype=float)[rows]
+    alleged = probs[np.arange(len(rows)), cols]
+
+    alleged_probability = np.full(len(env_df), NOT_APPLICABLE, dtype=object)
+    alleged_probability[in_prob] = alleged
+    env_df['alleged_probability'] = alleged_probability
+    prob_below_min = pd.Series(alleged < alleged_min_probability,
+                               index=env_df.index[in_prob],
+                               name='alleged_probability')
 
     # qiime2.Metadata cannot handle bool dtype which would occur if no
-    # samples are dropped from rarefaction
-    env_df['Mislabeled'] = env_df['Mislabeled'].astype(str)
+    # samples are dropped from rarefaction, so we store strings directly
+    mislabeled = np.full(len(env_df), NOT_APPLICABLE, dtype=object)
+    mislabeled[in_prob] = np.where(prob_below_min.values, 'True', 'False')
+    env_df['Mislabeled'] = mislabeled
 
     # record what we believe the correct label to be. for mislabeled samples,
     # pull the most probable label. For non-mislabeled samples, record the
     # original label
-    env_df['corrected_label'] = NOT_APPLICABLE
-    mislabeled = env_df[env_df['Mislabeled'] == 'True']
-    notmislabeled = env_df[env_df['Mislabeled'] == 'False']
-
-    env_df.loc[mislabeled.index, 'corrected_label'] = \
-        [prob_df.loc[r.Index].idxmax()
-         for r in env_df.loc[mislabeled.index].itertuples()]
-
-    env_df.loc[notmislabeled.index, 'corrected_label'] = \
-        [prob_df.loc[r.Index].idxmax()
-         for r in env_df.loc[notmislabeled.index].itertuples()]
+    corrected = np.full(len(env_df), NOT_APPLICABLE, dtype=object)
+    corrected[in_prob] = prob_df.columns.to_numpy()[probs.argmax(axis=1)]
+    env_df['corrected_label'] = corrected
 
     return prob_below_min
 
@@ -241,12 +1254,15 @@ def _set_contamination(env_df, proportions_df, c, prob_below_min,
     # environment type. note that care has to be taken with the possibility
     # that samples were removed from the input table due to the rarefaction
     # procedure.
-    env_df['min_proportion'] = NOT_APPLICABLE
-    overlap = [i for i in env_df.index if i in proportions_df.index]
-    env_df.loc[overlap, 'min_proportion'] = \
-        [proportions_df.loc[r.Index, getattr(r, c)]
-         for r in env_df.loc[overlap].itertuples()]
-    comm_below_min = env_df.loc[overlap, 'min_proportion'] < env_min_proportion
+    in_prop, rows, cols = _alleged_positions(env_df, proportions_df, c,
+                                             'source proportions')
+    overlap = env_df.index[in_prop]
+    proportions = proportions_df.to_numpy(dtype=float)[rows, cols]
+    comm_below_min = proportions < env_min_proportion
+
+    min_proportion = np.full(len(env_df), NOT_APPLICABLE, dtype=object)
+    min_proportion[in_prop] = proportions
+    env_df['min_proportion'] = min_proportion
 
     # From the HMP SOP
     # Add 'Mislabeled' column to the final mapping file, with 'NA' (n.b., we
@@ -255,13 +1271,12 @@ def _set_contamination(env_df, proportions_df, c, prob_below_min,
     # alleged label was < .25, 'FALSE' otherwise. Add 'Contaminated' column
     # with 'NA' when 'Mislabeled' is 'TRUE' or 'NA', 'TRUE' when 'Mislabeled'
     # is FALSE and 'Max_Proportion_this_Env' < .6, and 'FALSE' otherwise.
-    is_mislabeled = prob_below_min[prob_below_min]
-    env_df['Contaminated'] = False
-    env_df.loc[is_mislabeled.index, 'Contaminated'] = NOT_APPLICABLE
-    contaminated = comm_below_min & (~prob_below_min.loc[overlap])
-    contaminated_samples = contaminated[contaminated]
-    env_df.loc[contaminated_samples.index, 'Contaminated'] = True
-
-    # qiime2.Metadata cannot handle bool, which would happen in an unusual
-    # edge case here but let's protect ourselves anyway
-    env_df['Contaminated'] = env_df['Contaminated'].astype(str)
+    is_mislabeled = prob_below_min.index[prob_below_min.to_numpy(dtype=bool)]
+    overlap_mislabeled = prob_below_min.loc[overlap].to_numpy(dtype=bool)
+    contaminated = comm_below_min & ~overlap_mislabeled
+
+    # qiime2.Metadata cannot handle bool, so the flags are stored as strings
+    flags = np.full(len(env_df), 'False', dtype=object)
+    flags[env_df.index.isin(is_mislabeled)] = NOT_APPLICABLE
+    flags[np.flatnonzero(in_prop)[contaminated]] = 'True'
+    env_df['Contaminated'] = flags
@@ -0,0 +1,66 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import h5py
+import numpy as np
+import pandas as pd
+from q2_types.feature_table import BIOMV210Format
+
+
+class TableProbe:
+    """The dimensions, ids and sample totals of a BIOM table, read from its
+    file
+
+    Building a biom.Table reads every id, the metadata and the whole matrix.
+    The dimensions are instead read from the attributes of the BIOM HDF5
+    file, and the sample totals from the values and offsets of its
+    sample-major matrix only.
+
+    Parameters
+    ----------
+    table : qiime2.Artifact, BIOMV210Format or str
+        A feature table artifact, or its BIOM file or the path to it.
+    """
+    def __init__(self, table):
+        if hasattr(table, 'view'):
+            table = table.view(BIOMV210Format)
+        self.path = str(table)
+
+    @property
+    def shape(self):
+        """The number of features and samples, as biom.Table.shape"""
+        with h5py.File(self.path, 'r') as fh:
+            nfeat, nsamp = fh.attrs['shape']
+        return int(nfeat), int(nsamp)
+
+    def feature_ids(self):
+        """The ids of the features, in the order of the table"""
+        with h5py.File(self.path, 'r') as fh:
+            return _ids(fh['observation/ids'])
+
+    def sample_ids(self):
+        """The ids of the samples, in the order of the table"""
+        with h5py.File(self.path, 'r') as fh:
+            return _ids(fh['sample/ids'])
+
+    def sample_totals(self):
+        """The total count of each sample, as a pd.Series"""
+        with h5py.File(self.path, 'r') as fh:
+            ids = _ids(fh['sample/ids'])
+            data = fh['sample/matrix/data'][:]
+            indptr = fh['sample/matrix/indptr'][:]
+        samples = np.repeat(np.arange(len(ids)), np.diff(indptr))
+        totals = np.bincount(samples, weights=data, minlength=len(ids))
+        return pd.Series(totals, index=pd.Index(ids))
+
+
+def _ids(dataset):
+    # the ids are stored as variable length strings, which h5py reads as
+    # bytes
+    return np.array([i.decode('utf8') if isinstance(i, bytes) else i
+                     for i in dataset[:]], dtype=object)
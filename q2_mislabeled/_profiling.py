@@ -0,0 +1,187 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import resource
+import sys
+import time
+
+import biom
+import pandas as pd
+
+from ._probe import TableProbe
+
+METRICS_COLUMNS = ['stage', 'wall_time_s', 'cpu_time_s', 'peak_rss_mb',
+                   'input_samples', 'input_features', 'output_samples',
+                   'output_features']
+
+# the OpenMetrics metric families exported for each stage, as
+# (name, column, unit, help)
+OPENMETRICS_FAMILIES = [
+    ('q2_mislabeled_stage_wall_time_seconds', 'wall_time_s', 'seconds',
+     'Wall time spent in the stage'),
+    ('q2_mislabeled_stage_cpu_time_seconds', 'cpu_time_s', 'seconds',
+     'CPU time spent in the stage, including reaped child processes'),
+    ('q2_mislabeled_stage_peak_rss_bytes', 'peak_rss_mb', 'bytes',
+     'Peak resident set size of the process by the end of the stage'),
+    ('q2_mislabeled_stage_output_samples', 'output_samples', None,
+     'Number of samples in the table produced by the stage'),
+    ('q2_mislabeled_stage_output_features', 'output_features', None,
+     'Number of features in the table produced by the stage')]
+
+
+class StageRecorder:
+    """Record the cost of each stage of a pipeline
+
+    Each stage records its wall time, its CPU time, the peak resident set
+    size of the process (and of any child processes it has waited on) when
+    it completed, and the dimensions of the table it consumed and produced.
+
+    Note that the peak resident set size is a high-water mark for the whole
+    process, so it only increases from one stage to the next.
+
+    With a checkpoint, the outputs of the actions wrapped are persisted, and
+    are loaded rather than recomputed when the pipeline is run again.
+    """
+    def __init__(self, parallel=False, checkpoint=None):
+        # with parallel pipeline execution, actions return before they have
+        # run and their inputs may not exist yet, so table dimensions are not
+        # recorded as inspecting them would wait on the actions
+        self.parallel = parallel
+        self.checkpoint = checkpoint
+        self.records = []
+
+    def wrap(self, name, action):
+        """Record every call of action as a stage called name"""
+        if self.checkpoint is not None:
+            action = self.checkpoint.wrap(name, action)
+
+        def wrapped(*args, **kwargs):
+            return self.run(name, action, *args, **kwargs)
+        return wrapped
+
+    def run(self, name, func, *args, **kwargs):
+        """Call func with args and kwargs, recording it as a stage"""
+        if self.parallel:
+            in_samples, in_features = None, None
+        else:
+            in_samples, in_features = _first_dimensions(args)
+
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        result = func(*args, **kwargs)
+        wall = time.perf_counter() - start_wall
+        cpu = _cpu_time() - start_cpu
+
+        if self.parallel:
+            out_samples, out_features = None, None
+        elif isinstance(result, tuple):
+            out_samples, out_features = _first_dimensions(result)
+        else:
+            out_samples, out_features = _dimensions(result)
+
+        self.records.append({'stage': name,
+                             'wall_time_s': wall,
+                             'cpu_time_s': cpu,
+                             'peak_rss_mb': _peak_rss_mb(),
+                             'input_samples': in_samples,
+                             'input_features': in_features,
+                             'output_samples': out_samples,
+                             'output_features': out_features})
+        return result
+
+    def to_dataframe(self):
+        """The recorded stages, indexed by their order of execution"""
+        df = pd.DataFrame(self.records, columns=METRICS_COLUMNS)
+        df.index = pd.Index(['%03d' % (i + 1) for i in range(len(df))],
+                            name='id')
+        return df
+
+
+def to_openmetrics(df):
+    """Express stage metrics in the OpenMetrics text format
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Stage metrics, as produced by StageRecorder.to_dataframe.
+
+    Returns
+    -------
+    str
+        The metrics, suitable for the node exporter's textfile collector.
+    """
+    lines = []
+    for name, column, unit, help_ in OPENMETRICS_FAMILIES:
+        lines.append('# HELP %s %s.' % (name, help_))
+        lines.append('# TYPE %s gauge' % name)
+        if unit is not None:
+            lines.append('# UNIT %s %s' % (name, unit))
+
+        for step, row in df.iterrows():
+            value = row[column]
+            if pd.isnull(value):
+                continue
+            value = float(value)
+            if column == 'peak_rss_mb':
+                value *= 1024 * 1024
+
+            lines.append('%s{step="%s",stage="%s"} %r'
+                         % (name, _escape(step), _escape(row['stage']),
+                            value))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _cpu_time():
+    # the CPU time of this process, and of the child processes it reaped
+    times = os.times()
+    return (times.user + times.system +
+            times.children_user + times.children_system)
+
+
+def _peak_rss_mb():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def _first_dimensions(objs):
+    for obj in objs:
+        dims = _dimensions(obj)
+        if dims != (None, None):
+            return dims
+    return None, None
+
+
+def _dimensions(obj):
+    # the number of samples and features of a table, or the rows and columns
+    # of a data frame. feature table artifacts are measured from the shape
+    # stored in their BIOM file, so they are not loaded
+    if isinstance(obj, biom.Table):
+        nfeat, nsamp = obj.shape
+        return nsamp, nfeat
+    if isinstance(obj, pd.DataFrame):
+        return obj.shape
+
+    type_ = getattr(obj, 'type', None)
+    if type_ is not None and str(type_).startswith('FeatureTable'):
+        nfeat, nsamp = TableProbe(obj).shape
+        return nsamp, nfeat
+
+    return None, None
@@ -0,0 +1,208 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import scipy.sparse as ss
+import biom
+
+# the number of samples drawn together from a single random stream
+BATCH_SIZE = 512
+
+
+def rarefy(table, sampling_depth, n_jobs=1, random_state=None):
+    """Rarefy a table without replacement, in process
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table to rarefy.
+    sampling_depth : int
+        The number of counts to draw from each sample. Samples with fewer
+        counts are removed.
+    n_jobs : int, optional
+        The number of worker processes to shard the samples across.
+    random_state : int, optional
+        The seed for the random number generators. Samples are drawn in
+        fixed-size batches, each with its own stream derived from this seed
+        and the position of the batch, so a given seed gives the same result
+        for any n_jobs.
+
+    Raises
+    ------
+    ValueError
+        If the table does not contain integer counts, or if no samples
+        remain after rarefaction.
+
+    Returns
+    -------
+    biom.Table
+        The rarefied table, without features which are no longer observed.
+    """
+    return _rarefy(table, sampling_depth, 1, n_jobs, random_state)
+
+
+def rarefy_filter(table, sampling_depth, min_samples, n_jobs=1,
+                  random_state=None):
+    """Remove rare features, rarefy, and remove rare features again
+
+    This is the same as filtering the features observed in fewer than
+    min_samples samples, rarefying, and filtering again, as the HMP SOP
+    prepares the SourceTracker table. However, the prevalence of each
+    feature is counted from the nonzero entries of the sparse matrix, and
+    the rare features are dropped from those entries, so only the final
+    table is built.
+
+    Parameters
+    ----------
+    table : biom.Table
+        The table to rarefy.
+    sampling_depth : int
+        The number of counts to draw from each sample. Samples with fewer
+        counts, once the rare features are removed, are removed.
+    min_samples : int
+        The number of samples a feature must be observed in to be kept,
+        both before and after rarefying.
+    n_jobs : int, optional
+        The number of worker processes to shard the samples across.
+    random_state : int, optional
+        The seed for the random number generators, as with rarefy.
+
+    Raises
+    ------
+    ValueError
+        If the table does not contain integer counts, or if no samples
+        remain after rarefaction.
+
+    Returns
+    -------
+    biom.Table
+        The rarefied table, without rare features.
+    """
+    return _rarefy(table, sampling_depth, min_samples, n_jobs, random_state)
+
+
+def _rarefy(table, sampling_depth, min_samples, n_jobs, random_state):
+    # samples are columns, so CSC gives us each sample as a contiguous slice
+    matrix = table.matrix_data.tocsc()
+    if not np.array_equal(matrix.data, np.floor(matrix.data)):
+        raise ValueError("The table must contain integer counts to be "
+                         "rarefied.")
+
+    if min_samples > 1:
+        matrix = _drop_rare(matrix, min_samples)
+
+    totals = np.asarray(matrix.sum(axis=0)).ravel()
+    keep = np.flatnonzero(totals >= sampling_depth)
+    if len(keep) == 0:
+        raise ValueError("The rarefied table contains no samples. Verify "
+                         "that you provided a shallow enough sampling "
+                         "depth.")
+
+    matrix = matrix[:, keep]
+    entropy = np.random.SeedSequence(random_state).entropy
+
+    # batches are the unit of randomness, and shards are contiguous runs of
+    # batches. each shard only needs its counts and column boundaries, as
+    # the sparsity structure is unchanged by subsampling aside from zeros
+    # which are eliminated afterwards
+    n_batches = -(-len(keep) // BATCH_SIZE)
+    n_shards = max(1, min(n_jobs, n_batches))
+    bounds = np.linspace(0, n_batches, n_shards + 1).astype(int)
+    shards = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        first = lo * BATCH_SIZE
+        last = min(hi * BATCH_SIZE, len(keep))
+        start, stop = matrix.indptr[first], matrix.indptr[last]
+        shards.append((matrix.data[start:stop],
+                       matrix.indptr[first:last + 1] - start,
+                       totals[keep[first:last]], lo, sampling_depth,
+                       entropy))
+
+    if n_shards == 1:
+        counts = [_rarefy_shard(*shards[0])]
+    else:
+        with ProcessPoolExecutor(max_workers=n_shards) as pool:
+            counts = list(pool.map(_rarefy_shard, *zip(*shards)))
+
+    matrix.data = np.concatenate(counts).astype(float)
+    matrix.eliminate_zeros()
+
+    # the prevalence of each feature is its number of nonzero entries
+    prevalence = np.bincount(matrix.indices, minlength=matrix.shape[0])
+    observed = np.flatnonzero(prevalence >= max(min_samples, 1))
+    matrix = matrix[observed]
+
+    obs_md = table.metadata(axis='observation')
+    samp_md = table.metadata(axis='sample')
+    return biom.Table(matrix,
+                      table.ids(axis='observation')[observed],
+                      table.ids()[keep],
+                      None if obs_md is None else [obs_md[i]
+                                                   for i in observed],
+                      None if samp_md is None else [samp_md[i]
+                                                    for i in keep])
+
+
+def _drop_rare(matrix, min_samples):
+    # drop the entries of the features observed in fewer than min_samples
+    # samples from a CSC matrix. the features are kept as rows, so that they
+    # are only removed once the final table is built
+    prevalence = np.bincount(matrix.indices, minlength=matrix.shape[0])
+    kept = (prevalence >= min_samples)[matrix.indices]
+    columns = np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+    indptr = np.r_[0, np.cumsum(np.bincount(columns[kept],
+                                            minlength=matrix.shape[1]))]
+    return ss.csc_matrix((matrix.data[kept], matrix.indices[kept], indptr),
+                         shape=matrix.shape)
+
+
+def _rarefy_shard(data, indptr, totals, first_batch, sampling_depth,
+                  entropy):
+    counts = np.empty(len(data), dtype=np.int64)
+    for i, lo in enumerate(range(0, len(indptr) - 1, BATCH_SIZE)):
+        hi = min(lo + BATCH_SIZE, len(indptr) - 1)
+        seed = np.random.SeedSequence(entropy,
+                                      spawn_key=(first_batch + i, ))
+        start, stop = indptr[lo], indptr[hi]
+        counts[start:stop] = _rarefy_batch(data[start:stop],
+                                           indptr[lo:hi + 1] - start,
+                                           totals[lo:hi], sampling_depth,
+                                           np.random.default_rng(seed))
+    return counts
+
+
+def _rarefy_batch(data, indptr, totals, sampling_depth, rng):
+    # draw sampling_depth counts without replacement from each column. a
+    # multivariate hypergeometric draw is a sequence of univariate draws,
+    # one per feature, conditioned on the counts and draws remaining. we
+    # take the j-th draw for every column in the batch at once, ordering the
+    # columns by their number of features so the columns with a j-th
+    # feature are always a prefix.
+    data = data.astype(np.int64)
+    nnz = np.diff(indptr)
+    order = np.argsort(-nnz, kind='stable')
+    starts = indptr[:-1][order]
+    nnz = nnz[order]
+    remaining = totals[order].astype(np.int64)
+    draws = np.full(len(nnz), sampling_depth, dtype=np.int64)
+
+    counts = np.empty(len(data), dtype=np.int64)
+    active = len(nnz)
+    for j in range(nnz[0] if len(nnz) else 0):
+        while nnz[active - 1] <= j:
+            active -= 1
+        positions = starts[:active] + j
+        good = data[positions]
+        bad = remaining[:active] - good
+        drawn = rng.hypergeometric(good, bad, draws[:active])
+        counts[positions] = drawn
+        remaining[:active] = bad
+        draws[:active] -= drawn
+    return counts
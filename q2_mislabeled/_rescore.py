@@ -0,0 +1,56 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import itertools
+from typing import Dict
+
+import pandas as pd
+import qiime2
+
+from ._pipelines import _set_mislabeled, _set_contamination
+
+
+def rescore(probabilities: pd.DataFrame, proportions: pd.DataFrame,
+            env: qiime2.CategoricalMetadataColumn,
+            alleged_min_probability: float = 0.25,
+            env_min_proportion: float = 0.6) -> pd.DataFrame:
+    return _rescore(env.to_dataframe(), probabilities, proportions,
+                    alleged_min_probability, env_min_proportion)
+
+
+def rescore_grid(probabilities: pd.DataFrame, proportions: pd.DataFrame,
+                 env: qiime2.CategoricalMetadataColumn,
+                 alleged_min_probabilities: list,
+                 env_min_proportions: list) -> Dict[str, pd.DataFrame]:
+    env_df = env.to_dataframe()
+    return {key: _rescore(env_df, probabilities, proportions,
+                          alleged_min_probability, env_min_proportion)
+            for key, alleged_min_probability, env_min_proportion
+            in _threshold_pairs(alleged_min_probabilities,
+                                env_min_proportions)}
+
+
+def _rescore(env_df, prob_df, proportions_df, alleged_min_probability,
+             env_min_proportion):
+    # only the thresholds are applied here, so the columns are set on a copy
+    # to let a grid share the inputs
+    env_df = env_df.copy()
+    c = env_df.columns[0]
+    prob_below_min = _set_mislabeled(env_df, prob_df, c,
+                                     alleged_min_probability)
+    _set_contamination(env_df, proportions_df, c, prob_below_min,
+                       env_min_proportion)
+    return env_df
+
+
+def _threshold_pairs(alleged_min_probabilities, env_min_proportions):
+    # every pair of thresholds, keyed for the output collection
+    for alleged_min_probability, env_min_proportion in itertools.product(
+            alleged_min_probabilities, env_min_proportions):
+        key = '%s_%s' % (alleged_min_probability, env_min_proportion)
+        yield key, alleged_min_probability, env_min_proportion
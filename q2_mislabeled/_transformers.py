@@ -9,7 +9,8 @@ from qiime2 import Metadata
 
 from .plugin_setup import plugin
 import pandas as pd
-from ._format import TSVFormat
+from ._format import TSVFormat, StageMetricsFormat, OpenMetricsFormat
+from ._profiling import METRICS_COLUMNS, to_openmetrics
 
 
 @plugin.register_transformer
@@ -20,6 +21,11 @@ def _1(ff: TSVFormat) -> pd.DataFrame:
                                               errors='coerce')
     df['min_proportion'] = pd.to_numeric(df['min_proportion'],
                                          errors='coerce')
+
+    # the spread over rarefactions, with more than one rarefaction
+    for column in ('alleged_probability_std', 'min_proportion_std'):
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
     return df
 
 
@@ -34,3 +40,31 @@ def _2(data: pd.DataFrame) -> TSVFormat:
 @plugin.register_transformer
 def _3(ff: TSVFormat) -> Metadata:
     return Metadata.load(str(ff))
+
+
+@plugin.register_transformer
+def _4(data: pd.DataFrame) -> StageMetricsFormat:
+    ff = StageMetricsFormat()
+    with ff.open() as fh:
+        data[METRICS_COLUMNS].to_csv(fh, sep='\t', index=True, header=True)
+    return ff
+
+
+@plugin.register_transformer
+def _5(ff: StageMetricsFormat) -> pd.DataFrame:
+    with ff.open() as fh:
+        df = pd.read_csv(fh, sep='\t', dtype={'id': str}).set_index('id')
+    return df
+
+
+@plugin.register_transformer
+def _6(ff: StageMetricsFormat) -> Metadata:
+    return Metadata(_5(ff))
+
+
+@plugin.register_transformer
+def _7(ff: StageMetricsFormat) -> OpenMetricsFormat:
+    out = OpenMetricsFormat()
+    with out.open() as fh:
+        fh.write(to_openmetrics(_5(ff)))
+    return out
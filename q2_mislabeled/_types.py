@@ -11,3 +11,7 @@ from q2_types.sample_data import SampleData
 
 Mislabeled = SemanticType('Mislabeled',
                           variant_of=SampleData.field['type'])
+
+ReferenceBundle = SemanticType('ReferenceBundle')
+
+StageMetrics = SemanticType('StageMetrics')
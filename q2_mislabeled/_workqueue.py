@@ -0,0 +1,279 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+"""A work queue shared through a directory.
+
+Workers on other machines which share the directory can join a queue with
+
+    $ python -m q2_mislabeled._workqueue DIRECTORY --wait 600
+
+The directory must be trusted. Whoever can write to it can queue tasks,
+which every worker runs, and alter the inputs and results of the tasks.
+Tasks are limited to the functions of this package marked with task, and
+are stored as JSON rather than pickles, but their arguments are still taken
+as given. The queue creates its directories readable only by their owner.
+"""
+import argparse
+import contextlib
+import importlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+TASKS = 'tasks'
+CLAIMED = 'claimed'
+RESULTS = 'results'
+
+# the seconds to wait between checks of the directory
+POLL = 0.1
+# the seconds between the refreshes of the claim of a running task
+HEARTBEAT = 10
+
+
+class WorkQueue:
+    """Tasks, and their results, shared through a directory
+
+    A task is the name of a function marked with task and its arguments,
+    written as JSON to the tasks directory, so the arguments and the result
+    must be serializable as JSON. A worker claims a task by
+    renaming it into the claimed directory. Renaming is atomic, including
+    on a shared filesystem, so each task is claimed by one worker. The
+    result, or the traceback of the exception the task raised, is written
+    to the results directory once the task completes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        for name in (TASKS, CLAIMED, RESULTS):
+            os.makedirs(os.path.join(directory, name), mode=0o700,
+                        exist_ok=True)
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, name)
+
+    def submit(self, func, *args):
+        """Queue a call of func with args, returning the name of the task"""
+        if not getattr(func, '_task', False):
+            raise ValueError("%r is not a task of the work queue." % func)
+        name = uuid.uuid4().hex
+        self._write(self._path(TASKS, name),
+                    {'task': '%s:%s' % (func.__module__, func.__qualname__),
+                     'args': args})
+        return name
+
+    def claim(self):
+        """Claim the next task, returning its name, or None if none are
+        left"""
+        for name in sorted(os.listdir(os.path.join(self.directory, TASKS))):
+            claimed = self._path(CLAIMED, name)
+            try:
+                os.rename(self._path(TASKS, name), claimed)
+            except FileNotFoundError:
+                # another worker claimed it first
+                continue
+
+            # the claim is dated from when it was made, so that claims of
+            # workers which stopped can be found
+            os.utime(claimed)
+            return name
+        return None
+
+    def run(self, name):
+        """Run a claimed task, and write its result"""
+        claimed = self._path(CLAIMED, name)
+        with open(claimed) as fh:
+            spec = json.load(fh)
+
+        # the claim is refreshed while the task runs, so that only the claims
+        # of workers which stopped outlive a lease, however long tasks take
+        done = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat, args=(claimed, done),
+                                     daemon=True)
+        heartbeat.start()
+        try:
+            func = _task_function(spec['task'])
+            result = {'completed': True, 'result': func(*spec['args'])}
+            # a result which is not serializable fails the task
+            json.dumps(result)
+        except Exception:
+            # the exception itself may not be serializable
+            result = {'completed': False, 'result': traceback.format_exc()}
+        finally:
+            done.set()
+            heartbeat.join()
+        self._write(self._path(RESULTS, name), result)
+
+        # a task which outlived its lease may have been claimed again
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(CLAIMED, name))
+
+    def work(self, wait=0):
+        """Run tasks until none have been left for wait seconds, returning
+        the number run"""
+        n_run = 0
+        idle = time.monotonic()
+        while True:
+            name = self.claim()
+            if name is not None:
+                self.run(name)
+                n_run += 1
+                idle = time.monotonic()
+            elif time.monotonic() - idle >= wait:
+                return n_run
+            else:
+                time.sleep(POLL)
+
+    def gather(self, names, lease=None, timeout=None):
+        """Wait for the results of the tasks called names, and return them
+
+        While waiting, this process runs tasks as well, so the tasks are
+        completed even without any other worker.
+
+        Parameters
+        ----------
+        names : list of str
+            The tasks, as returned by submit.
+        lease : float, optional
+            The seconds after which a task claimed by a worker, and not yet
+            completed, is returned to the queue if the worker has stopped
+            refreshing its claim. Workers refresh their claims every
+            HEARTBEAT seconds, so this should be well above it. By default,
+            workers are assumed to complete every task they claim.
+        timeout : float, optional
+            The seconds to wait for the results.
+
+        Returns
+        -------
+        list
+            The result of each task, in the order of names.
+
+        Raises
+        ------
+        RuntimeError
+            If a task raised an exception.
+        TimeoutError
+            If the results are not gathered within timeout seconds.
+        """
+        start = time.monotonic()
+        results = {}
+        while len(results) < len(names):
+            claimed = self.claim()
+            if claimed is not None:
+                self.run(claimed)
+
+            for name in names:
+                path = self._path(RESULTS, name)
+                if name in results or not os.path.exists(path):
+                    continue
+                with open(path) as fh:
+                    result = json.load(fh)
+                os.remove(path)
+                if not result['completed']:
+                    raise RuntimeError("A task of the work queue in %s "
+                                       "failed:\n%s"
+                                       % (self.directory, result['result']))
+                results[name] = result['result']
+
+            if lease is not None:
+                self._release(set(names) - set(results), lease)
+            if timeout is not None and time.monotonic() - start > timeout:
+                raise TimeoutError("The tasks of the work queue in %s were "
+                                   "not completed within %s seconds."
+                                   % (self.directory, timeout))
+            if claimed is None and len(results) < len(names):
+                time.sleep(POLL)
+        return [results[name] for name in names]
+
+    def _release(self, names, lease):
+        # return the tasks claimed more than lease seconds ago to the queue
+        for name in names:
+            claimed = self._path(CLAIMED, name)
+            try:
+                if time.time() - os.path.getmtime(claimed) > lease:
+                    os.rename(claimed, self._path(TASKS, name))
+            except FileNotFoundError:
+                # not claimed, or completed meanwhile
+                continue
+
+    def _write(self, path, obj):
+        # write to a temporary file which is then renamed, so that the file
+        # is never seen partially written
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as fh:
+            json.dump(obj, fh)
+        os.rename(tmp, path)
+
+
+def task(func):
+    """Mark func, a function of this package, as a task which workers may
+    run"""
+    func._task = True
+    return func
+
+
+def _task_function(name):
+    # the function a task names, if it is marked as a task. the module is
+    # only imported if it is of this package
+    module, _, qualname = name.partition(':')
+    package = __name__.split('.')[0]
+    func = None
+    if module == package or module.startswith(package + '.'):
+        func = getattr(importlib.import_module(module), qualname, None)
+    if not getattr(func, '_task', False):
+        raise ValueError("%r is not a task of the work queue." % name)
+    return func
+
+
+@contextlib.contextmanager
+def local_workers(directory, n_workers):
+    """Run workers on the queue in directory in n_workers processes of this
+    machine, until the tasks queued when they started are completed"""
+    processes = [multiprocessing.Process(target=_work, args=(directory, ))
+                 for _ in range(n_workers)]
+    for process in processes:
+        process.start()
+    try:
+        yield
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+
+
+def _heartbeat(claimed, done):
+    # date the claim from now, until the task is done
+    while not done.wait(HEARTBEAT):
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(claimed)
+
+
+def _work(directory, wait=0):
+    return WorkQueue(directory).work(wait=wait)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the tasks of a work queue shared through a "
+                    "directory.")
+    parser.add_argument('directory')
+    parser.add_argument('--wait', type=float, default=0,
+                        help="The seconds to wait for new tasks once the "
+                             "queue is empty.")
+    args = parser.parse_args(argv)
+    n_run = _work(args.directory, args.wait)
+    print("Ran %d tasks" % n_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,87 @@
 # ----------------------------------------------------------------------------
 
 import importlib
-from qiime2.plugin import Plugin, MetadataColumn, Float, Categorical, Int
-from q2_types.feature_table import FeatureTable, Frequency
+from qiime2.plugin import (Plugin, Metadata, MetadataColumn, Float,
+                           Categorical, Int, Str, Choices, Collection, Range,
+                           List)
+from q2_types.feature_table import FeatureTable, Frequency, RelativeFrequency
 from q2_types.sample_data import SampleData
+from q2_sample_classifier import Probabilities
 
-from ._types import Mislabeled
-from ._format import TSVDirectoryFormat
+from ._types import Mislabeled, ReferenceBundle, StageMetrics
+from ._format import (TSVDirectoryFormat, ReferenceBundleDirectoryFormat,
+                      JSONFormat, EstimatorArchiveFormat, NpyFormat,
+                      StageMetricsFormat, StageMetricsDirectoryFormat,
+                      OpenMetricsFormat)
+from ._engines import (PREPROCESSING, RAREFACTION_ENGINES,
+                       CONTAMINATION_ENGINES, CLASSIFIER_ENGINES,
+                       FOCUS_FEATURES)
 import q2_mislabeled
+from . import _actions
 
+_preprocessing_description = (
+    'How to prepare the tables for classification and source tracking. '
+    '"hmp" follows the HMP SOP, rarefying and filtering separately for each '
+    'stage. "shared" rarefies and filters once, and uses the resulting '
+    'table for both stages.')
+_rarefaction_engine_description = (
+    'How to rarefy. "feature-table" uses the q2-feature-table rarefy action. '
+    '"in-process" rarefies the tables within this plugin, sharding samples '
+    'across n_jobs processes, and is reproducible for a given random_state '
+    'regardless of n_jobs. It also prepares the SourceTracker table of the '
+    '"hmp" preprocessing, removing rare features before and after '
+    'rarefying, in a single pass.')
+_contamination_engine_description = (
+    'How to estimate the environment proportions of each sample. "gibbs" '
+    'uses the SourceTracker2 gibbs action. "mixture" fits each sample as a '
+    'mixture of the pooled profiles of the source environments and an '
+    'unknown source, in process and for all samples at once, which is much '
+    'faster but does not sample the posterior.')
+_classifier_engine_description = (
+    'How to estimate the probability of each sample\'s label. '
+    '"random-forest" uses the q2-sample-classifier classify-samples-ncv '
+    'action. "logistic" uses an L2 regularized logistic regression on the '
+    'square root of the relative abundances, cross-validated in process '
+    'across n_jobs processes, which is much faster on wide tables. '
+    '"naive-bayes" scores each sample with a multinomial naive Bayes model '
+    'of all of the other samples, computed exactly for every sample at '
+    'once. It is the fastest, and is suited to screening, but flags more '
+    'correctly labeled samples than the other engines.')
+_chunk_size_description = (
+    'The number of focus samples to classify and source track at a time. '
+    'Smaller chunks bound the memory used, and each chunk is assessed '
+    'against the full reference. By default, all focus samples are assessed '
+    'at once.')
+_focus_features_description = (
+    'How the features of the focus samples are matched to those of the '
+    'reference for source tracking. "merge" merges the focus and reference '
+    'tables over the union of their features. "drop" projects the focus '
+    'samples onto the reference features, dropping the features the '
+    'reference does not have, and "pool" instead sums those features into '
+    'one "unassigned" feature. Projecting avoids merging the tables, and '
+    'keeps the SourceTracker input to the reference features. Counts '
+    'dropped by "drop" are no longer attributed to the unknown source, so '
+    '"pool" stays closer to "merge". Focus samples left without counts by '
+    '"drop" are not source tracked.')
+_random_state_description = (
+    'Seed used by the random number generators of the rarefaction and '
+    'classification steps.')
+_probabilities_description = (
+    'The probability of each environment for each sample, from '
+    'classification. Use with rescore to apply other thresholds.')
+_proportions_description = (
+    'The proportion of each sample attributed to each environment, from '
+    'source tracking. Use with rescore to apply other thresholds.')
+_checkpoint_dir_description = (
+    'A directory to save the outputs of each stage to. If the pipeline is '
+    'run again with the same inputs and parameters and the same directory, '
+    'for instance after it failed, the stages which completed are loaded '
+    'rather than run again. With parallel execution, each stage is waited '
+    'on so that it can be saved. By default, nothing is saved.')
+_stage_metrics_description = (
+    'The wall time, CPU time, peak memory and table dimensions of each stage '
+    'of the pipeline. Export with --output-format OpenMetricsFormat for the '
+    'OpenMetrics text format.')
 
 plugin = Plugin(
     name='mislabeled',
@@ -25,25 +98,59 @@ plugin = Plugin(
     short_description="Methods for identifying mislabeled samples"
 )
 
-plugin.register_semantic_types(Mislabeled)
-plugin.register_formats(TSVDirectoryFormat)
+plugin.register_semantic_types(Mislabeled, ReferenceBundle, StageMetrics)
+plugin.register_formats(TSVDirectoryFormat, ReferenceBundleDirectoryFormat,
+                        JSONFormat, EstimatorArchiveFormat, NpyFormat,
+                        StageMetricsFormat, StageMetricsDirectoryFormat,
+                        OpenMetricsFormat)
 plugin.register_artifact_class(
     SampleData[Mislabeled],
     directory_format=TSVDirectoryFormat)
+plugin.register_artifact_class(
+    ReferenceBundle,
+    directory_format=ReferenceBundleDirectoryFormat)
+plugin.register_artifact_class(
+    StageMetrics,
+    directory_format=StageMetricsDirectoryFormat)
 
 plugin.pipelines.register_function(
     name="Mislabelings within dataset",
     description="Identify mislabelings and contaminated samples within a "
                 "specific dataset based on the HMP SOP",
-    function=q2_mislabeled.within_dataset,
-    inputs={'table': FeatureTable[Frequency]},
+    function=_actions.within_dataset,
+    inputs={'table': FeatureTable[Frequency],
+            'previous_probabilities': SampleData[Probabilities],
+            'previous_proportions': FeatureTable[RelativeFrequency]},
     parameters={'alleged_min_probability': Float,
                 'env_min_proportion': Float,
                 'env': MetadataColumn[Categorical],
                 'n_jobs': Int,
-                'sampling_depth': Int},
-    outputs=[('mislabelings', SampleData[Mislabeled])],
-    input_descriptions={'table': 'The feature table to examine'},
+                'sampling_depth': Int,
+                'preprocessing': Str % Choices(PREPROCESSING),
+                'rarefaction_engine': Str % Choices(RAREFACTION_ENGINES),
+                'contamination_engine': Str % Choices(CONTAMINATION_ENGINES),
+                'classifier_engine': Str % Choices(CLASSIFIER_ENGINES),
+                'random_state': Int,
+                'refresh_fraction': Float % Range(0, None),
+                'checkpoint_dir': Str,
+                'n_rarefactions': Int % Range(1, None),
+                'loo_shards': Int % Range(1, None),
+                'work_dir': Str,
+                'shard_lease': Float % Range(0, None,
+                                             inclusive_start=False)},
+    outputs=[('mislabelings', SampleData[Mislabeled]),
+             ('probabilities', SampleData[Probabilities]),
+             ('proportions', FeatureTable[RelativeFrequency]),
+             ('stage_metrics', StageMetrics)],
+    input_descriptions={
+        'table': 'The feature table to examine',
+        'previous_probabilities': 'The probabilities output by a previous '
+                                  'run on an earlier version of the table. '
+                                  'If provided, only the samples added since '
+                                  'are classified and source tracked, unless '
+                                  'refresh_fraction is exceeded.',
+        'previous_proportions': 'The proportions output by the same previous '
+                                'run. Required with previous_probabilities.'},
     parameter_descriptions={
         'alleged_min_probability': 'The minimum probability a sample must '
                                    'must have from classification to be '
@@ -54,16 +161,113 @@ plugin.pipelines.register_function(
         'env': 'The column in the metadata with the variable to assess '
                'mislabelings with',
         'n_jobs': 'The number of CPUs to use',
-        'sampling_depth': 'The rarefaction level to use'},
+        'sampling_depth': 'The rarefaction level to use',
+        'preprocessing': _preprocessing_description,
+        'rarefaction_engine': _rarefaction_engine_description,
+        'contamination_engine': _contamination_engine_description,
+        'classifier_engine': _classifier_engine_description,
+        'random_state': _random_state_description,
+        'refresh_fraction': 'With the results of a previous run, every '
+                            'sample is assessed again if the samples added '
+                            'to any environment are more than this fraction '
+                            'of the samples it had, or if an environment is '
+                            'new. Otherwise, the new samples are classified '
+                            'by a model of the previous samples, and source '
+                            'tracked against them.',
+        'checkpoint_dir': _checkpoint_dir_description,
+        'n_rarefactions': 'The number of times to rarefy the table, each '
+                          'with its own seed. Each rarefaction is '
+                          'classified and source tracked, concurrently with '
+                          'parallel execution, and the mean probabilities '
+                          'and proportions are reported. The mislabelings '
+                          'then also report the standard deviation over the '
+                          'rarefactions of the alleged probability and the '
+                          'minimum proportion.',
+        'loo_shards': 'The number of shards to split the samples source '
+                      'tracked with leave one out into. Each sample is still '
+                      'assessed against all of the others, and the shards '
+                      'are run by n_jobs processes, and by any workers '
+                      'sharing work_dir.',
+        'work_dir': 'A directory to queue the shards in. Workers on other '
+                    'machines sharing the directory run shards with '
+                    '"python -m q2_mislabeled._workqueue DIRECTORY". By '
+                    'default, a temporary directory is used and the shards '
+                    'are only run on this machine. The directory must only '
+                    'be writable by trusted users, as the workers run the '
+                    'tasks queued in it.',
+        'shard_lease': 'The seconds after which a shard is queued again if '
+                       'the worker running it has stopped. Running workers '
+                       'renew their shards every 10 seconds, so shards of '
+                       'any length are not run twice.'},
     output_descriptions={'mislabelings': 'A tabular file describing '
-                                         'mislabelings per sample'}
+                                         'mislabelings per sample',
+                         'probabilities': _probabilities_description,
+                         'proportions': _proportions_description,
+                         'stage_metrics': _stage_metrics_description}
+)
+
+plugin.pipelines.register_function(
+    name="Mislabelings of several variables within dataset",
+    description="As within-dataset, for several metadata columns at once. "
+                "The table is rarefied and filtered once for all of the "
+                "columns, and the columns are then classified and source "
+                "tracked concurrently with parallel execution. The results "
+                "of each column are keyed by its name.",
+    function=_actions.within_dataset_columns,
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'alleged_min_probability': Float,
+                'env_min_proportion': Float,
+                'metadata': Metadata,
+                'columns': List[Str],
+                'n_jobs': Int,
+                'sampling_depth': Int,
+                'preprocessing': Str % Choices(PREPROCESSING),
+                'rarefaction_engine': Str % Choices(RAREFACTION_ENGINES),
+                'contamination_engine': Str % Choices(CONTAMINATION_ENGINES),
+                'classifier_engine': Str % Choices(CLASSIFIER_ENGINES),
+                'random_state': Int,
+                'checkpoint_dir': Str},
+    outputs=[('mislabelings', Collection[SampleData[Mislabeled]]),
+             ('probabilities', Collection[SampleData[Probabilities]]),
+             ('proportions', Collection[FeatureTable[RelativeFrequency]]),
+             ('stage_metrics', StageMetrics)],
+    input_descriptions={'table': 'The feature table to examine'},
+    parameter_descriptions={
+        'alleged_min_probability': 'The minimum probability a sample must '
+                                   'must have from classification to be '
+                                   'considered correctly classified.',
+        'env_min_proportion': 'The minimum environment proportion a sample '
+                              'must have from source tracking to be '
+                              'considered correctly classified',
+        'metadata': 'The metadata with the variables to assess mislabelings '
+                    'with',
+        'columns': 'The categorical columns in the metadata to assess '
+                   'mislabelings with. Each is assessed with the samples '
+                   'it has a value for.',
+        'n_jobs': 'The number of CPUs to use, shared by the columns with '
+                  'parallel execution',
+        'sampling_depth': 'The rarefaction level to use',
+        'preprocessing': _preprocessing_description,
+        'rarefaction_engine': _rarefaction_engine_description,
+        'contamination_engine': _contamination_engine_description,
+        'classifier_engine': _classifier_engine_description,
+        'random_state': _random_state_description,
+        'checkpoint_dir': _checkpoint_dir_description},
+    output_descriptions={'mislabelings': 'A tabular file describing '
+                                         'mislabelings per sample, for each '
+                                         'column',
+                         'probabilities': 'The classification '
+                                          'probabilities, for each column',
+                         'proportions': 'The source tracking proportions, '
+                                        'for each column',
+                         'stage_metrics': _stage_metrics_description}
 )
 
 plugin.pipelines.register_function(
     name="Mislabelings against dataset",
     description="Identify mislabemings and contaminated samples using a "
                 "separate dataset as a reference.",
-    function=q2_mislabeled.against_dataset,
+    function=_actions.against_dataset,
     inputs={'focus': FeatureTable[Frequency],
             'reference': FeatureTable[Frequency]},
     parameters={'alleged_min_probability': Float,
@@ -71,8 +275,18 @@ plugin.pipelines.register_function(
                 'focus_env': MetadataColumn[Categorical],
                 'reference_env': MetadataColumn[Categorical],
                 'n_jobs': Int,
-                'sampling_depth': Int},
-    outputs=[('mislabelings', SampleData[Mislabeled])],
+                'sampling_depth': Int,
+                'preprocessing': Str % Choices(PREPROCESSING),
+                'rarefaction_engine': Str % Choices(RAREFACTION_ENGINES),
+                'contamination_engine': Str % Choices(CONTAMINATION_ENGINES),
+                'random_state': Int,
+                'chunk_size': Int % Range(1, None),
+                'checkpoint_dir': Str,
+                'focus_features': Str % Choices(FOCUS_FEATURES)},
+    outputs=[('mislabelings', SampleData[Mislabeled]),
+             ('probabilities', SampleData[Probabilities]),
+             ('proportions', FeatureTable[RelativeFrequency]),
+             ('stage_metrics', StageMetrics)],
     input_descriptions={'focus': 'The feature table to examine',
                         'reference': 'The reference feature table'},
     parameter_descriptions={
@@ -87,9 +301,213 @@ plugin.pipelines.register_function(
         'reference_env': 'The column in the reference metadata with the '
                          'variable to assess mislabelings with',
         'n_jobs': 'The number of CPUs to use',
-        'sampling_depth': 'The rarefaction level to use'},
+        'sampling_depth': 'The rarefaction level to use',
+        'preprocessing': _preprocessing_description,
+        'rarefaction_engine': _rarefaction_engine_description,
+        'contamination_engine': _contamination_engine_description,
+        'random_state': _random_state_description,
+        'chunk_size': _chunk_size_description,
+        'checkpoint_dir': _checkpoint_dir_description,
+        'focus_features': _focus_features_description},
+    output_descriptions={'mislabelings': 'A tabular file describing '
+                                         'mislabelings per sample',
+                         'probabilities': _probabilities_description,
+                         'proportions': _proportions_description,
+                         'stage_metrics': _stage_metrics_description}
+)
+
+plugin.pipelines.register_function(
+    name="Prepare a reference dataset",
+    description="Rarefy and filter a reference dataset, fit a classifier to "
+                "it, and summarize its environments as SourceTracker "
+                "sources, so that it can be reused by "
+                "against-prepared-reference.",
+    function=_actions.prepare_reference,
+    inputs={'reference': FeatureTable[Frequency]},
+    parameters={'reference_env': MetadataColumn[Categorical],
+                'n_jobs': Int,
+                'sampling_depth': Int,
+                'preprocessing': Str % Choices(PREPROCESSING),
+                'rarefaction_engine': Str % Choices(RAREFACTION_ENGINES),
+                'random_state': Int},
+    outputs=[('reference_bundle', ReferenceBundle)],
+    input_descriptions={'reference': 'The reference feature table'},
+    parameter_descriptions={
+        'reference_env': 'The column in the reference metadata with the '
+                         'variable to assess mislabelings with',
+        'n_jobs': 'The number of CPUs to use',
+        'sampling_depth': 'The rarefaction level to use. Focus tables '
+                          'assessed against this reference are rarefied '
+                          'to the same level.',
+        'preprocessing': _preprocessing_description,
+        'rarefaction_engine': _rarefaction_engine_description,
+        'random_state': _random_state_description},
+    output_descriptions={'reference_bundle': 'The prepared reference'}
+)
+
+plugin.pipelines.register_function(
+    name="Mislabelings against a prepared reference",
+    description="Identify mislabelings and contaminated samples using a "
+                "reference prepared with prepare-reference. Only the focus "
+                "table is rarefied, filtered and assessed.",
+    function=_actions.against_prepared_reference,
+    inputs={'focus': FeatureTable[Frequency],
+            'reference': ReferenceBundle},
+    parameters={'alleged_min_probability': Float,
+                'env_min_proportion': Float,
+                'focus_env': MetadataColumn[Categorical],
+                'n_jobs': Int,
+                'rarefaction_engine': Str % Choices(RAREFACTION_ENGINES),
+                'contamination_engine': Str % Choices(CONTAMINATION_ENGINES),
+                'random_state': Int,
+                'chunk_size': Int % Range(1, None),
+                'focus_features': Str % Choices(FOCUS_FEATURES)},
+    outputs=[('mislabelings', SampleData[Mislabeled]),
+             ('probabilities', SampleData[Probabilities]),
+             ('proportions', FeatureTable[RelativeFrequency])],
+    input_descriptions={'focus': 'The feature table to examine',
+                        'reference': 'The prepared reference'},
+    parameter_descriptions={
+        'alleged_min_probability': 'The minimum probability a sample must '
+                                   'must have from classification to be '
+                                   'considered correctly classified.',
+        'env_min_proportion': 'The minimum environment proportion a sample '
+                              'must have from source tracking to be '
+                              'considered correctly classified',
+        'focus_env': 'The column in the focus metadata with the variable to '
+                     'assess mislabelings with',
+        'n_jobs': 'The number of CPUs to use',
+        'rarefaction_engine': _rarefaction_engine_description,
+        'contamination_engine': _contamination_engine_description,
+        'random_state': _random_state_description,
+        'chunk_size': _chunk_size_description,
+        'focus_features': _focus_features_description},
+    output_descriptions={'mislabelings': 'A tabular file describing '
+                                         'mislabelings per sample',
+                         'probabilities': _probabilities_description,
+                         'proportions': _proportions_description}
+)
+
+plugin.pipelines.register_function(
+    name="Mislabelings of many datasets against a dataset",
+    description="Identify mislabelings and contaminated samples in each of "
+                "a collection of focus datasets, using a separate dataset as "
+                "a reference. The reference is prepared once and shared by "
+                "all focus datasets.",
+    function=_actions.against_dataset_batch,
+    inputs={'focus': Collection[FeatureTable[Frequency]],
+            'reference': FeatureTable[Frequency]},
+    parameters={'alleged_min_probability': Float,
+                'env_min_proportion': Float,
+                'focus_env': MetadataColumn[Categorical],
+                'reference_env': MetadataColumn[Categorical],
+                'n_jobs': Int,
+                'sampling_depth': Int,
+                'preprocessing': Str % Choices(PREPROCESSING),
+                'rarefaction_engine': Str % Choices(RAREFACTION_ENGINES),
+                'contamination_engine': Str % Choices(CONTAMINATION_ENGINES),
+                'random_state': Int,
+                'chunk_size': Int % Range(1, None),
+                'focus_features': Str % Choices(FOCUS_FEATURES)},
+    outputs=[('mislabelings', Collection[SampleData[Mislabeled]]),
+             ('probabilities', Collection[SampleData[Probabilities]]),
+             ('proportions', Collection[FeatureTable[RelativeFrequency]])],
+    input_descriptions={'focus': 'The feature tables to examine',
+                        'reference': 'The reference feature table'},
+    parameter_descriptions={
+        'alleged_min_probability': 'The minimum probability a sample must '
+                                   'must have from classification to be '
+                                   'considered correctly classified.',
+        'env_min_proportion': 'The minimum environment proportion a sample '
+                              'must have from source tracking to be '
+                              'considered correctly classified',
+        'focus_env': 'The column in the focus metadata with the variable to '
+                     'assess mislabelings with. It must describe the '
+                     'samples of every focus table.',
+        'reference_env': 'The column in the reference metadata with the '
+                         'variable to assess mislabelings with',
+        'n_jobs': 'The number of CPUs to use. With parallel execution, '
+                  'the focus tables are assessed concurrently and share '
+                  'them.',
+        'sampling_depth': 'The rarefaction level to use',
+        'preprocessing': _preprocessing_description,
+        'rarefaction_engine': _rarefaction_engine_description,
+        'contamination_engine': _contamination_engine_description,
+        'random_state': _random_state_description,
+        'chunk_size': _chunk_size_description,
+        'focus_features': _focus_features_description},
+    output_descriptions={'mislabelings': 'A tabular file describing '
+                                         'mislabelings per sample, for each '
+                                         'focus table',
+                         'probabilities': 'The classification '
+                                          'probabilities, for each focus '
+                                          'table',
+                         'proportions': 'The source tracking proportions, '
+                                        'for each focus table'}
+)
+
+_rescore_inputs = {'probabilities': SampleData[Probabilities],
+                   'proportions': FeatureTable[RelativeFrequency]}
+_rescore_input_descriptions = {
+    'probabilities': 'The classification probabilities output by a '
+                     'mislabelings pipeline',
+    'proportions': 'The source tracking proportions output by the same run'}
+_rescore_env_description = (
+    'The column in the metadata with the variable to assess mislabelings '
+    'with. For against-dataset, this is the focus metadata.')
+
+plugin.methods.register_function(
+    name="Reassess mislabelings with other thresholds",
+    description="Recompute the mislabeled, contaminated and corrected label "
+                "of each sample from the probabilities and proportions of a "
+                "previous run, without classifying or source tracking "
+                "again. The proportions of within-dataset are estimated for "
+                "the samples that run did not find mislabeled, so samples "
+                "only found mislabeled at the original threshold are not "
+                "assessed for contamination.",
+    function=_actions.rescore,
+    inputs=_rescore_inputs,
+    parameters={'env': MetadataColumn[Categorical],
+                'alleged_min_probability': Float,
+                'env_min_proportion': Float},
+    outputs=[('mislabelings', SampleData[Mislabeled])],
+    input_descriptions=_rescore_input_descriptions,
+    parameter_descriptions={
+        'env': _rescore_env_description,
+        'alleged_min_probability': 'The minimum probability a sample must '
+                                   'have from classification to be '
+                                   'considered correctly classified.',
+        'env_min_proportion': 'The minimum environment proportion a sample '
+                              'must have from source tracking to be '
+                              'considered correctly classified'},
     output_descriptions={'mislabelings': 'A tabular file describing '
                                          'mislabelings per sample'}
 )
 
+plugin.methods.register_function(
+    name="Reassess mislabelings over a grid of thresholds",
+    description="As rescore, for every pair of the given thresholds at "
+                "once. The mislabelings of each pair are keyed by the "
+                "alleged minimum probability and the environment minimum "
+                "proportion, joined by an underscore.",
+    function=_actions.rescore_grid,
+    inputs=_rescore_inputs,
+    parameters={'env': MetadataColumn[Categorical],
+                'alleged_min_probabilities': List[Float],
+                'env_min_proportions': List[Float]},
+    outputs=[('mislabelings', Collection[SampleData[Mislabeled]])],
+    input_descriptions=_rescore_input_descriptions,
+    parameter_descriptions={
+        'env': _rescore_env_description,
+        'alleged_min_probabilities': 'The minimum probabilities a sample '
+                                     'must have from classification to be '
+                                     'considered correctly classified.',
+        'env_min_proportions': 'The minimum environment proportions a '
+                               'sample must have from source tracking to be '
+                               'considered correctly classified'},
+    output_descriptions={'mislabelings': 'A tabular file describing '
+                                         'mislabelings per sample, for each '
+                                         'pair of thresholds'}
+)
+
 importlib.import_module('q2_mislabeled._transformers')
@@ -0,0 +1,37 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import importlib
+import inspect
+import unittest
+import unittest.mock
+
+import q2_mislabeled
+from q2_mislabeled import _actions
+
+
+class ActionsTests(unittest.TestCase):
+    def test_signatures(self):
+        # the registered functions must describe the actions they run
+        for name, module in q2_mislabeled._ACTIONS.items():
+            module = importlib.import_module('q2_mislabeled.' + module)
+            self.assertEqual(inspect.signature(getattr(_actions, name)),
+                             inspect.signature(getattr(module, name)), name)
+
+    def test_call(self):
+        with unittest.mock.patch('q2_mislabeled._rescore.rescore',
+                                 return_value='result') as rescore:
+            obs = _actions.rescore('prob', 'prop', 'env',
+                                   env_min_proportion=0.5)
+        self.assertEqual(obs, 'result')
+        rescore.assert_called_once_with(
+            probabilities='prob', proportions='prop', env='env',
+            alleged_min_probability=0.25, env_min_proportion=0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
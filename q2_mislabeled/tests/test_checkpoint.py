@@ -0,0 +1,124 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import biom
+import qiime2
+
+from q2_mislabeled._checkpoint import Checkpoint
+
+
+class CheckpointTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            biom.Table(np.arange(12).reshape(3, 4), ['O1', 'O2', 'O3'],
+                       ['S1', 'S2', 'S3', 'S4']))
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def subset(self, table, ids):
+        # a stage, which records that it ran
+        self.calls.append('subset')
+        subset = table.view(biom.Table).filter(ids, inplace=False)
+        return qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                           subset),
+
+    def total(self, table, fail=False):
+        self.calls.append('total')
+        if fail:
+            raise MemoryError()
+        return None, table
+
+    def pipeline(self, fail=False, context=None):
+        checkpoint = Checkpoint(self.tmp.name, context or {'version': '1'})
+        subset = checkpoint.wrap('subset', self.subset)
+        total = checkpoint.wrap('total', self.total)
+        subsetted, = subset(self.table, ['S1', 'S2'])
+        return total(subsetted, fail=fail)
+
+    def test_resume(self):
+        with self.assertRaises(MemoryError):
+            self.pipeline(fail=True)
+        self.assertEqual(self.calls, ['subset', 'total'])
+
+        # only the stage which failed runs again
+        none, obs = self.pipeline()
+        self.assertEqual(self.calls, ['subset', 'total', 'total'])
+        self.assertIsNone(none)
+        self.assertEqual(list(obs.view(biom.Table).ids()), ['S1', 'S2'])
+
+        # and then nothing does
+        none, obs = self.pipeline()
+        self.assertEqual(len(self.calls), 3)
+        self.assertIsNone(none)
+        self.assertEqual(list(obs.view(biom.Table).ids()), ['S1', 'S2'])
+
+    def test_context(self):
+        self.pipeline()
+        self.pipeline(context={'version': '2'})
+        self.assertEqual(self.calls, ['subset', 'total'] * 2)
+
+    def test_key(self):
+        checkpoint = Checkpoint(self.tmp.name, {})
+        md = qiime2.Metadata(pd.DataFrame({'env': ['gut', 'oral']},
+                                          index=pd.Index(['S1', 'S2'],
+                                                         name='id')))
+        same = qiime2.Metadata(md.to_dataframe())
+        other = qiime2.Metadata(pd.DataFrame({'env': ['gut', 'gut']},
+                                             index=pd.Index(['S1', 'S2'],
+                                                            name='id')))
+
+        key = checkpoint.key('stage', (self.table, md), {'depth': 10})
+        self.assertEqual(checkpoint.key('stage', (self.table, same),
+                                        {'depth': 10}), key)
+        self.assertNotEqual(checkpoint.key('stage', (self.table, other),
+                                           {'depth': 10}), key)
+        self.assertNotEqual(checkpoint.key('stage', (self.table, md),
+                                           {'depth': 20}), key)
+        self.assertNotEqual(checkpoint.key('other', (self.table, md),
+                                           {'depth': 10}), key)
+
+        # the number of processes does not change the outputs
+        self.assertEqual(checkpoint.key('stage', (self.table, md),
+                                        {'depth': 10, 'n_jobs': 4}), key)
+        self.assertEqual(checkpoint.key('stage', (self.table, md),
+                                        {'depth': 10, 'jobs': 2}), key)
+
+    def test_repeated_call(self):
+        # a stage called twice with the same arguments in one run is run
+        # twice, and each call is resumed separately
+        for _ in range(2):
+            checkpoint = Checkpoint(self.tmp.name, {})
+            first, = checkpoint.call('subset', self.subset, self.table,
+                                     ['S1'])
+            second, = checkpoint.call('subset', self.subset, self.table,
+                                      ['S1'])
+            self.assertNotEqual(first.uuid, second.uuid)
+        self.assertEqual(self.calls, ['subset', 'subset'])
+
+    def test_outputs_keyed_by_stage(self):
+        # the artifacts a stage produces are identified by the stage, so
+        # the stages using them have the same keys when it runs again
+        keys = []
+        for _ in range(2):
+            checkpoint = Checkpoint(tempfile.mkdtemp(dir=self.tmp.name), {})
+            subsetted, = checkpoint.call('subset', self.subset, self.table,
+                                         ['S1'])
+            keys.append(checkpoint.key('total', (subsetted, ), {}))
+        self.assertEqual(keys[0], keys[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
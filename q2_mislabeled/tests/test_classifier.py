@@ -0,0 +1,151 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+import unittest.mock
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import biom
+
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+from sklearn.naive_bayes import MultinomialNB
+
+from q2_mislabeled._classifier import (out_of_fold_probabilities,
+                                       leave_one_out_probabilities,
+                                       heldout_probabilities)
+
+
+class ClassifierTests(unittest.TestCase):
+    def setUp(self):
+        # three environments with mostly disjoint features, twenty samples
+        # each, and a sample with no environment
+        rng = np.random.default_rng(0)
+        data = rng.poisson(1, size=(30, 61))
+        for env in range(3):
+            data[env * 10:(env + 1) * 10, env * 20:(env + 1) * 20] += \
+                rng.poisson(20, size=(10, 20))
+        self.table = biom.Table(data, ['O%d' % i for i in range(30)],
+                                ['S%d' % i for i in range(61)])
+        self.labels = pd.Series(np.repeat(['gut', 'oral', 'skin'], 20),
+                                index=['S%d' % i for i in range(60)])
+
+    def test_probabilities(self):
+        obs = out_of_fold_probabilities(self.table, self.labels,
+                                        random_state=0)
+        self.assertEqual(list(obs.index), list(self.labels.index))
+        self.assertEqual(list(obs.columns), ['gut', 'oral', 'skin'])
+        npt.assert_allclose(obs.sum(axis=1), 1)
+        self.assertTrue((obs.idxmax(axis=1) == self.labels).all())
+
+    def test_mislabeled(self):
+        labels = self.labels.copy()
+        labels['S0'] = 'skin'
+        obs = out_of_fold_probabilities(self.table, labels, random_state=0)
+        self.assertEqual(obs.loc['S0'].idxmax(), 'gut')
+        self.assertLess(obs.loc['S0', 'skin'], 0.25)
+
+    def test_reproducible(self):
+        first = out_of_fold_probabilities(self.table, self.labels,
+                                          random_state=0)
+        second = out_of_fold_probabilities(self.table, self.labels,
+                                           random_state=0)
+        pd.testing.assert_frame_equal(first, second)
+
+    def test_heldout(self):
+        new = ['S0', 'S25', 'S45']
+        labels = self.labels.copy()
+        labels['S0'] = 'skin'
+        for engine in ('logistic', 'naive-bayes'):
+            obs = heldout_probabilities(self.table, labels, new, engine)
+            self.assertEqual(list(obs.index), new)
+            self.assertEqual(list(obs.columns), ['gut', 'oral', 'skin'])
+            npt.assert_allclose(obs.sum(axis=1), 1)
+            # the labels of new samples are not trained on
+            self.assertEqual(list(obs.idxmax(axis=1)),
+                             ['gut', 'oral', 'skin'])
+
+    def test_heldout_missing(self):
+        # a new sample removed from the table is not classified, rather than
+        # taking the probabilities of another sample
+        exp = heldout_probabilities(self.table, self.labels, ['S0', 'S25'])
+        obs = heldout_probabilities(self.table, self.labels,
+                                    ['S0', 'rarefied-away', 'S25'])
+        pd.testing.assert_frame_equal(obs, exp)
+
+    def test_n_jobs(self):
+        # the folds are warm started in turn, or cold started in parallel,
+        # which only differ by the solver tolerance
+        exp = out_of_fold_probabilities(self.table, self.labels,
+                                        random_state=0)
+        obs = out_of_fold_probabilities(self.table, self.labels, n_jobs=2,
+                                        random_state=0)
+        pd.testing.assert_frame_equal(obs, exp, atol=1e-3)
+
+    def test_cold_start(self):
+        # no fold starts from a model which saw its own samples
+        labels = self.labels.copy()
+        labels['S0'] = 'skin'
+        sizes = []
+        fit = LogisticRegression.fit
+
+        def record(model, X, y, *args, **kwargs):
+            sizes.append(X.shape[0])
+            return fit(model, X, y, *args, **kwargs)
+
+        with unittest.mock.patch.object(LogisticRegression, 'fit', record):
+            obs = out_of_fold_probabilities(self.table, labels,
+                                            random_state=0)
+        self.assertEqual(sizes, [48] * 5)
+
+        table = self.table.filter(labels.index, inplace=False)
+        X = np.sqrt(table.matrix_data.T.toarray() /
+                    table.sum(axis='sample')[:, None])
+        y = labels.to_numpy()
+        exp = np.zeros((len(y), 3))
+        for train, test in StratifiedKFold(5, shuffle=True,
+                                           random_state=0).split(X, y):
+            model = LogisticRegression(C=1.0, max_iter=1000)
+            exp[test] = model.fit(X[train], y[train]).predict_proba(X[test])
+        npt.assert_allclose(obs.to_numpy(), exp, atol=1e-3)
+
+
+class LeaveOneOutTests(unittest.TestCase):
+    def setUp(self):
+        # a sample with no class
+        rng = np.random.default_rng(1)
+        self.table = biom.Table(rng.poisson(2, size=(20, 16)),
+                                ['O%d' % i for i in range(20)],
+                                ['S%d' % i for i in range(16)])
+        self.labels = pd.Series(np.repeat(['gut', 'oral', 'skin'], 5),
+                                index=['S%d' % i for i in range(15)])
+
+    def test_leave_one_out_is_exact(self):
+        obs = leave_one_out_probabilities(self.table, self.labels)
+        self.assertEqual(list(obs.index), list(self.labels.index))
+        self.assertEqual(list(obs.columns), ['gut', 'oral', 'skin'])
+
+        X = self.table.matrix_data.T.toarray()
+        for i, sample in enumerate(self.labels.index):
+            others = self.labels.drop(sample)
+            model = MultinomialNB().fit(X[[int(s[1:]) for s in others.index]],
+                                        others)
+            npt.assert_allclose(obs.loc[sample],
+                                model.predict_proba(X[[i]])[0])
+
+    def test_only_sample_of_class(self):
+        labels = self.labels.copy()
+        labels['S0'] = 'nasal'
+        obs = leave_one_out_probabilities(self.table, labels)
+        self.assertEqual(obs.loc['S0', 'nasal'], 0)
+        npt.assert_allclose(obs.sum(axis=1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import biom
+
+from q2_mislabeled._mixture import mixture_proportions, UNKNOWN
+
+
+class MixtureTests(unittest.TestCase):
+    def setUp(self):
+        # three environments with disjoint features, ten samples each
+        rng = np.random.default_rng(0)
+        data = np.zeros((30, 30), dtype=int)
+        for env in range(3):
+            data[env * 10:(env + 1) * 10, env * 10:(env + 1) * 10] = \
+                rng.poisson(20, size=(10, 10))
+        self.features = ['O%d' % i for i in range(30)]
+        self.sources = biom.Table(data, self.features,
+                                  ['S%d' % i for i in range(30)])
+        self.env = pd.Series(np.repeat(['gut', 'oral', 'skin'], 10),
+                             index=self.sources.ids())
+
+    def test_pure_and_mixed_sinks(self):
+        profile = self.sources.sum(axis='observation')
+        gut = np.where(np.arange(30) < 10, profile, 0)
+        skin = np.where(np.arange(30) >= 20, profile, 0)
+        sinks = biom.Table(np.vstack([gut, gut + skin]).T, self.features,
+                           ['pure', 'mixed'])
+
+        obs = mixture_proportions(self.sources, self.env, sinks)
+        self.assertEqual(list(obs.index), ['pure', 'mixed'])
+        self.assertEqual(list(obs.columns), ['gut', 'oral', 'skin', UNKNOWN])
+        npt.assert_allclose(obs.sum(axis=1), 1)
+        self.assertGreater(obs.loc['pure', 'gut'], 0.99)
+        self.assertAlmostEqual(obs.loc['mixed', 'gut'], 0.5, places=2)
+        self.assertAlmostEqual(obs.loc['mixed', 'skin'], 0.5, places=2)
+
+    def test_unshared_features_are_unknown(self):
+        gut = np.where(np.arange(30) < 10, 10, 0)
+        sinks = biom.Table(np.append(gut, [100] * 10)[:, None],
+                           self.features + ['X%d' % i for i in range(10)],
+                           ['novel'])
+
+        # the unknown source explains the reads of the novel features
+        obs = mixture_proportions(self.sources, self.env, sinks)
+        self.assertAlmostEqual(obs.loc['novel', 'gut'], 100 / 1100, places=2)
+        self.assertAlmostEqual(obs.loc['novel', UNKNOWN], 1000 / 1100,
+                               places=2)
+
+    def test_sinks_are_independent(self):
+        # sinks with novel features of their own, and one mixing a
+        # source-less feature with gut, are assessed as they would be alone
+        gut = np.where(np.arange(30) < 10, 10, 0)
+        oral = np.where((np.arange(30) >= 10) & (np.arange(30) < 20), 10, 0)
+        novel = np.zeros((6, 3), dtype=int)
+        novel[:5, 0] = 50
+        novel[5, 1] = 40
+        sinks = biom.Table(np.vstack([np.column_stack([gut, oral, gut + oral]),
+                                      novel]),
+                           self.features + ['X%d' % i for i in range(6)],
+                           ['A', 'B', 'C'])
+
+        together = mixture_proportions(self.sources, self.env, sinks)
+        for sink in sinks.ids():
+            alone = sinks.filter([sink], inplace=False).remove_empty(
+                axis='observation', inplace=False)
+            obs = mixture_proportions(self.sources, self.env, alone)
+            npt.assert_allclose(obs.loc[sink], together.loc[sink])
+
+    def test_leave_one_out(self):
+        # a sample without an environment is not assessed, and is not part
+        # of any source profile
+        env = self.env.drop('S29')
+        obs = mixture_proportions(self.sources, env)
+
+        self.assertEqual(list(obs.index), list(env.index))
+        npt.assert_allclose(obs.sum(axis=1), 1)
+        alleged = obs.to_numpy()[np.arange(len(env)),
+                                 obs.columns.get_indexer(env)]
+        self.assertTrue((alleged > 0.9).all())
+
+    def test_leave_one_out_is_exact(self):
+        # overlapping environments, so that every source contributes
+        rng = np.random.default_rng(1)
+        sources = biom.Table(rng.poisson(2, size=(20, 12)),
+                             ['O%d' % i for i in range(20)],
+                             ['S%d' % i for i in range(12)])
+        env = pd.Series(np.repeat(['gut', 'oral', 'skin'], 4),
+                        index=sources.ids())
+        obs = mixture_proportions(sources, env, tol=1e-10)
+
+        for sample in ['S0', 'S5', 'S11']:
+            others = [i for i in sources.ids() if i != sample]
+            exp = mixture_proportions(
+                sources.filter(others, inplace=False), env,
+                sources.filter([sample], inplace=False), tol=1e-10)
+            npt.assert_allclose(obs.loc[[sample]], exp, atol=1e-6)
+
+    def test_leave_one_out_shards(self):
+        env = self.env.drop('S29')
+        exp = mixture_proportions(self.sources, env, tol=1e-10)
+        shards = [mixture_proportions(self.sources, env, tol=1e-10,
+                                      loo_ids=ids)
+                  for ids in (['S3', 'S21'], ['S0', 'S12', 'S28'])]
+        obs = pd.concat(shards)
+        self.assertEqual(list(obs.index), ['S3', 'S21', 'S0', 'S12', 'S28'])
+        npt.assert_allclose(obs, exp.loc[obs.index], atol=1e-6)
+
+        # only the samples with an environment are sources
+        with self.assertRaisesRegex(KeyError, 'S29'):
+            mixture_proportions(self.sources, env, loo_ids=['S0', 'S29'])
+
+    def test_leave_one_out_only_sample(self):
+        # the only sample of an environment has nothing to be compared to
+        env = self.env.copy()
+        env['S0'] = 'nasal'
+        obs = mixture_proportions(self.sources, env)
+        self.assertLess(obs.loc['S0', 'nasal'], 0.01)
+        self.assertGreater(obs.loc['S0', 'gut'], 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import biom
+
+from q2_mislabeled._mixture import mixture_proportions
+from q2_mislabeled._mmap import MappedTable, write_mapped
+
+
+class MappedTableTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        data = np.array([[0, 5, 1, 0, 2, 7],
+                         [2, 0, 3, 0, 1, 0],
+                         [0, 0, 4, 6, 0, 1],
+                         [3, 1, 0, 2, 0, 0]])
+        self.table = biom.Table(data, ['O1', 'O2', 'O3', 'O4'],
+                                ['S1', 'S2', 'S3', 'S4', 'S5', 'S6'])
+        write_mapped(self.table, self.tmp.name)
+        self.mapped = MappedTable(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_round_trip(self):
+        self.assertEqual(self.mapped.shape, (4, 6))
+        self.assertEqual(list(self.mapped.ids()), list(self.table.ids()))
+        self.assertEqual(list(self.mapped.ids(axis='observation')),
+                         ['O1', 'O2', 'O3', 'O4'])
+        self.assertEqual((self.mapped.matrix_data !=
+                          self.table.matrix_data).nnz, 0)
+
+    def test_matrix_is_mapped(self):
+        # a copy would be writeable
+        matrix = self.mapped.matrix_data
+        for array in (matrix.data, matrix.indices, matrix.indptr):
+            self.assertFalse(array.flags.writeable)
+        with self.assertRaises(ValueError):
+            matrix.data[0] = 1
+
+    def test_filter(self):
+        obs = self.mapped.filter(['S4', 'S2'], inplace=False)
+        exp = self.table.filter(['S2', 'S4'], inplace=False)
+        self.assertEqual(obs, exp)
+
+        with self.assertRaisesRegex(ValueError, 'read-only'):
+            self.mapped.filter(['S2'], inplace=True)
+
+    def test_mixture_proportions(self):
+        env = pd.Series(['fecal', 'fecal', 'oral', 'oral', 'skin'],
+                        index=['S1', 'S2', 'S3', 'S4', 'S5'])
+        pdt.assert_frame_equal(
+            mixture_proportions(self.mapped, env, loo_ids=['S2', 'S3']),
+            mixture_proportions(self.table, env, loo_ids=['S2', 'S3']))
+
+    def test_env(self):
+        self.assertIsNone(self.mapped.env)
+
+        env = pd.Series(['oral', 'fecal', 'skin', 'fecal', 'oral', 'skin'],
+                        index=['S6', 'S1', 'S3', 'S2', 'S5', 'S4'])
+        with tempfile.TemporaryDirectory() as tmp:
+            write_mapped(self.table, tmp, env=env)
+            obs = MappedTable(tmp).env
+            pdt.assert_series_equal(obs, env.loc[self.table.ids()],
+                                    check_index_type=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
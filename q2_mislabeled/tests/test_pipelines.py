@@ -5,12 +5,41 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import json
+import os
+import pickle
+import sys
+import tarfile
+import tempfile
+import types
 import unittest
+import unittest.mock
+import numpy as np
 import pandas as pd
 import pandas.testing as pdt
+import biom
+import qiime2
+import sklearn
+from sklearn.naive_bayes import MultinomialNB
 
-from q2_mislabeled._pipelines import (_set_mislabeled, _set_contamination,
-                                      NOT_APPLICABLE)
+from q2_mislabeled._classifier import leave_one_out_probabilities
+from q2_mislabeled._mixture import mixture_proportions
+from q2_mislabeled._mmap import MappedTable
+from q2_mislabeled._engines import CONTAMINATION_ENGINES
+from q2_mislabeled._pipelines import (within_dataset_columns,
+                                      against_dataset, prepare_reference,
+                                      against_prepared_reference,
+                                      _set_mislabeled, _set_contamination,
+                                      _source_counts, _new_samples,
+                                      _current, _metadata_columns,
+                                      _shared_jobs, _seeds, _ensemble,
+                                      _set_spread, _project_features,
+                                      _stack_samples, _against_mapped,
+                                      _write_mapped_sources,
+                                      _get_sourcetracker,
+                                      _get_sharded_sourcetracker,
+                                      _sourcetracker_artifact, NOT_APPLICABLE,
+                                      UNASSIGNED)
 
 
 class Tests(unittest.TestCase):
@@ -84,6 +113,465 @@ class Tests(unittest.TestCase):
 
         pdt.assert_frame_equal(env_df, exp)
 
+    def test_set_mislabeled_unknown_environment(self):
+        env_df = pd.DataFrame([['foo', 'fecal'],
+                               ['bar', 'vaginal']],
+                              columns=['#SampleID', 'env'])
+        env_df.set_index('#SampleID', inplace=True)
+        prob_df = pd.DataFrame([['bar', 0.5, 0.5],
+                                ['foo', 0.6, 0.4]],
+                               columns=['#SampleID', 'fecal', 'oral'])
+        prob_df.set_index('#SampleID', inplace=True)
+
+        with self.assertRaisesRegex(KeyError, 'vaginal'):
+            _set_mislabeled(env_df, prob_df, 'env', 0.25)
+
+    def test_source_counts(self):
+        table = biom.Table(np.array([[1, 3, 0, 4],
+                                     [2, 0, 6, 0],
+                                     [0, 1, 0, 9]]),
+                           ['O1', 'O2', 'O3'], ['S1', 'S2', 'S3', 'S4'])
+        env = pd.Series(['fecal', 'fecal', 'oral', 'skin', 'oral'],
+                        index=['S1', 'S2', 'S3', 'S5', 'S6'])
+
+        exp = biom.Table(np.array([[4, 0],
+                                   [2, 6],
+                                   [1, 0]]),
+                         ['O1', 'O2', 'O3'], ['__source__fecal',
+                                              '__source__oral'])
+        obs = _source_counts(table, env)
+        self.assertEqual(obs, exp)
+
+    def test_new_samples(self):
+        # ten previous samples in each of two environments, and a shallow
+        # sample which was never assessed
+        ids = ['S%d' % i for i in range(23)]
+        env_df = pd.DataFrame({'env': ['fecal'] * 10 + ['oral'] * 10 +
+                               ['fecal', 'oral', 'fecal']},
+                              index=pd.Index(ids, name='#SampleID'))
+        totals = pd.Series(1000.0, index=ids)
+        totals['S20'] = 10
+        prev_prob_df = pd.DataFrame({'fecal': 1.0, 'oral': 0.0},
+                                    index=ids[:20])
+
+        obs = _new_samples(totals, env_df, 'env', prev_prob_df, 1000, 0.1)
+        self.assertEqual(obs, ['S21', 'S22'])
+
+        # one sample added to each environment is 10% of it
+        self.assertIsNone(_new_samples(totals, env_df, 'env', prev_prob_df,
+                                       1000, 0.05))
+
+        # nothing added
+        obs = _new_samples(totals[:21], env_df, 'env', prev_prob_df, 1000,
+                           0.1)
+        self.assertEqual(obs, [])
+
+    def test_new_samples_new_environment(self):
+        ids = ['S%d' % i for i in range(11)]
+        env_df = pd.DataFrame({'env': ['fecal'] * 10 + ['skin']},
+                              index=pd.Index(ids, name='#SampleID'))
+        totals = pd.Series(1000.0, index=ids)
+        prev_prob_df = pd.DataFrame({'fecal': [1.0] * 10}, index=ids[:10])
+        self.assertIsNone(_new_samples(totals, env_df, 'env', prev_prob_df,
+                                       1000, 1.0))
+
+    def test_current(self):
+        env_df = pd.DataFrame({'env': ['fecal', 'oral', 'skin']},
+                              index=['foo', 'bar', 'baz'])
+        prob_df = pd.DataFrame({'fecal': [0.5, 0.2, 0.1]},
+                               index=['foo', 'bar', 'removed'])
+        obs = _current(prob_df, env_df, ['bar'])
+        pdt.assert_frame_equal(obs, prob_df.loc[['foo']])
+
+    def test_metadata_columns(self):
+        md = qiime2.Metadata(pd.DataFrame(
+            {'env_package': ['fecal', 'oral', 'skin'],
+             'body_site': ['gut', None, 'hand'],
+             'ph': [7.0, 6.5, 5.5]},
+            index=pd.Index(['foo', 'bar', 'baz'], name='#SampleID')))
+
+        obs = _metadata_columns(md, ['body_site', 'env_package'])
+        self.assertEqual(list(obs), ['body_site', 'env_package'])
+        self.assertEqual(list(obs['body_site'].to_series().index),
+                         ['foo', 'baz'])
+        self.assertEqual(list(obs['env_package'].to_series().index),
+                         ['foo', 'bar', 'baz'])
+
+        with self.assertRaisesRegex(ValueError, 'categorical'):
+            _metadata_columns(md, ['env_package', 'ph'])
+        with self.assertRaisesRegex(ValueError, 'repeated'):
+            _metadata_columns(md, ['env_package', 'env_package'])
+        with self.assertRaisesRegex(ValueError, 'At least one'):
+            _metadata_columns(md, [])
+
+    def test_shared_jobs(self):
+        class Ctx:
+            parallel = False
+
+        self.assertEqual(_shared_jobs(Ctx(), 8, 3), 8)
+        Ctx.parallel = True
+        self.assertEqual(_shared_jobs(Ctx(), 8, 3), 2)
+        self.assertEqual(_shared_jobs(Ctx(), 2, 3), 1)
+
+    def test_seeds(self):
+        self.assertEqual(_seeds(None, 2), [None, None])
+        self.assertEqual(_seeds(42, 3), [42, 43, 44])
+
+    def test_ensemble(self):
+        df = pd.DataFrame({'fecal': [0.5, 0.2]}, index=['foo', 'bar'])
+        obs_mean, obs_spread = _ensemble([df])
+        self.assertIs(obs_mean, df)
+        self.assertIsNone(obs_spread)
+
+        # an environment missing from a rarefaction is zero in it
+        other = pd.DataFrame({'fecal': [0.3, 0.4], 'oral': [0.2, 0.6]},
+                             index=['foo', 'bar'])
+        obs_mean, obs_spread = _ensemble([df, other])
+        exp_mean = pd.DataFrame({'fecal': [0.4, 0.3], 'oral': [0.1, 0.3]},
+                                index=['foo', 'bar'])
+        exp_spread = pd.DataFrame({'fecal': [0.2, 0.2], 'oral': [0.2, 0.6]},
+                                  index=['foo', 'bar']) / np.sqrt(2)
+        pdt.assert_frame_equal(obs_mean, exp_mean)
+        pdt.assert_frame_equal(obs_spread, exp_spread)
+
+    def test_set_spread(self):
+        env_df = pd.DataFrame({'env': ['fecal', 'oral', 'skin']},
+                              index=['foo', 'bar', 'baz'])
+        spread_df = pd.DataFrame({'fecal': [0.1, 0.2], 'oral': [0.3, 0.4],
+                                  'skin': [0.5, 0.6]}, index=['foo', 'bar'])
+        _set_spread(env_df, spread_df, 'env', 'alleged_probability',
+                    'classifier probabilities')
+        self.assertEqual(list(env_df['alleged_probability_std']),
+                         [0.1, 0.4, NOT_APPLICABLE])
+
+        _set_spread(env_df, None, 'env', 'min_proportion',
+                    'source proportions')
+        self.assertEqual(list(env_df['min_proportion_std']),
+                         [NOT_APPLICABLE] * 3)
+
+    def test_project_features(self):
+        table = biom.Table(np.array([[1, 3, 0],
+                                     [2, 1, 0],
+                                     [0, 1, 5],
+                                     [4, 0, 0]]),
+                           ['O4', 'O2', 'O5', 'O1'], ['S1', 'S2', 'S3'])
+        features = ['O1', 'O2', 'O3']
+
+        # S3 only has a feature the reference does not have
+        exp = biom.Table(np.array([[4, 0],
+                                   [2, 1],
+                                   [0, 0]]),
+                         features, ['S1', 'S2'])
+        self.assertEqual(_project_features(table, features), exp)
+
+        exp = biom.Table(np.array([[4, 0, 0],
+                                   [2, 1, 0],
+                                   [0, 0, 0],
+                                   [1, 4, 5]]),
+                         features + [UNASSIGNED], ['S1', 'S2', 'S3'])
+        self.assertEqual(_project_features(table, features, pool=True), exp)
+
+    def test_stack_samples(self):
+        sources = biom.Table(np.array([[1, 2],
+                                       [3, 4]]),
+                             ['O1', 'O2'], ['fecal', 'oral'])
+        sinks = biom.Table(np.array([[5],
+                                     [6],
+                                     [7]]),
+                           ['O2', 'O1', UNASSIGNED], ['S1'])
+
+        exp = biom.Table(np.array([[1, 2, 6],
+                                   [3, 4, 5],
+                                   [0, 0, 7]]),
+                         ['O1', 'O2', UNASSIGNED], ['fecal', 'oral', 'S1'])
+        self.assertEqual(_stack_samples([sources, sinks]), exp)
+
+        other = biom.Table(np.array([[1]]), ['O3'], ['S2'])
+        with self.assertRaisesRegex(ValueError, 'features'):
+            _stack_samples([sources, other])
+
+    def test_against_mapped(self):
+        sources = biom.Table(np.array([[4, 0, 2, 1],
+                                       [0, 3, 1, 0],
+                                       [1, 1, 0, 5]]),
+                             ['O1', 'O2', 'O3'], ['R1', 'R2', 'R3', 'R4'])
+        # R4 has no environment, so it is not a source
+        env = pd.Series(['gut', 'oral', 'gut'], index=['R1', 'R2', 'R3'])
+        sinks = biom.Table(np.array([[3, 0, 1],
+                                     [1, 2, 0],
+                                     [0, 4, 2]]),
+                           ['O1', 'O2', 'O4'], ['F1', 'F2', 'F3'])
+        exp = mixture_proportions(sources, env, sinks)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            _write_mapped_sources(sources, env, tmp)
+            sinks = qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                                sinks)
+            obs = _against_mapped(tmp, FakeContext().filter_samples, sinks,
+                                  chunk_size=2)
+            obs = pd.concat([prop.view(pd.DataFrame).T for prop in obs])
+        self.assertEqual(len(obs), 3)
+        pdt.assert_frame_equal(obs, exp, check_names=False)
+
+
+class FakeContext:
+    """The actions the in-process engines still use, and a
+    classify_samples_ncv which, as q2-sample-classifier's, fails on samples
+    its metadata does not describe"""
+    parallel = False
+
+    def get_action(self, plugin, name):
+        return getattr(self, name)
+
+    def filter_features(self, table, min_samples):
+        table = table.view(biom.Table)
+        kept = table.filter(lambda v, i, m: (v > 0).sum() >= min_samples,
+                            axis='observation', inplace=False)
+        return qiime2.Artifact.import_data('FeatureTable[Frequency]', kept),
+
+    def filter_samples(self, table, metadata):
+        ids = metadata.to_dataframe().index
+        kept = table.view(biom.Table).filter(
+            lambda v, i, m: i in ids, inplace=False)
+        return qiime2.Artifact.import_data('FeatureTable[Frequency]', kept),
+
+    def merge(self, tables):
+        merged = tables[0].view(biom.Table)
+        for table in tables[1:]:
+            merged = merged.merge(table.view(biom.Table))
+        return qiime2.Artifact.import_data('FeatureTable[Frequency]', merged),
+
+    def fit_classifier(self, table, metadata, n_jobs, random_state):
+        # a naive Bayes model, stored as q2-sample-classifier stores its
+        # estimators
+        table = table.view(biom.Table)
+        labels = metadata.to_series().reindex(table.ids())
+        model = MultinomialNB().fit(table.matrix_data.T, labels)
+        with tempfile.TemporaryDirectory() as tmp:
+            pickled = os.path.join(tmp, 'sklearn_pipeline.pkl')
+            with open(pickled, 'wb') as fh:
+                pickle.dump((model, list(table.ids(axis='observation'))), fh)
+            with tarfile.open(os.path.join(tmp, 'sklearn_pipeline.tar'),
+                              'w') as tar:
+                tar.add(pickled, 'sklearn_pipeline.pkl')
+            os.remove(pickled)
+            with open(os.path.join(tmp, 'sklearn_version.json'), 'w') as fh:
+                json.dump({'sklearn-version': sklearn.__version__}, fh)
+            estimator = qiime2.Artifact.import_data(
+                'SampleEstimator[Classifier]', tmp)
+        return estimator, None
+
+    def predict_classification(self, table, sample_estimator, n_jobs):
+        with tempfile.TemporaryDirectory() as tmp:
+            sample_estimator.export_data(tmp)
+            with tarfile.open(os.path.join(tmp,
+                                           'sklearn_pipeline.tar')) as tar:
+                model, features = pickle.load(
+                    tar.extractfile('sklearn_pipeline.pkl'))
+        X = table.view(biom.Table).to_dataframe(dense=True)
+        X = X.reindex(features).fillna(0).T
+        probabilities = pd.DataFrame(model.predict_proba(X.to_numpy()),
+                                     index=X.index, columns=model.classes_)
+        return None, qiime2.Artifact.import_data('SampleData[Probabilities]',
+                                                 probabilities)
+
+    def gibbs(self, feature_table, sample_metadata, jobs,
+              source_category_column, loo, source_rarefaction_depth,
+              sink_rarefaction_depth):
+        # as sourcetracker2, the sources of each environment are collapsed
+        # to their summed counts. the sinks are then fit as a mixture of them
+        table = feature_table.view(biom.Table)
+        md = sample_metadata.to_dataframe().reindex(table.ids())
+        is_source = md['SourceSink'] == 'source'
+        env = md.loc[is_source, source_category_column]
+        sources = table.filter(env.index, inplace=False).collapse(
+            lambda i, m: env[i], norm=False, axis='sample')
+        sinks = table.filter(md.index[~is_source], inplace=False)
+        proportions = mixture_proportions(
+            sources, pd.Series(sources.ids(), index=sources.ids()), sinks)
+        return _sourcetracker_artifact(proportions), None
+
+    def classify_samples_ncv(self, table, metadata, n_jobs, random_state):
+        table = table.view(biom.Table)
+        labels = metadata.to_series()
+        missing = set(table.ids()) - set(labels.index)
+        if missing:
+            raise ValueError("Missing samples in metadata: %s" % missing)
+        probabilities = leave_one_out_probabilities(table, labels)
+        return None, None, qiime2.Artifact.import_data(
+            'SampleData[Probabilities]', probabilities)
+
+
+class WithinDatasetColumnsTests(unittest.TestCase):
+    def test_partially_described_column(self):
+        rng = np.random.default_rng(0)
+        profiles = rng.dirichlet(np.full(50, 0.2), 2)
+        labels = np.repeat(['gut', 'oral'], 20)
+        counts = np.vstack([rng.multinomial(2000, profiles[i])
+                            for i in np.repeat([0, 1], 20)]).T
+        ids = ['S%d' % i for i in range(40)]
+        table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            biom.Table(counts, ['O%d' % i for i in range(50)], ids))
+
+        # site only describes half of the samples
+        site = np.where(np.arange(40) % 2 == 0, labels, None)
+        md = qiime2.Metadata(pd.DataFrame(
+            {'env': labels, 'site': site},
+            index=pd.Index(ids, name='#SampleID')))
+
+        mislabelings, probabilities, _, _ = within_dataset_columns(
+            FakeContext(), table, md, ['env', 'site'], sampling_depth=1000,
+            rarefaction_engine='in-process', contamination_engine='mixture',
+            random_state=0)
+        self.assertEqual(len(probabilities['env'].view(pd.DataFrame)), 40)
+        self.assertEqual(sorted(probabilities['site'].view(pd.DataFrame)
+                                .index), sorted(ids[::2]))
+        self.assertEqual(sorted(mislabelings['site'].view(pd.DataFrame)
+                                .index), sorted(ids[::2]))
+
+
+class PreparedReferenceTests(unittest.TestCase):
+    def setUp(self):
+        # every sample is at the rarefaction depth, so rarefying keeps it
+        rng = np.random.default_rng(0)
+        profiles = rng.dirichlet(np.full(40, 0.3), 3)
+        envs = np.array(['gut', 'oral', 'skin'])
+
+        def dataset(prefix, labels, drawn):
+            ids = ['%s%d' % (prefix, i) for i in range(len(labels))]
+            counts = np.vstack([rng.multinomial(1000, profiles[i])
+                                for i in drawn]).T
+            table = qiime2.Artifact.import_data(
+                'FeatureTable[Frequency]',
+                biom.Table(counts, ['O%d' % i for i in range(40)], ids))
+            env = qiime2.CategoricalMetadataColumn(pd.Series(
+                envs[labels], index=pd.Index(ids, name='#SampleID'),
+                name='env'))
+            return table, env
+
+        labels = np.repeat([0, 1, 2], 10)
+        self.reference, self.reference_env = dataset('R', labels, labels)
+        # F0 is labelled gut but drawn from oral
+        labels = np.repeat([0, 1, 2], 3)
+        drawn = labels.copy()
+        drawn[0] = 1
+        self.focus, self.focus_env = dataset('F', labels, drawn)
+
+    def test_matches_against_dataset(self):
+        for engine in CONTAMINATION_ENGINES:
+            kwargs = dict(rarefaction_engine='in-process',
+                          contamination_engine=engine, random_state=0)
+            exp = against_dataset(FakeContext(), self.focus, self.reference,
+                                  self.focus_env, self.reference_env,
+                                  **kwargs)
+            bundle = prepare_reference(FakeContext(), self.reference,
+                                       self.reference_env,
+                                       rarefaction_engine='in-process',
+                                       random_state=0)
+            obs = against_prepared_reference(FakeContext(), self.focus,
+                                             bundle, self.focus_env,
+                                             **kwargs)
+            for o, e in zip(obs, exp):
+                pdt.assert_frame_equal(o.view(pd.DataFrame),
+                                       e.view(pd.DataFrame))
+            mislabelings = obs[0].view(pd.DataFrame)
+            self.assertEqual(mislabelings.loc['F0', 'corrected_label'],
+                             'oral')
+
+    def test_source_ids(self):
+        # the summed sources do not collide with focus samples named after
+        # an environment
+        bundle = prepare_reference(FakeContext(), self.reference,
+                                   self.reference_env,
+                                   rarefaction_engine='in-process',
+                                   random_state=0)
+        table = self.focus.view(biom.Table).copy()
+        table.update_ids({'F0': 'gut'}, strict=False, inplace=True)
+        focus = qiime2.Artifact.import_data('FeatureTable[Frequency]', table)
+        env = self.focus_env.to_series().rename({'F0': 'gut'})
+        mislabelings, _, proportions = against_prepared_reference(
+            FakeContext(), focus, bundle,
+            qiime2.CategoricalMetadataColumn(env), random_state=0,
+            rarefaction_engine='in-process')
+        self.assertEqual(sorted(proportions.view(pd.DataFrame).index),
+                         sorted(env.index))
+
+
+class ShardedSourcetrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.ids = ['S%d' % i for i in range(7)]
+        self.table = qiime2.Artifact.import_data(
+            'FeatureTable[Frequency]',
+            biom.Table(np.arange(1, 22).reshape(3, 7), ['O1', 'O2', 'O3'],
+                       self.ids))
+        # S6 is a sink of the pipeline, so it is not assessed
+        self.md = qiime2.Metadata(pd.DataFrame(
+            {'env': ['gut', 'gut', 'gut', 'oral', 'oral', 'oral', 'gut'],
+             'SourceSink': ['source'] * 6 + ['sink']},
+            index=pd.Index(self.ids, name='#SampleID')))
+
+    def gibbs(self, sources, sinks, jobs, create_feature_tables):
+        # as sourcetracker2, the proportions of every sink are returned,
+        # here those of the sources themselves
+        self.calls.append((sources.copy(), sinks.copy()))
+        proportions = sources.sum(axis=1) / sources.to_numpy().sum()
+        proportions['Unknown'] = 0.0
+        return pd.DataFrame([proportions] * len(sinks), index=sinks.index), \
+            None, None
+
+    def test_gibbs_shards(self):
+        ids, table, md = self.ids, self.table, self.md
+
+        # the shards run sourcetracker2 rather than the action of the context
+        ctx = FakeContext()
+        ctx.gibbs = None
+        module = types.ModuleType('sourcetracker._sourcetracker')
+        module.gibbs = self.gibbs
+        with unittest.mock.patch.dict(sys.modules, {
+                'sourcetracker._sourcetracker': module}):
+            sharded = _get_sharded_sourcetracker(ctx, 'gibbs', 3, None)
+            proportions, _ = sharded(table, md, jobs=1,
+                                     source_category_column='env', loo=True,
+                                     source_rarefaction_depth=0,
+                                     sink_rarefaction_depth=0)
+
+        # each sink is left out of the summed counts of its environment, and
+        # the sink of the pipeline is in none of them
+        counts = table.view(pd.DataFrame)
+        sums = pd.DataFrame({'gut': counts.loc[ids[:3]].sum(),
+                             'oral': counts.loc[ids[3:6]].sum()}).T
+        self.assertEqual(sorted(sinks.index[0] for _, sinks in self.calls),
+                         ids[:6])
+        for sources, sinks in self.calls:
+            sink = sinks.index[0]
+            exp = sums.copy()
+            exp.loc[md.get_column('env').to_series()[sink]] -= \
+                counts.loc[sink]
+            pdt.assert_frame_equal(sources, exp, check_dtype=False,
+                                   check_names=False)
+            pdt.assert_series_equal(sinks.loc[sink], counts.loc[sink],
+                                    check_dtype=False, check_names=False)
+
+        obs = proportions.view(pd.DataFrame).T
+        self.assertEqual(sorted(obs.index), ids[:6])
+        self.assertEqual(list(obs.columns), ['gut', 'oral', 'Unknown'])
+
+    def test_mixture_shards(self):
+        # the workers map only the sources, which they use without copying
+        kwargs = dict(jobs=1, source_category_column='env', loo=True,
+                      source_rarefaction_depth=0, sink_rarefaction_depth=0)
+        sharded = _get_sharded_sourcetracker(FakeContext(), 'mixture', 3,
+                                             None)
+        with unittest.mock.patch.object(MappedTable, 'filter',
+                                        side_effect=AssertionError):
+            obs, _ = sharded(self.table, self.md, **kwargs)
+        exp, _ = _get_sourcetracker(FakeContext(), 'mixture')(
+            self.table, self.md, **kwargs)
+        pdt.assert_frame_equal(obs.view(pd.DataFrame).sort_index(axis=1),
+                               exp.view(pd.DataFrame).sort_index(axis=1))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,58 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import os
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import biom
+
+from q2_mislabeled._probe import TableProbe
+
+
+class TableProbeTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'feature-table.biom')
+
+        # an empty sample, so that the totals do not rely on every sample
+        # having an entry
+        data = np.array([[0, 5, 1, 0],
+                         [2, 0, 3, 0],
+                         [0, 0, 4, 0]])
+        self.table = biom.Table(data, ['O1', 'O2', 'O3'],
+                                ['S1', 'S2', 'S3', 'S4'])
+        with h5py.File(self.path, 'w') as fh:
+            self.table.to_hdf5(fh, generated_by='q2-mislabeled tests')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_shape(self):
+        self.assertEqual(TableProbe(self.path).shape, (3, 4))
+
+    def test_sample_ids(self):
+        self.assertEqual(list(TableProbe(self.path).sample_ids()),
+                         ['S1', 'S2', 'S3', 'S4'])
+
+    def test_feature_ids(self):
+        self.assertEqual(list(TableProbe(self.path).feature_ids()),
+                         ['O1', 'O2', 'O3'])
+
+    def test_sample_totals(self):
+        obs = TableProbe(self.path).sample_totals()
+        exp = pd.Series([2.0, 5.0, 8.0, 0.0],
+                        index=pd.Index(['S1', 'S2', 'S3', 'S4']))
+        pdt.assert_series_equal(obs, exp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import pandas as pd
+import biom
+
+from q2_mislabeled._profiling import (StageRecorder, to_openmetrics,
+                                      METRICS_COLUMNS)
+
+
+class StageRecorderTests(unittest.TestCase):
+    def setUp(self):
+        self.table = biom.Table(np.arange(12).reshape(3, 4),
+                                ['O1', 'O2', 'O3'],
+                                ['S1', 'S2', 'S3', 'S4'])
+
+    def test_run(self):
+        recorder = StageRecorder()
+        obs = recorder.run('subset', lambda t: t.filter(['S1', 'S2'],
+                                                        inplace=False),
+                           self.table)
+        self.assertEqual(list(obs.ids()), ['S1', 'S2'])
+
+        df = recorder.to_dataframe()
+        self.assertEqual(list(df.columns), METRICS_COLUMNS)
+        self.assertEqual(list(df.index), ['001'])
+        self.assertEqual(df.index.name, 'id')
+
+        row = df.loc['001']
+        self.assertEqual(row['stage'], 'subset')
+        self.assertEqual(row['input_samples'], 4)
+        self.assertEqual(row['input_features'], 3)
+        self.assertEqual(row['output_samples'], 2)
+        self.assertEqual(row['output_features'], 3)
+        self.assertGreaterEqual(row['wall_time_s'], 0)
+        self.assertGreater(row['peak_rss_mb'], 0)
+
+    def test_wrap(self):
+        recorder = StageRecorder()
+        action = recorder.wrap('action', lambda t: (t, None))
+        action(self.table)
+        action(self.table)
+
+        df = recorder.to_dataframe()
+        self.assertEqual(list(df.index), ['001', '002'])
+        self.assertEqual(list(df['stage']), ['action', 'action'])
+        self.assertEqual(list(df['output_samples']), [4, 4])
+
+    def test_parallel_skips_dimensions(self):
+        recorder = StageRecorder(parallel=True)
+        recorder.run('identity', lambda t: t, self.table)
+
+        df = recorder.to_dataframe()
+        self.assertTrue(df[['input_samples', 'input_features',
+                            'output_samples', 'output_features']]
+                        .isnull().all().all())
+
+
+class OpenMetricsTests(unittest.TestCase):
+    def test_to_openmetrics(self):
+        df = pd.DataFrame([['rarefy', 1.5, 3.0, 2.0, 10, 5, 8, 4],
+                           ['view "x"', 0.25, 0.25, 2.0, None, None, 8,
+                            None]],
+                          columns=METRICS_COLUMNS,
+                          index=pd.Index(['001', '002'], name='id'))
+        obs = to_openmetrics(df).splitlines()
+
+        self.assertEqual(obs[-1], '# EOF')
+        self.assertIn('# TYPE q2_mislabeled_stage_wall_time_seconds gauge',
+                      obs)
+        self.assertIn('# UNIT q2_mislabeled_stage_wall_time_seconds seconds',
+                      obs)
+        self.assertIn('q2_mislabeled_stage_wall_time_seconds'
+                      '{step="001",stage="rarefy"} 1.5', obs)
+        self.assertIn('q2_mislabeled_stage_peak_rss_bytes'
+                      '{step="001",stage="rarefy"} 2097152.0', obs)
+        self.assertIn('q2_mislabeled_stage_wall_time_seconds'
+                      '{step="002",stage="view \\"x\\""} 0.25', obs)
+
+        # missing values are omitted rather than exported
+        features = [line for line in obs if line.startswith(
+            'q2_mislabeled_stage_output_features{')]
+        self.assertEqual(features, ['q2_mislabeled_stage_output_features'
+                                    '{step="001",stage="rarefy"} 4.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
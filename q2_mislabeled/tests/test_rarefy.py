@@ -0,0 +1,89 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+import biom
+
+from q2_mislabeled._rarefy import rarefy, rarefy_filter
+
+
+class RarefyTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        data = rng.poisson(5, size=(40, 30)) * (rng.random((40, 30)) > 0.5)
+        data[:, 3] = 0
+        data[0, 3] = 10  # a sample below the depth used below
+        data[39] = 0
+        data[39, 3] = 4  # a feature only present in that sample
+        self.table = biom.Table(data,
+                                ['O%d' % i for i in range(40)],
+                                ['S%d' % i for i in range(30)])
+
+    def test_rarefy(self):
+        obs = rarefy(self.table, 20, random_state=42)
+
+        self.assertNotIn('S3', obs.ids())
+        self.assertEqual(len(obs.ids()), 29)
+        npt.assert_equal(obs.sum(axis='sample'), np.full(29, 20))
+
+        # the feature only present in the dropped sample is removed, as are
+        # any others which were not drawn
+        self.assertNotIn('O39', obs.ids(axis='observation'))
+        self.assertTrue((obs.sum(axis='observation') > 0).all())
+
+        # we never draw more than is present
+        orig = self.table.filter(obs.ids(), inplace=False)
+        orig = orig.filter(obs.ids(axis='observation'), axis='observation',
+                           inplace=False)
+        self.assertTrue((obs.matrix_data.toarray() <=
+                         orig.matrix_data.toarray()).all())
+
+    def test_rarefy_reproducible_across_n_jobs(self):
+        exp = rarefy(self.table, 20, n_jobs=1, random_state=42)
+        for n_jobs in (2, 3):
+            obs = rarefy(self.table, 20, n_jobs=n_jobs, random_state=42)
+            self.assertEqual(obs, exp)
+
+    def test_rarefy_seed_changes_draw(self):
+        a = rarefy(self.table, 20, random_state=1)
+        b = rarefy(self.table, 20, random_state=2)
+        self.assertNotEqual(a, b)
+
+    def test_rarefy_too_deep(self):
+        with self.assertRaisesRegex(ValueError, 'no samples'):
+            rarefy(self.table, 10000)
+
+    def test_rarefy_non_integer(self):
+        table = biom.Table(np.array([[0.5, 2], [3, 4]]), ['O1', 'O2'],
+                           ['S1', 'S2'])
+        with self.assertRaisesRegex(ValueError, 'integer'):
+            rarefy(table, 2)
+
+    def test_rarefy_filter(self):
+        def prevalent(table, min_samples):
+            return table.filter(lambda v, i, m: (v > 0).sum() >= min_samples,
+                                axis='observation', inplace=False)
+
+        # the same draws as filtering, rarefying and filtering separately
+        for min_samples in (1, 5, 12):
+            exp = prevalent(rarefy(prevalent(self.table, min_samples), 20,
+                                   random_state=42), min_samples)
+            obs = rarefy_filter(self.table, 20, min_samples, n_jobs=2,
+                                random_state=42)
+            self.assertEqual(obs, exp)
+
+        # S3 only reaches the depth with O39, which is only present in it
+        obs = rarefy_filter(self.table, 11, 2, random_state=42)
+        self.assertNotIn('S3', obs.ids())
+        self.assertIn('S3', rarefy(self.table, 11, random_state=42).ids())
+
+
+if __name__ == '__main__':
+    unittest.main()
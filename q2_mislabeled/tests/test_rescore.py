@@ -0,0 +1,81 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import typing
+import unittest
+import pandas as pd
+import pandas.testing as pdt
+import qiime2
+
+from q2_mislabeled._pipelines import (_set_mislabeled, _set_contamination,
+                                      NOT_APPLICABLE)
+from q2_mislabeled._rescore import rescore_grid, _rescore, _threshold_pairs
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.env_df = pd.DataFrame({'env': ['fecal', 'oral', 'skin',
+                                            'fecal']},
+                                   index=pd.Index(['foo', 'bar', 'baz',
+                                                   'extra'],
+                                                  name='#SampleID'))
+        self.prob_df = pd.DataFrame([[0.5, 0.2, 0.3],
+                                     [0.3, 0.3, 0.4],
+                                     [0.6, 0.2, 0.2]],
+                                    index=['bar', 'baz', 'foo'],
+                                    columns=['fecal', 'oral', 'skin'])
+        self.prop_df = pd.DataFrame([[0.5, 0.2, 0.3],
+                                     [0.3, 0.3, 0.4],
+                                     [0.7, 0.1, 0.2]],
+                                    index=['bar', 'baz', 'foo'],
+                                    columns=['fecal', 'oral', 'skin'])
+
+    def test_rescore_matches_pipelines(self):
+        exp = self.env_df.copy()
+        below = _set_mislabeled(exp, self.prob_df, 'env', 0.25)
+        _set_contamination(exp, self.prop_df, 'env', below, 0.6)
+
+        obs = _rescore(self.env_df, self.prob_df, self.prop_df, 0.25, 0.6)
+        pdt.assert_frame_equal(obs, exp)
+
+        # the input is not modified, so it can be rescored again
+        self.assertEqual(list(self.env_df.columns), ['env'])
+
+    def test_rescore_thresholds(self):
+        obs = _rescore(self.env_df, self.prob_df, self.prop_df, 0.1, 0.35)
+        self.assertEqual(list(obs['Mislabeled']),
+                         ['False', 'False', 'False', NOT_APPLICABLE])
+        self.assertEqual(list(obs['Contaminated']),
+                         ['False', 'True', 'False', 'False'])
+        self.assertEqual(list(obs['corrected_label']),
+                         ['fecal', 'fecal', 'skin', NOT_APPLICABLE])
+
+        obs = _rescore(self.env_df, self.prob_df, self.prop_df, 0.5, 0.6)
+        self.assertEqual(list(obs['Mislabeled']),
+                         ['False', 'True', 'True', NOT_APPLICABLE])
+        self.assertEqual(list(obs['Contaminated']),
+                         ['False', NOT_APPLICABLE, NOT_APPLICABLE, 'False'])
+
+    def test_rescore_grid(self):
+        env = qiime2.CategoricalMetadataColumn(self.env_df['env'])
+        obs = rescore_grid(self.prob_df, self.prop_df, env, [0.1, 0.5], [0.6])
+        self.assertEqual(list(obs), ['0.1_0.6', '0.5_0.6'])
+        pdt.assert_frame_equal(obs['0.5_0.6'], _rescore(
+            self.env_df, self.prob_df, self.prop_df, 0.5, 0.6))
+
+        # the collection registered is what is returned
+        self.assertEqual(typing.get_type_hints(rescore_grid)['return'],
+                         typing.Dict[str, pd.DataFrame])
+
+    def test_threshold_pairs(self):
+        obs = list(_threshold_pairs([0.25, 0.5], [0.6]))
+        self.assertEqual(obs, [('0.25_0.6', 0.25, 0.6),
+                               ('0.5_0.6', 0.5, 0.6)])
+
+
+if __name__ == '__main__':
+    unittest.main()
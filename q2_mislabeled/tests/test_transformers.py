@@ -12,7 +12,9 @@ import pandas.testing as pdt
 from unittest import main
 from qiime2.plugin.testing import TestPluginBase
 from q2_mislabeled._pipelines import NOT_APPLICABLE
-from q2_mislabeled._format import TSVFormat
+from q2_mislabeled._format import (TSVFormat, StageMetricsFormat,
+                                   OpenMetricsFormat)
+from q2_mislabeled._profiling import METRICS_COLUMNS
 import numpy as np
 
 
@@ -69,6 +71,29 @@ class TransformerTests(TestPluginBase):
         obs = transformer(ff)
         self.assertEqual(obs, Metadata(self.df))
 
+    def test_stage_metrics_roundtrip(self):
+        df = pd.DataFrame([['rarefy', 1.5, 3.0, 200.0, 10, 5, 8, 4],
+                           ['gibbs', 20.0, 40.0, 250.0, 8, 4, np.nan,
+                            np.nan]],
+                          columns=METRICS_COLUMNS,
+                          index=pd.Index(['001', '002'], name='id'))
+        to_format = self.get_transformer(pd.DataFrame, StageMetricsFormat)
+        from_format = self.get_transformer(StageMetricsFormat, pd.DataFrame)
+        obs = from_format(to_format(df))
+        pdt.assert_frame_equal(obs, df, check_dtype=False)
+
+    def test_stage_metrics_to_openmetrics(self):
+        df = pd.DataFrame([['rarefy', 1.5, 3.0, 200.0, 10, 5, 8, 4]],
+                          columns=METRICS_COLUMNS,
+                          index=pd.Index(['001'], name='id'))
+        ff = self.get_transformer(pd.DataFrame, StageMetricsFormat)(df)
+        obs = self.get_transformer(StageMetricsFormat, OpenMetricsFormat)(ff)
+        with obs.open() as fh:
+            lines = fh.read().splitlines()
+        self.assertIn('q2_mislabeled_stage_wall_time_seconds'
+                      '{step="001",stage="rarefy"} 1.5', lines)
+        self.assertEqual(lines[-1], '# EOF')
+
 
 if __name__ == '__main__':
     main()
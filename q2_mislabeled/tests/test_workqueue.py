@@ -0,0 +1,133 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2022-, Mislabeled development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from q2_mislabeled._workqueue import WorkQueue, local_workers, task
+
+
+@task
+def _square(value):
+    return value ** 2
+
+
+@task
+def _pid(delay):
+    time.sleep(delay)
+    return os.getpid()
+
+
+@task
+def _fail(value):
+    raise ValueError("cannot use %r" % value)
+
+
+@task
+def _unserializable():
+    return object()
+
+
+def _unmarked(value):
+    return value
+
+
+class WorkQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = WorkQueue(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_gather(self):
+        # without workers, the tasks are run while gathering them
+        names = [self.queue.submit(_square, i) for i in range(5)]
+        self.assertEqual(self.queue.gather(names), [0, 1, 4, 9, 16])
+        self.assertIsNone(self.queue.claim())
+
+    def test_local_workers(self):
+        names = [self.queue.submit(_pid, 0.2) for _ in range(6)]
+        with local_workers(self.tmp.name, 2):
+            pids = self.queue.gather(names)
+        self.assertEqual(len(pids), 6)
+        self.assertGreater(len(set(pids) - {os.getpid()}), 0)
+
+    def test_work(self):
+        for i in range(3):
+            self.queue.submit(_square, i)
+        self.assertEqual(self.queue.work(), 3)
+        self.assertEqual(self.queue.work(), 0)
+
+    def test_failure(self):
+        names = [self.queue.submit(_square, 2),
+                 self.queue.submit(_fail, 'foo')]
+        with self.assertRaisesRegex(RuntimeError, "cannot use 'foo'"):
+            self.queue.gather(names)
+
+    def test_directory(self):
+        for name in ('tasks', 'claimed', 'results'):
+            mode = os.stat(os.path.join(self.tmp.name, name)).st_mode
+            self.assertEqual(stat.S_IMODE(mode) & 0o077, 0)
+
+    def test_json(self):
+        name = self.queue.submit(_square, 3)
+        with open(os.path.join(self.tmp.name, 'tasks', name)) as fh:
+            self.assertEqual(json.load(fh),
+                             {'task': '%s:_square' % __name__, 'args': [3]})
+
+    def test_unmarked(self):
+        with self.assertRaisesRegex(ValueError, "not a task"):
+            self.queue.submit(_unmarked, 1)
+
+        # a task written to the directory by other means is not run unless it
+        # names a task of the package
+        for spec in ('os:getcwd', '%s:_unmarked' % __name__):
+            path = os.path.join(self.tmp.name, 'tasks', spec.split(':')[0])
+            with open(path, 'w') as fh:
+                json.dump({'task': spec, 'args': []}, fh)
+            with self.assertRaisesRegex(RuntimeError, "not a task"):
+                self.queue.gather([os.path.basename(path)])
+
+    def test_unserializable(self):
+        name = self.queue.submit(_unserializable)
+        with self.assertRaisesRegex(RuntimeError, "not JSON serializable"):
+            self.queue.gather([name])
+
+    def test_lease(self):
+        # a worker claimed the task, and stopped
+        name = self.queue.submit(_square, 3)
+        self.assertEqual(self.queue.claim(), name)
+        with self.assertRaises(TimeoutError):
+            self.queue.gather([name], timeout=0.2)
+
+        claimed = os.path.join(self.tmp.name, 'claimed', name)
+        os.utime(claimed, (time.time() - 60, time.time() - 60))
+        self.assertEqual(self.queue.gather([name], lease=30), [9])
+
+    @unittest.mock.patch('q2_mislabeled._workqueue.HEARTBEAT', 0.05)
+    def test_lease_running(self):
+        # a worker running a task longer than the lease keeps its claim
+        name = self.queue.submit(_pid, 1)
+        self.assertEqual(self.queue.claim(), name)
+        worker = threading.Thread(target=self.queue.run, args=(name, ))
+        worker.start()
+        time.sleep(0.5)
+        self.queue._release([name], 0.25)
+        self.assertIsNone(self.queue.claim())
+        worker.join()
+        self.assertEqual(self.queue.gather([name], lease=0.25), [os.getpid()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,55 +1,90 @@
 import pandas as pd
 import qiime2
 
-input_md = pd.read_csv('mvp_problematic.tsv', sep='\t').set_index('#SampleID')
-result_md = qiime2.Artifact.load('within_test_run.qza').view(pd.DataFrame)
-
-for r in input_md.itertuples():
-    if r.intentional_mislabel:
-        incorrect = r.env_package
-        original = r.original_env_package
-        corrected = result_md.loc[r.Index, 'corrected_label']
-        if original != corrected:
-            print("MISLABELED")
-            print(r.Index)
-            print("Incorrect:", incorrect)
-            print("Original:", original)
-            print("Corrected:", corrected)
-            print(result_md.loc[r.Index, 'Mislabeled'])
-            print("---")
-        assert result_md.loc[r.Index, 'Mislabeled']
-        assert original == corrected
-    if r.intentional_contamination:
-        if not result_md.loc[r.Index, 'Contaminated']:
-            print("CONTAMINATED")
-            print(result_md.loc[r.Index, 'min_proportion'])
-            print("---")
-        assert result_md.loc[r.Index, 'Contaminated']
-
-input_md = pd.read_csv('tmi_problematic.tsv', sep='\t').set_index('#SampleID')
-result_md = qiime2.Artifact.load('against_test_run.qza').view(pd.DataFrame)
-
-# we should not have reference samples in our result
-assert set(input_md.index) == set(result_md.index)
-
-for r in input_md.itertuples():
-    if r.intentional_mislabel:
-        incorrect = r.env_package
-        original = r.original_env_package
-        corrected = result_md.loc[r.Index, 'corrected_label']
-        if original != corrected:
-            print("MISLABELED")
-            print(r.Index)
-            print("Incorrect:", incorrect)
-            print("Original:", original)
-            print("Corrected:", corrected)
-            print(result_md.loc[r.Index, 'Mislabeled'])
-            print("---")
-        assert result_md.loc[r.Index, 'Mislabeled']
-        assert original == corrected
-    if r.intentional_contamination:
-        if not result_md.loc[r.Index, 'Contaminated']:
-            print("CONTAMINATED")
-            print(result_md.loc[r.Index, 'min_proportion'])
-            print("---")
-        assert result_md.loc[r.Index, 'Contaminated']
+
+def check(input_md, result_md):
+    """Assert that every injected problem was detected"""
+    for r in input_md.itertuples():
+        if r.intentional_mislabel:
+            incorrect = r.env_package
+            original = r.original_env_package
+            corrected = result_md.loc[r.Index, 'corrected_label']
+            if original != corrected:
+                print("MISLABELED")
+                print(r.Index)
+                print("Incorrect:", incorrect)
+                print("Original:", original)
+                print("Corrected:", corrected)
+                print(result_md.loc[r.Index, 'Mislabeled'])
+                print("---")
+            assert result_md.loc[r.Index, 'Mislabeled']
+            assert original == corrected
+        if r.intentional_contamination:
+            if not result_md.loc[r.Index, 'Contaminated']:
+                print("CONTAMINATED")
+                print(result_md.loc[r.Index, 'min_proportion'])
+                print("---")
+            assert result_md.loc[r.Index, 'Contaminated']
+
+
+def assess(input_md, result_md, column='env_package'):
+    """Summarize how well the injected problems were detected
+
+    Samples absent from the result (e.g., removed by rarefaction) are not
+    counted.
+
+    Returns
+    -------
+    dict
+        mislabel_recall: the fraction of mislabeled samples flagged as such
+        correction_accuracy: the fraction of mislabeled samples whose
+            corrected label is their original label
+        contamination_recall: the fraction of contaminated samples flagged
+            as such
+        false_mislabel_rate: the fraction of correctly labeled samples
+            flagged as mislabeled
+        false_contamination_rate: the fraction of clean, correctly labeled
+            samples flagged as contaminated
+    """
+    input_md = input_md.loc[input_md.index.isin(result_md.index)]
+    result_md = result_md.loc[input_md.index]
+
+    injected_mislabel = input_md['intentional_mislabel'].astype(str) == 'True'
+    injected_contamination = \
+        input_md['intentional_contamination'].astype(str) == 'True'
+    clean = ~injected_mislabel & ~injected_contamination
+    flagged_mislabel = result_md['Mislabeled'].astype(str) == 'True'
+    flagged_contamination = result_md['Contaminated'].astype(str) == 'True'
+    corrected = (result_md['corrected_label'] ==
+                 input_md['original_%s' % column])
+
+    def fraction(flags, of):
+        return flags[of].mean() if of.any() else float('nan')
+
+    return {'mislabel_recall': fraction(flagged_mislabel, injected_mislabel),
+            'correction_accuracy': fraction(corrected, injected_mislabel),
+            'contamination_recall': fraction(flagged_contamination,
+                                             injected_contamination),
+            'false_mislabel_rate': fraction(flagged_mislabel,
+                                            ~injected_mislabel),
+            'false_contamination_rate': fraction(flagged_contamination,
+                                                 clean)}
+
+
+if __name__ == '__main__':
+    input_md = pd.read_csv('mvp_problematic.tsv',
+                           sep='\t').set_index('#SampleID')
+    result_md = qiime2.Artifact.load('within_test_run.qza').view(pd.DataFrame)
+    check(input_md, result_md)
+    print('within_test_run.qza', assess(input_md, result_md))
+
+    input_md = pd.read_csv('tmi_problematic.tsv',
+                           sep='\t').set_index('#SampleID')
+    for result in ('against_test_run.qza', 'against_prepared_test_run.qza'):
+        result_md = qiime2.Artifact.load(result).view(pd.DataFrame)
+
+        # we should not have reference samples in our result
+        assert set(input_md.index) == set(result_md.index)
+
+        check(input_md, result_md)
+        print(result, assess(input_md, result_md))
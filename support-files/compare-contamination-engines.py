@@ -0,0 +1,44 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import qiime2
+
+
+def compare(gibbs_md, mixture_md):
+    """Summarize the agreement of two results of the same pipeline"""
+    ids = gibbs_md.index.intersection(mixture_md.index)
+    gibbs_md = gibbs_md.loc[ids]
+    mixture_md = mixture_md.loc[ids]
+
+    both = gibbs_md['min_proportion'].notnull() & \
+        mixture_md['min_proportion'].notnull()
+    gibbs_prop = gibbs_md.loc[both, 'min_proportion']
+    mixture_prop = mixture_md.loc[both, 'min_proportion']
+
+    return {'samples': int(both.sum()),
+            'proportion_correlation': np.corrcoef(gibbs_prop,
+                                                  mixture_prop)[0, 1],
+            'proportion_mean_abs_difference': (gibbs_prop -
+                                               mixture_prop).abs().mean(),
+            'contaminated_agreement': (gibbs_md.loc[both, 'Contaminated'] ==
+                                       mixture_md.loc[both, 'Contaminated']
+                                       ).mean(),
+            'contaminated_gibbs_only': int(
+                ((gibbs_md.loc[both, 'Contaminated'] == 'True') &
+                 (mixture_md.loc[both, 'Contaminated'] != 'True')).sum()),
+            'contaminated_mixture_only': int(
+                ((gibbs_md.loc[both, 'Contaminated'] != 'True') &
+                 (mixture_md.loc[both, 'Contaminated'] == 'True')).sum())}
+
+
+if __name__ == '__main__':
+    # pairs of results from the gibbs and mixture engines, e.g.
+    # within_test_run.qza within_mixture_test_run.qza
+    pairs = sys.argv[1:]
+    for gibbs, mixture in zip(pairs[::2], pairs[1::2]):
+        summary = compare(qiime2.Artifact.load(gibbs).view(pd.DataFrame),
+                          qiime2.Artifact.load(mixture).view(pd.DataFrame))
+        print(gibbs, 'vs', mixture)
+        for name, value in summary.items():
+            print('  %-32s %s' % (name, value))
@@ -1,81 +1,79 @@
 import biom
 import pandas as pd
 import sys
-import qiime2
 import random
-import numpy as np
-
-tab = biom.load_table(sys.argv[1])
-tab.filter(lambda v, i, m: v.sum() >= 1000)
-md = pd.read_csv(sys.argv[2], sep='\t', dtype=str).set_index('#SampleID')
-md = md[md['env_package'].isin(['human-gut', 'human-skin',
-                                'human-oral'])]
-o = set(tab.ids()) & set(md.index)
-md = md.loc[o]
-tab = tab.filter(o).remove_empty()
-
-size = int(sys.argv[3])
-keep = []
-for _, grp in md.groupby('env_package'):
-    ids = list(grp.index)
-    random.shuffle(ids)
-    keep.extend(ids[:size])
-tab = tab.filter(set(keep)).remove_empty()
-random.shuffle(keep)
-md = md.loc[keep]
-
-md['intentional_mislabel'] = False
-md['intentional_contamination'] = False
-md['original_env_package'] = md['env_package']
-
-gut = md[md['env_package'] == 'human-gut']
-oral = md[md['env_package'] == 'human-oral']
-skin = md[md['env_package'] == 'human-skin']
-
-md.loc[gut.index[0], 'env_package'] = 'human-oral'
-md.loc[gut.index[1], 'env_package'] = 'human-skin'
-md.loc[gut.index[0], 'intentional_mislabel'] = True
-md.loc[gut.index[1], 'intentional_mislabel'] = True
-md.loc[gut.index[0], 'original_env_package'] = 'human-gut'
-md.loc[gut.index[1], 'original_env_package'] = 'human-gut'
-
-md.loc[oral.index[0], 'env_package'] = 'human-gut'
-md.loc[oral.index[1], 'env_package'] = 'human-skin'
-md.loc[oral.index[0], 'intentional_mislabel'] = True
-md.loc[oral.index[1], 'intentional_mislabel'] = True
-md.loc[oral.index[0], 'original_env_package'] = 'human-oral'
-md.loc[oral.index[1], 'original_env_package'] = 'human-oral'
-
-md.loc[skin.index[0], 'env_package'] = 'human-gut'
-md.loc[skin.index[1], 'env_package'] = 'human-oral'
-md.loc[skin.index[0], 'intentional_mislabel'] = True
-md.loc[skin.index[1], 'intentional_mislabel'] = True
-md.loc[skin.index[0], 'original_env_package'] = 'human-skin'
-md.loc[skin.index[1], 'original_env_package'] = 'human-skin'
-
-gut_sample = tab.data(gut.index[3], dense=False)
-skin_sample = tab.data(skin.index[3], dense=False)
-oral_sample = tab.data(oral.index[3], dense=False)
-
-tab.matrix_data[:, tab.index(gut.index[4], 'sample')] += skin_sample
-tab.matrix_data[:, tab.index(gut.index[5], 'sample')] += oral_sample
-
-tab.matrix_data[:, tab.index(skin.index[4], 'sample')] += gut_sample
-tab.matrix_data[:, tab.index(skin.index[5], 'sample')] += oral_sample
-
-tab.matrix_data[:, tab.index(oral.index[4], 'sample')] += skin_sample
-tab.matrix_data[:, tab.index(oral.index[5], 'sample')] += gut_sample
-
-md.loc[gut.index[4], 'intentional_contamination'] = True
-md.loc[gut.index[5], 'intentional_contamination'] = True
-md.loc[gut.index[6], 'intentional_contamination'] = True
-md.loc[skin.index[4], 'intentional_contamination'] = True
-md.loc[skin.index[5], 'intentional_contamination'] = True
-md.loc[skin.index[6], 'intentional_contamination'] = True
-md.loc[oral.index[4], 'intentional_contamination'] = True
-md.loc[oral.index[5], 'intentional_contamination'] = True
-md.loc[oral.index[6], 'intentional_contamination'] = True
-
-tab_ar = qiime2.Artifact.import_data('FeatureTable[Frequency]', tab)
-tab_ar.save(sys.argv[4] + '.biom.qza')
-md.to_csv(sys.argv[4] + '.tsv', sep='\t', index=True, header=True)
+
+
+ENVIRONMENTS = ('human-gut', 'human-skin', 'human-oral')
+
+
+def select_samples(tab, md, size, environments=ENVIRONMENTS):
+    """Keep up to size samples of each environment, in a random order"""
+    tab = tab.filter(lambda v, i, m: v.sum() >= 1000, inplace=False)
+    md = md[md['env_package'].isin(environments)]
+    o = set(tab.ids()) & set(md.index)
+    md = md.loc[list(o)]
+
+    keep = []
+    for _, grp in md.groupby('env_package'):
+        ids = list(grp.index)
+        random.shuffle(ids)
+        keep.extend(ids[:size])
+    tab = tab.filter(set(keep), inplace=False).remove_empty()
+    random.shuffle(keep)
+    md = md.loc[keep]
+    return tab, md
+
+
+def inject_problems(tab, md, column='env_package', flag_unchanged=True):
+    """Mislabel and contaminate samples of every environment
+
+    For each environment, the first two samples are relabeled as other
+    environments, and the fifth and sixth samples have the fourth sample of
+    another environment added to them. Unless flag_unchanged is False, the
+    seventh sample is marked as contaminated as well but left unchanged, as
+    in the committed fixtures which assess-test-run checks. Each environment
+    must have at least seven samples. The metadata gain intentional_mislabel,
+    intentional_contamination and original_<column> columns describing what
+    was done. The table is modified in place.
+    """
+    original = 'original_%s' % column
+    md = md.copy()
+    md['intentional_mislabel'] = False
+    md['intentional_contamination'] = False
+    md[original] = md[column]
+
+    groups = {env: grp.index for env, grp in md.groupby(column)}
+    environments = sorted(groups)
+    contaminants = {env: tab.data(groups[env][3], dense=False)
+                    for env in environments}
+
+    for env in environments:
+        ids = groups[env]
+        others = [e for e in environments if e != env]
+
+        for idx, other in zip(ids[:2], [others[0], others[-1]]):
+            md.loc[idx, column] = other
+            md.loc[idx, 'intentional_mislabel'] = True
+
+        for idx, other in zip(ids[4:6], [others[-1], others[0]]):
+            tab.matrix_data[:, tab.index(idx, 'sample')] += \
+                contaminants[other]
+            md.loc[idx, 'intentional_contamination'] = True
+        if flag_unchanged:
+            md.loc[ids[6], 'intentional_contamination'] = True
+
+    return tab, md
+
+
+if __name__ == '__main__':
+    import qiime2
+
+    tab = biom.load_table(sys.argv[1])
+    md = pd.read_csv(sys.argv[2], sep='\t', dtype=str).set_index('#SampleID')
+    tab, md = select_samples(tab, md, int(sys.argv[3]))
+    tab, md = inject_problems(tab, md)
+
+    tab_ar = qiime2.Artifact.import_data('FeatureTable[Frequency]', tab)
+    tab_ar.save(sys.argv[4] + '.biom.qza')
+    md.to_csv(sys.argv[4] + '.tsv', sep='\t', index=True, header=True)
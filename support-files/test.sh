@@ -8,6 +8,47 @@ qiime mislabeled within-dataset \
    --i-table mvp_problematic.biom.qza \
    --m-env-file mvp_problematic.tsv \
    --o-mislabelings within_test_run.qza \
+   --o-probabilities within_test_run_probabilities.qza \
+   --o-proportions within_test_run_proportions.qza \
+   --o-stage-metrics within_test_run_metrics.qza \
+   --m-env-column env_package \
+   --p-n-jobs 2 \
+   --verbose
+
+qiime mislabeled within-dataset \
+   --i-table mvp_problematic.biom.qza \
+   --m-env-file mvp_problematic.tsv \
+   --o-mislabelings within_mixture_test_run.qza \
+   --o-probabilities within_mixture_test_run_probabilities.qza \
+   --o-proportions within_mixture_test_run_proportions.qza \
+   --o-stage-metrics within_mixture_test_run_metrics.qza \
+   --m-env-column env_package \
+   --p-contamination-engine mixture \
+   --p-n-rarefactions 3 \
+   --p-n-jobs 2 \
+   --verbose
+
+qiime mislabeled within-dataset-columns \
+   --i-table mvp_problematic.biom.qza \
+   --m-metadata-file mvp_problematic.tsv \
+   --p-columns env_package body_site \
+   --o-mislabelings within_columns_test_run \
+   --o-probabilities within_columns_test_run_probabilities \
+   --o-proportions within_columns_test_run_proportions \
+   --o-stage-metrics within_columns_test_run_metrics.qza \
+   --p-contamination-engine mixture \
+   --p-n-jobs 2 \
+   --verbose
+
+qiime mislabeled within-dataset \
+   --i-table mvp_problematic.biom.qza \
+   --i-previous-probabilities within_test_run_probabilities.qza \
+   --i-previous-proportions within_test_run_proportions.qza \
+   --m-env-file mvp_problematic.tsv \
+   --o-mislabelings within_incremental_test_run.qza \
+   --o-probabilities within_incremental_test_run_probabilities.qza \
+   --o-proportions within_incremental_test_run_proportions.qza \
+   --o-stage-metrics within_incremental_test_run_metrics.qza \
    --m-env-column env_package \
    --p-n-jobs 2 \
    --verbose
@@ -20,8 +61,56 @@ qiime mislabeled against-dataset \
    --m-reference-env-file mvp_reference.tsv \
    --m-reference-env-column env_package \
    --o-mislabelings against_test_run.qza \
+   --o-probabilities against_test_run_probabilities.qza \
+   --o-proportions against_test_run_proportions.qza \
+   --o-stage-metrics against_test_run_metrics.qza \
    --p-alleged-min-probability 0.5 \
    --p-n-jobs 2 \
    --verbose
 
+qiime mislabeled prepare-reference \
+   --i-reference mvp_reference.biom.qza \
+   --m-reference-env-file mvp_reference.tsv \
+   --m-reference-env-column env_package \
+   --o-reference-bundle mvp_reference_bundle.qza \
+   --p-n-jobs 2 \
+   --verbose
+
+qiime mislabeled against-prepared-reference \
+   --i-focus tmi_problematic.biom.qza \
+   --i-reference mvp_reference_bundle.qza \
+   --m-focus-env-file tmi_problematic.tsv \
+   --m-focus-env-column env_package \
+   --o-mislabelings against_prepared_test_run.qza \
+   --o-probabilities against_prepared_test_run_probabilities.qza \
+   --o-proportions against_prepared_test_run_proportions.qza \
+   --p-alleged-min-probability 0.5 \
+   --p-n-jobs 2 \
+   --verbose
+
+qiime mislabeled rescore \
+   --i-probabilities within_test_run_probabilities.qza \
+   --i-proportions within_test_run_proportions.qza \
+   --m-env-file mvp_problematic.tsv \
+   --m-env-column env_package \
+   --o-mislabelings within_test_run_rescored.qza \
+   --verbose
+
+qiime mislabeled rescore-grid \
+   --i-probabilities against_test_run_probabilities.qza \
+   --i-proportions against_test_run_proportions.qza \
+   --m-env-file tmi_problematic.tsv \
+   --m-env-column env_package \
+   --p-alleged-min-probabilities 0.25 0.5 \
+   --p-env-min-proportions 0.4 0.6 \
+   --output-dir against_test_run_grid \
+   --verbose
+
+qiime tools export \
+   --input-path within_test_run_metrics.qza \
+   --output-path within_test_run_metrics \
+   --output-format OpenMetricsFormat
+
 python assess-test-run.py
+python compare-contamination-engines.py \
+   within_test_run.qza within_mixture_test_run.qza